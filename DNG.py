@@ -362,6 +362,7 @@ class DNG(object):
             self.length = None
             self.RowsPerStrip = None
             self.TileWidth = None
+            self.TileLength = None
             self.PlanarConfiguration = None
             self.BitsPerSample = None
             self._strips = None
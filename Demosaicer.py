@@ -143,7 +143,8 @@ class Demosaicer(ui.Drawable):
                     self.encoder.demosaicDuration(after-before)
                     if (frameData != self.lastFrameData) or (self.rgbFrameUploaded != frameNumber):
                         PLOG(PLOG_GPU,"RGB texture upload called for frame %d"%frameNumber)
-                        self.rgbUploadTex.update(frameData.rgbimage)
+                        data,yoff,rows = frameData.decodedImage(frameData.rgbimage,3)
+                        self.rgbUploadTex.update(data,0,yoff,frameData.width,rows)
                         PLOG(PLOG_GPU,"RGB texture upload returned for frame %d"%frameNumber)
                         self.rgbFrameUploaded = frameNumber
                     self.shaderQuality.demosaicPass(self.rgbUploadTex,self.luttex,frameData.black,balance=balance,white=frameData.white,tonemap=tone,colourMatrix=self.settings.setting_colourMatrix,lut1d1=self.lut1d1tex,lut1d2=self.lut1d2tex)
@@ -191,7 +192,8 @@ class Demosaicer(ui.Drawable):
                         self.encoder.demosaicDuration(after-before)
                     if (frameData != self.lastFrameData) or (self.rgbFrameUploaded != frameNumber):
                         PLOG(PLOG_GPU,"RGB texture upload called for frame %d"%frameNumber)
-                        self.rgbUploadTex.update(frameData.rgbimage)
+                        data,yoff,rows = frameData.decodedImage(frameData.rgbimage,3)
+                        self.rgbUploadTex.update(data,0,yoff,frameData.width,rows)
                         PLOG(PLOG_GPU,"RGB texture upload returned for frame %d"%frameNumber)
                         self.rgbFrameUploaded = frameNumber
                     wbalred = frameData.rawwbal[0]
@@ -206,7 +208,8 @@ class Demosaicer(ui.Drawable):
                     PLOG(PLOG_CPU,"Bayer 14-16 convert starts for frame %d"%frameNumber)
                     frameData.convert()
                     PLOG(PLOG_CPU,"Bayer 14-16 convert done for frame %d"%frameNumber)
-                    self.rawUploadTex.update(frameData.rawimage)
+                    data,yoff,rows = frameData.decodedImage(frameData.rawimage)
+                    self.rawUploadTex.update(data,0,yoff,frameData.width,rows)
                 PLOG(PLOG_GPU,"Demosaic shader draw for frame %d"%frameNumber)
 
                 if self.settings.setting_preprocess:
@@ -391,6 +391,7 @@ class DialogScene(ui.Scene):
             self.frames.refresh()
     def indexFile(self,filename):
         r = MlRaw.loadRAWorMLV(filename,preindex=False)
+        r.conversionPriority = MlRaw.ConversionPool.THUMBNAIL
         balance = r.getMeta("balance_v1")
         brightness = r.getMeta("brightness_v1")
         if r.frames()>1:
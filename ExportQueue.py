@@ -21,7 +21,7 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-import sys,os,threading,Queue,time,math,subprocess,multiprocessing,wave
+import sys,os,threading,Queue,time,math,subprocess,multiprocessing,wave,collections
 
 import wavext
 
@@ -70,6 +70,8 @@ class ExportQueue(threading.Thread):
     JOB_MKV = 2
     PREPROCESS_NONE = 0
     PREPROCESS_ALL = 1
+    DNG_TILES_ACROSS = 2 # LJ92 tiles across each frame, unless the dngTiles config state (across,down) says otherwise
+    DNG_MIN_TILE_LENGTH = 64
     def __init__(self,config,**kwds):
         super(ExportQueue,self).__init__(**kwds)
         self.config = config
@@ -77,7 +79,6 @@ class ExportQueue(threading.Thread):
         self.bgiq = Queue.Queue()
         self.wq = Queue.Queue()
         self.dq = Queue.Queue()
-        self.tc = Queue.Queue()
         self.jobs = {}
         self.jobstatus = {}
         self.jobindex = 0
@@ -262,7 +263,26 @@ class ExportQueue(threading.Thread):
         #print "FPS parts:",fps,fpsnum,fpsden
         return fps,fpsnum,fpsden
 
-    def setDngHeader(self,r,d,bits,frame,rgbl,ljpeg=False,date=None):
+    def dngTileGrid(self,width,height):
+        """
+        (tilewidth,tilelength) of the LJ92 tiles for a frame. Tiles are
+        compressed in parallel, so by default there are about as many as
+        cores, DNG_TILES_ACROSS wide. Sizes are even to keep the Bayer
+        pattern, and edge tiles are padded
+        """
+        grid = self.config.getState("dngTiles")
+        if grid != None:
+            across,down = grid
+        else:
+            across = self.DNG_TILES_ACROSS
+            down = max(1,(MlRaw.UnpackThreads.threads+across-1)/across)
+        across = max(1,across)
+        down = max(1,min(down,height/self.DNG_MIN_TILE_LENGTH))
+        tw = ((width+across-1)/across+1)&~1
+        tl = ((height+down-1)/down+1)&~1
+        return tw,tl
+
+    def setDngHeader(self,r,d,bits,frame,rgbl,ljpeg=False,date=None,tiles=None):
         d.stripTotal = 3000000
         d.bo = "<" # Little endian
         # Prepopulate DNG with basic set of tags for a single image
@@ -301,11 +321,14 @@ class ExportQueue(threading.Thread):
             atm(e,DNG.Tag.DateTime,"%04d:%02d:%02d %02d:%02d:%02d\0"%(ye+1900,mo,da,ho,mi,se))
         #atm(e,DNG.Tag.DateTime,"1988:10:01 23:23:23")
         if ljpeg:
-            at(e,DNG.Tag.TileWidth,r.width()/2)
-            at(e,DNG.Tag.TileLength,r.height())
-            ifd.TileWidth = r.width()/2
-            atm(e,DNG.Tag.TileOffsets,(0,0))
-            atm(e,DNG.Tag.TileByteCounts,(0,0))
+            tw,tl = tiles or self.dngTileGrid(r.width(),r.height())
+            count = ((r.width()+tw-1)/tw)*((r.height()+tl-1)/tl)
+            at(e,DNG.Tag.TileWidth,tw)
+            at(e,DNG.Tag.TileLength,tl)
+            ifd.TileWidth = tw
+            ifd.TileLength = tl
+            atm(e,DNG.Tag.TileOffsets,(0,)*count)
+            atm(e,DNG.Tag.TileByteCounts,(0,)*count)
         atm(e,DNG.Tag.CFARepeatPatternDim,(2,2)) # No compression
         atm(e,DNG.Tag.CFAPattern,(0,1,1,2)) # No compression
         at(e,DNG.Tag.EXIF_IFD,0)
@@ -449,6 +472,7 @@ class ExportQueue(threading.Thread):
         os.mkdir(dngdir)
         target = dngdir
         r = MlRaw.loadRAWorMLV(filename)
+        r.conversionPriority = MlRaw.ConversionPool.EXPORT # Viewer frames go first
         if endFrame == None:
             endFrame = r.frames()-1
         todo = endFrame-startFrame+1
@@ -461,20 +485,21 @@ class ExportQueue(threading.Thread):
         wavfile = self.wavOverride(r,wavfile)
         if wavfile != None:
             wavfile = os.path.join(os.path.split(filename)[0],wavfile)
+        if bits == 14 and r.bitsPerSample != 14:
+            bits = 16 # Packed data can only be copied from 14bit sources
         targfile = os.path.splitext(os.path.split(r.filename)[1])[0]
         target = os.path.join(target,targfile)
         print "DNG export to",repr(target),"started"
-        self.tileCompressor = threading.Thread(target=self.tileCompress)
-        self.tileCompressor.daemon = True
-        self.tileCompressor.start()
         self.writer = threading.Thread(target=self.dngWriter)
         self.writer.daemon = True
         self.writer.start()
         self.writtenFrame = 0
-        r.preloadFrame(startFrame)
-        r.preloadFrame(startFrame+1) # Preload one ahead
+        depth = r.preloadDepth()
+        for ahead in range(min(depth,endFrame-startFrame+1)):
+            r.preloadFrame(startFrame+ahead) # Keep the preloaders busy
         ljpeg = True
         if bits == 14: jpeg = False
+        tiles = self.dngTileGrid(r.width(),r.height()) # Same for every frame
         wavneeded = False
         if wavfile != None:
             if os.path.exists(wavfile):
@@ -495,10 +520,10 @@ class ExportQueue(threading.Thread):
                 outwavname = os.path.join(dngdir, rhead + ".WAV")
                 self.tempEncoderWav(wavfile,fps,outwavname,startFrame,endFrame,audioOffset,date,r.bodySerialNumber())
                 wavmade = True
-            self.setDngHeader(r,d,bits,f,rgbl,ljpeg,date)
+            self.setDngHeader(r,d,bits,f,rgbl,ljpeg,date,tiles)
             ifd = d.FULL_IFD
-            if ((startFrame+i+1)<r.frames()):
-                r.preloadFrame(startFrame+i+1)
+            if ((startFrame+i+depth)<=endFrame):
+                r.preloadFrame(startFrame+i+depth)
             while self.writtenFrame<(i-10):
                 # Give writing thread time to write...
                 if self.endflag or self.cancel:
@@ -513,7 +538,7 @@ class ExportQueue(threading.Thread):
                     d.rawdata = np.frombuffer(f.rawdata,dtype=np.uint16).byteswap().tostring()
                 elif bits==16:
                     f.convert() # Will block if still processing
-                    d.rawdata = np.frombuffer(f.rawimage,dtype=np.uint16).tostring()
+                    d.rawdata = buffer(f.rawimage) # Keeps the frame buffer until written
                 self.wq.put((i,target,d)) # Queue writing
             st = float(self.writtenFrame+1)/float(todo)
             #print "%.02f%%"%(st*100.0)
@@ -538,19 +563,6 @@ class ExportQueue(threading.Thread):
         print "DNG export to",repr(target),"finished"
         r.close()
 
-    def tileCompress(self):
-        tilejob = self.tc.get()
-        while tilejob != None:
-            try:
-                rawdata,w,l = tilejob
-                self.nextCompressedTile = bitunpack.pack16tolj(rawdata,w,l/2,16,w,w/2,w/2,"")
-                self.tc.task_done()
-            except:
-                import traceback
-                traceback.print_exc()
-                self.nextCompressedTile = None
-            tilejob = self.tc.get()
-
     def dngWriter(self):
         nextbuf = self.wq.get()
         while nextbuf != None:
@@ -558,15 +570,8 @@ class ExportQueue(threading.Thread):
                 index,target,dng = nextbuf
                 ifd = dng.FULL_IFD
                 if dng.ljpeg:
-                    self.tc.put((dng.rawdata,ifd.width,ifd.length))
-                    tile1 = bitunpack.pack16tolj(dng.rawdata,ifd.width,ifd.length/2,16,0,ifd.width/2,ifd.width/2,"")
-                    #tile2 = bitunpack.pack16tolj(dng.rawdata,ifd.width,ifd.length/2,16,ifd.width,ifd.width/2,ifd.width/2,"")
-                    self.tc.join() # Wait for it to be done
-                    tile2 = self.nextCompressedTile
-                    ifd._tiles = [
-                        tile1,
-                        tile2
-                        ]
+                    # All the tiles of a frame are compressed at once on the unpack workers
+                    ifd._tiles = MlRaw.UnpackThreads.packLJ(dng.rawdata,ifd.width,ifd.length,ifd.TileWidth,ifd.TileLength)
                 else:
                     ifd._strips = [ dng.rawdata ]
                 dng.writeFile(target+"_%06d.dng"%index)
@@ -649,6 +654,7 @@ class ExportQueue(threading.Thread):
         print extension,"export to",repr(movfile),"started"
         tempwavname = None
         r = MlRaw.loadRAWorMLV(filename)
+        r.conversionPriority = MlRaw.ConversionPool.EXPORT # Viewer frames go first
         if endFrame == None:
             endFrame = r.frames()-1
         todo = endFrame-startFrame+1
@@ -677,17 +683,9 @@ class ExportQueue(threading.Thread):
                 self.tempEncoderWav(wavfile,fps,tempwavname,startFrame,endFrame,audioOffset)
         fw = r.width()
         fh = r.height()
-        aa = r.activeArea
-        tlx,tly = aa[1],aa[0]
-        aw = aa[3]-aa[1]
-        ah = aa[2]-aa[0]
-        if aw>=fw:
-            aw = fw
-            tlx = 0
-        if ah>=fh:
-            ah = fh
-            tly = 0
-        area = (tlx,tly,aw,ah)
+        area = r.activeWindow()
+        if preprocess==self.PREPROCESS_NONE:
+            r.decodeWindow = area # Only the active area is encoded
         if subprocess.mswindows:
             exe = "ffmpeg.exe"
         else:
@@ -742,8 +740,9 @@ class ExportQueue(threading.Thread):
         self.demosaicThread.daemon = True
         self.demosaicThread.start()
         self.writtenFrame = 0
-        r.preloadFrame(startFrame)
-        r.preloadFrame(startFrame+1) # Preload one ahead
+        depth = r.preloadDepth()
+        for ahead in range(min(depth,endFrame-startFrame+1)):
+            r.preloadFrame(startFrame+ahead) # Keep the preloaders busy
         print "Processing", endFrame, "frames, it may take a while."
         for i in range(endFrame-startFrame+1):
             self.processCommands(block=False)
@@ -751,8 +750,8 @@ class ExportQueue(threading.Thread):
             f.lut = lut
             f.lut1d1 = lut1d1
             f.lut1d2 = lut1d2
-            if ((startFrame+i+1)<r.frames()):
-                r.preloadFrame(startFrame+i+1)
+            if ((startFrame+i+depth)<=endFrame):
+                r.preloadFrame(startFrame+i+depth)
             # Queue job
             if preprocess==self.PREPROCESS_ALL:
                 # Must first preprocess with shader
@@ -841,18 +840,48 @@ class ExportQueue(threading.Thread):
         #print "WRITER FINISHED!"
 
     def demosaicThreadFunction(self):
+        # Several frames are demosaiced at once, each spread over all cores,
+        # so the cores are not left idle on the last tiles of each frame.
+        # Finished frames are still passed on in the order they came
+        jobq = Queue.Queue()
+        def demosaicWorker():
+            job = jobq.get()
+            while job != None:
+                buf,doneq = job
+                try:
+                    buf[0].demosaic()
+                    doneq.put(True)
+                except:
+                    import traceback
+                    traceback.print_exc()
+                    doneq.put(False)
+                job = jobq.get()
+        inflight = MlRaw.DemosaicThread.FramesInFlight
+        for i in range(inflight):
+            worker = threading.Thread(target=demosaicWorker)
+            worker.daemon = True
+            worker.start()
+        pending = collections.deque()
+        def passOldest():
+            buf,doneq = pending.popleft()
+            if doneq.get():
+                self.bgiq.put(buf)
+            else:
+                self.cancel = True
         nextbuf = self.dq.get()
         while nextbuf != None:
-            try:
-                #self.dq.put((f,r.width(),r.height(),rgbl,tm,matrix))
-                nextbuf[0].demosaic()
-                self.bgiq.put(nextbuf)
-            except:
-                import traceback
-                traceback.print_exc()
-                self.cancel = True
+            #self.dq.put((f,r.width(),r.height(),rgbl,tm,matrix))
+            doneq = Queue.Queue(1)
+            pending.append((nextbuf,doneq))
+            jobq.put((nextbuf,doneq))
+            if len(pending)>=inflight:
+                passOldest()
             self.dq.task_done()
             nextbuf = self.dq.get()
+        while len(pending)>0:
+            passOldest()
+        for i in range(inflight):
+            jobq.put(None)
         self.bgiq.put(None)
         self.bgiq.join()
         self.dq.task_done()
@@ -912,7 +941,8 @@ class ExportQueue(threading.Thread):
         if jobtype==0:
             frame,index,jobtype,w,h,rgbl,tm,matrix,preprocess,area = args
             # Shader part of demosaicing
-            self.rgbUploadTex.update(frame.rgbimage)
+            data,yoff,rows = frame.decodedImage(frame.rgbimage,3)
+            self.rgbUploadTex.update(data,0,yoff,w,rows)
             self.rgbImage.bindfbo()
             self.svbo.bind()
             self.shaderQuality.prepare(self.svbo)
@@ -0,0 +1,110 @@
+"""
+FrameCache.py, part of MlRawViewer
+(c) Andrew Baldwin 2014
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# standard python imports
+import time,heapq
+
+import numpy as np
+
+DEFAULT_BUDGET = 1024*1024*1024 # Bytes of frames to keep
+PIN_RADIUS = 2 # Frames either side of the playhead which are never dropped
+DISTANCE_COST = 0.02 # Seconds of recency a frame of distance from the playhead is worth
+
+def dataBytes(data):
+    """
+    Memory owned by a piece of frame data. Buffers onto mapped files
+    are not counted as they are backed by the file cache
+    """
+    if data is None:
+        return 0
+    if isinstance(data,np.ndarray):
+        return data.nbytes
+    if isinstance(data,(str,bytearray)):
+        return len(data)
+    if isinstance(data,tuple): # LJ92 tiles
+        return sum([dataBytes(d) for d in data])
+    if isinstance(data,list):
+        return sum([dataBytes(d) for d in data])
+    return 0
+
+def frameBytes(frame):
+    """
+    Memory held by a loaded (and possibly converted) frame
+    """
+    if frame is None:
+        return 0
+    total = 0
+    for data in (frame.rawdata,frame.rawimage,frame.rgbimage):
+        total += dataBytes(data)
+    return total
+
+class FrameCache(object):
+    """
+    Loaded frames by index, limited by the memory they use rather than
+    by count. When over budget, frames are dropped by how long ago they
+    were last used and how far they are from the playhead. Frames at
+    pinned indexes (marks, the frame being shown) and close to the
+    playhead are kept
+    """
+    def __init__(self,budget=DEFAULT_BUDGET):
+        self.budget = budget
+        self.frames = {}
+        self.lastUse = {}
+    def __contains__(self,index):
+        return index in self.frames
+    def __getitem__(self,index):
+        self.lastUse[index] = time.time()
+        return self.frames[index]
+    def __setitem__(self,index,frame):
+        self.frames[index] = frame
+        self.lastUse[index] = time.time()
+    def __delitem__(self,index):
+        del self.frames[index]
+        del self.lastUse[index]
+    def __iter__(self):
+        return iter(self.frames)
+    def __len__(self):
+        return len(self.frames)
+    def keys(self):
+        return self.frames.keys()
+    def clear(self):
+        self.frames = {}
+        self.lastUse = {}
+    def bytesUsed(self):
+        return sum([frameBytes(f) for f in self.frames.itervalues()])
+    def trim(self,playhead,pinned=()):
+        """
+        Drop frames until within budget
+        """
+        sizes = dict([(i,frameBytes(f)) for i,f in self.frames.iteritems()])
+        used = sum(sizes.itervalues())
+        if used <= self.budget:
+            return
+        keep = set(pinned)
+        keep.update(range(playhead-PIN_RADIUS,playhead+PIN_RADIUS+1))
+        candidates = [(self.lastUse[i]-DISTANCE_COST*abs(i-playhead),i) for i in self.frames if i not in keep]
+        heapq.heapify(candidates)
+        while used > self.budget and len(candidates)>0:
+            score,index = heapq.heappop(candidates)
+            used -= sizes[index]
+            del self[index]
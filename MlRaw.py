@@ -22,7 +22,7 @@ SOFTWARE.
 """
 
 # standard python imports
-import sys,struct,os,math,time,threading,Queue,traceback,wave,multiprocessing,mutex,cPickle
+import sys,struct,os,math,time,threading,Queue,traceback,wave,multiprocessing,cPickle
 
 # MlRawViewer imports
 import DNG
@@ -46,7 +46,7 @@ try:
     numpy in case it hasn't been compiled
     """
     import bitunpack
-    if ("__version__" not in dir(bitunpack)) or bitunpack.__version__!="3.0":
+    if ("__version__" not in dir(bitunpack)) or bitunpack.__version__!="3.11":
         print """
 
 !!! Wrong version of bitunpack found !!!
@@ -62,8 +62,221 @@ except:
 """
     raise
 
-class SerialiseCPUDemosaic(object):
-    class DemosaicWorker(threading.Thread):
+import MlvIndex
+import FrameCache
+
+class DemosaicerPool(object):
+    """
+    Demosaicers kept by resolution, so that frames of different sizes,
+    or several frames at once, neither wait for one demosaicer nor keep
+    reallocating its buffers. The memory of all demosaicers together is
+    capped. Idle ones are freed oldest first to make room, and callers
+    wait while the ones in use already fill the cap
+    """
+    DefaultCap = 1024*1024*1024 # Bytes
+    def __init__(self,cap=DefaultCap):
+        self.cap = cap
+        self.cond = threading.Condition()
+        self.idle = [] # ((width,height),demosaicer), least recently used first
+        self.used = 0 # Bytes held by idle and in use demosaicers
+        self.inUse = 0
+        self.created = 0
+        self.freed = 0
+    @staticmethod
+    def size(width,height):
+        return width*height*4*4 # Float raw, red, green and blue planes
+    def acquire(self,width,height):
+        need = self.size(width,height)
+        self.cond.acquire()
+        try:
+            while 1:
+                for i in range(len(self.idle)-1,-1,-1):
+                    if self.idle[i][0] == (width,height):
+                        self.inUse += 1
+                        return self.idle.pop(i)[1]
+                while len(self.idle)>0 and self.used+need>self.cap:
+                    (w,h),demosaicer = self.idle.pop(0)
+                    self.used -= self.size(w,h)
+                    self.freed += 1
+                if self.used+need<=self.cap or self.inUse==0:
+                    break
+                self.cond.wait()
+            self.used += need
+            self.inUse += 1
+            self.created += 1
+        finally:
+            self.cond.release()
+        return bitunpack.demosaicer(width,height)
+    def release(self,demosaicer,width,height):
+        self.cond.acquire()
+        self.idle.append(((width,height),demosaicer))
+        self.inUse -= 1
+        self.cond.notifyAll()
+        self.cond.release()
+
+class CPUDemosaic(object):
+    """
+    AMaZE demosaicing on all cores. Each frame is cut into tiles which
+    are shared out between native threads in bitunpack, with idle
+    threads stealing work from busy ones. Several frames can be
+    demosaiced at the same time, each with its own demosaicer
+    """
+    FramesInFlight = max(2,multiprocessing.cpu_count()/8) # For callers with a stream of frames
+    TilesPerThread = 4 # So uneven tiles still share out evenly
+    MinTiles = 4 # So windowed demosaicing can skip some
+    MinTileSide = 192 # Smaller tiles cost more than they balance, for AMaZE's 16 pixel borders
+    # Qualities, best first. The others are bitunpack.demosaicfast methods
+    AMAZE = 0
+    BILINEAR = 1
+    NEAREST = 2
+    SUPERPIXEL = 3 # One pixel per Bayer quad, so half size
+    Qualities = ("amaze","bilinear","nearest","superpixel")
+
+    def __init__(self,threads=None):
+        if threads == None:
+            threads = multiprocessing.cpu_count()
+        self.threads = threads
+        self.demosaicers = DemosaicerPool()
+
+    def grid(self,width,height,threads=None):
+        """
+        Columns and rows to cut a frame into. Only depends on the frame
+        size and thread count, never on a window, so results inside a
+        window do not change
+        """
+        if threads == None:
+            threads = self.threads
+        tiles = max(self.MinTiles,threads*self.TilesPerThread)
+        side = max(float(self.MinTileSide),math.sqrt(float(width*height)/tiles))
+        cols = max(1,int(round(width/side)))
+        rows = max(1,int(round(height/side)))
+        return cols,rows
+
+    def tiles(self,width,height,window=None,threads=None):
+        """
+        (x,y,w,h) tiles covering the frame, or only those touching the
+        window (x,y,w,h) when there is one
+        """
+        cols,rows = self.grid(width,height,threads)
+        # Near equal tiles, starting on even rows and columns which are multiples of 4
+        xs = [(i*width/cols)&~3 for i in range(cols)]+[width]
+        ys = [(i*height/rows)&~1 for i in range(rows)]+[height]
+        tiles = []
+        for y,ye in zip(ys[:-1],ys[1:]):
+            for x,xe in zip(xs[:-1],xs[1:]):
+                if window != None:
+                    wx,wy,ww,wh = window
+                    if x>=wx+ww or xe<=wx or y>=wy+wh or ye<=wy:
+                        continue
+                tiles.append((x,y,xe-x,ye-y))
+        return tiles
+
+    def outputSize(self,width,height,quality=AMAZE):
+        if quality == self.SUPERPIXEL:
+            return width/2,height/2
+        return width,height
+
+    def doDemosaic(self,demosaicer,width,height,cfa,window=None,threads=None,quality=AMAZE):
+        if threads == None:
+            threads = self.threads
+        if quality == self.AMAZE:
+            tiles = self.tiles(width,height,window,threads)
+            bitunpack.demosaictiles(demosaicer,tiles,cfa,threads)
+            return
+        # The fast ones only look at neighbouring pixels, so just do the window rows
+        first,rows = 0,-1
+        if window != None:
+            ow,oh = self.outputSize(width,height,quality)
+            scale = height/oh
+            wx,wy,ww,wh = window
+            first = min(oh,max(0,wy/scale))
+            rows = max(0,min(oh,(wy+wh+scale-1)/scale)-first)
+        bitunpack.demosaicfast(demosaicer,quality,cfa,threads,first,rows)
+
+    def demosaicbits(self,rawdata,width,height,black,bits,byteSwap=0,cfa=0,window=None,dtype=np.float32,scale=1.0,quality=AMAZE):
+        """
+        Interleaved RGB of values above black as float32, uint16
+        (rounded and clamped) or float16, multiplied by scale.
+        Size is given by outputSize for the quality
+        """
+        demosaicer = self.demosaicers.acquire(width,height)
+        try:
+            bitunpack.predemosaicbits(demosaicer,rawdata,width,height,black,bits,byteSwap)
+            self.doDemosaic(demosaicer,width,height,cfa,window,quality=quality)
+            result = bitunpack.postdemosaic(demosaicer,np.dtype(dtype).char,scale)
+        finally:
+            self.demosaicers.release(demosaicer,width,height)
+        return np.frombuffer(result,dtype=dtype)
+
+    def demosaic12(self,rawdata,width,height,black,byteSwap=0,cfa=0):
+        # 12bit data is always a big endian byte stream
+        return self.demosaicbits(rawdata,width,height,black,12,1,cfa)
+
+    def demosaic14(self,rawdata,width,height,black,byteSwap=0,cfa=0):
+        return self.demosaicbits(rawdata,width,height,black,14,byteSwap,cfa)
+
+    def demosaic16(self,rawdata,width,height,black,byteSwap=0,cfa=0,window=None,dtype=np.float32,scale=1.0,quality=AMAZE):
+        return self.demosaicbits(rawdata,width,height,black,16,byteSwap,cfa,window,dtype,scale,quality)
+
+DemosaicThread = CPUDemosaic()
+
+class FrameStats(object):
+    """
+    Per channel levels of a frame, measured while it is unpacked.
+    Channels are in R,G1,G2,B order. Histogram bins are spread evenly
+    from black to white, with clipped values in the last bin
+    """
+    Channels = ("R","G1","G2","B")
+    def __init__(self,black,white,subtracted=False):
+        self.black = black
+        self.white = white
+        self.subtracted = subtracted
+        self.min = [0xFFFF]*4
+        self.max = [0]*4
+        self.sum = [0]*4
+        self.count = [0]*4
+        self.clipped = [0]*4
+        self.histogram = None
+    def add(self,part):
+        mins,maxs,sums,counts,clipped,hist = part
+        for c in range(4):
+            self.min[c] = min(self.min[c],mins[c])
+            self.max[c] = max(self.max[c],maxs[c])
+            self.sum[c] += sums[c]
+            self.count[c] += counts[c]
+            self.clipped[c] += clipped[c]
+        hist = np.frombuffer(hist,dtype=np.uint32).reshape((4,-1))
+        if self.histogram is None:
+            self.histogram = hist.copy()
+        else:
+            self.histogram += hist
+    def mean(self,channel):
+        """
+        Mean level above black
+        """
+        if self.count[channel]==0:
+            return 0.0
+        mean = float(self.sum[channel])/self.count[channel]
+        if not self.subtracted:
+            mean -= self.black
+        return max(0.0,mean)
+    def exposure(self,channel=1):
+        """
+        Mean level as a fraction of the range from black to white
+        """
+        return self.mean(channel)/max(1,self.white-self.black)
+    def clippedFraction(self,channel=None):
+        if channel==None:
+            return float(sum(self.clipped))/max(1,sum(self.count))
+        return float(self.clipped[channel])/max(1,self.count[channel])
+
+class ParallelUnpack(object):
+    """
+    Unpack one frame on all cores. The frame is split into ranges which
+    worker threads unpack with the GIL released
+    """
+    MinimumPiece = 256*1024 # Pixels. Smaller frames are not worth splitting
+    class UnpackWorker(threading.Thread):
         def __init__(self,jobq):
             threading.Thread.__init__(self)
             self.daemon = True
@@ -71,146 +284,243 @@ class SerialiseCPUDemosaic(object):
             self.start()
         def run(self):
             while True:
-                job = self.jobq.get()
-                bitunpack.demosaic(*job)
-                self.jobq.task_done()
+                func,index,job,doneq = self.jobq.get()
+                try:
+                    doneq.put((index,None,func(*job)))
+                except Exception,err:
+                    doneq.put((index,err,None))
 
-    def __init__(self):
-        self.mutex = mutex.mutex()
-        self.serq = Queue.Queue(1) # Using as Mutex
+    def __init__(self,threads=None):
         self.jobq = Queue.Queue()
-        pool = [self.DemosaicWorker(self.jobq) for i in range(multiprocessing.cpu_count())]
-        self.demosaicer = None
-        self.dw = 0
-        self.dh = 0
-    def getdemosaicer(self,width,height):
-        if self.serq.empty():
-            raise # Cannot call this if you don't hold the mutex
-        if self.demosaicer != None:
-            if width==self.dw and height==self.dh:
-                return self.demosaicer
-            else:
-                del self.demosaicer # Wrong size
-                self.demosaicer = None
-        self.demosaicer = bitunpack.demosaicer(width,height)
-        self.dw = width
-        self.dh = height
-        return self.demosaicer
-
-    def doDemosaic(self,demosaicer,width,height,cfa):
-        # Submit 16 jobs to be spread amongst available threads
-        bw = (width/4)
-        bw = bw + (4-bw%4) # Round up
-        bh = height/4
-        bh = bh + (bh%2) # Round up
-        for y in range(4):
-            for x in range(4):
-                aw = bw
-                ah = bh
-                re = (x+1)*bw
-                if re>=width:
-                    aw -= (re-width)
-                be = (y+1)*bh
-                if be>=height:
-                    ah -= (be-height)
-                #print x*bw,y*bh,x*bw+aw,y*bh+ah,width,height,aw,ah,re,be
-                self.jobq.put((demosaicer,x*bw,y*bh,aw,ah,cfa))
-        self.jobq.join()
+        if threads == None:
+            threads = multiprocessing.cpu_count()
+        self.threads = threads
+        pool = [self.UnpackWorker(self.jobq) for i in range(self.threads)]
+    def ranges(self,elements,first=0):
+        """
+        Split elements values starting at first into ranges for the workers
+        """
+        end = first+elements
+        first &= ~7 # Ranges must start on 8 pixel groups
+        elements = end-first
+        pieces = max(1,min(self.threads,elements/self.MinimumPiece))
+        step = ((elements+pieces-1)/pieces+7)&~7
+        return [(start,min(step,end-start)) for start in range(first,end,step)]
+    def run(self,func,jobs):
+        """
+        Call func for each job, spread over the workers. Returns the
+        results in the order of the jobs, whatever order they finish in
+        """
+        if len(jobs)<=1:
+            return [func(*job) for job in jobs]
+        doneq = Queue.Queue()
+        for index,job in enumerate(jobs):
+            self.jobq.put((func,index,job,doneq))
+        done = sorted([doneq.get() for job in jobs])
+        for index,err,result in done:
+            if err != None:
+                raise err
+        return [result for index,err,result in done]
+    def unpack(self,rawdata,elements,bits,byteSwap=0,output=None):
+        if output is None:
+            output = np.frombuffer(FrameBuffers.get(elements*2),dtype=np.uint16)
+        self.run(bitunpack.unpackrange,[(rawdata,bits,byteSwap,output,start,count) for start,count in self.ranges(elements)])
+        return output
+    def unpackStats(self,rawdata,width,height,bits,byteSwap,black,white,cfa=0,subtract=False,linearization="",output=None,rows=None):
+        """
+        Unpack and measure the levels in the same pass. bits can be 16
+        for data which is already unpacked. Optionally the values are
+        linearized and have black subtracted. rows (first,count) limits
+        the work to those rows, leaving the rest of output untouched.
+        Returns output,FrameStats
+        """
+        elements = width*height
+        if output is None:
+            output = np.frombuffer(FrameBuffers.get(elements*2),dtype=np.uint16)
+        firstRow,rowCount = rows or (0,height)
+        ranges = self.ranges(rowCount*width,firstRow*width)
+        jobs = [(rawdata,bits,byteSwap,output,start,count,width,int(black),int(white),cfa,int(subtract),linearization) for start,count in ranges]
+        stats = FrameStats(black,white,subtract)
+        for part in self.run(bitunpack.unpackstats,jobs):
+            stats.add(part)
+        return output,stats
+    def unpackLJ(self,tiles,width,height,tileWidth,tileLength,linearization="",output=None):
+        """
+        Decode a frame of LJ92 tiles, in rows of tiles across the frame,
+        with the tiles spread over native threads. Returns output and
+        the LJ92 status of each tile, which is 0 when it decoded
+        """
+        if output is None:
+            output = np.frombuffer(FrameBuffers.get(width*height*2),dtype=np.uint16)
+        status = bitunpack.unpackljtiles(tiles,output,width,height,tileWidth,tileLength,linearization,min(self.threads,len(tiles)))
+        return output,status
+    def packLJ(self,rawdata,width,height,tileWidth,tileLength,delinearization=""):
+        """
+        Compress a 16bit frame as LJ92 tiles, in rows across the frame,
+        with the tiles spread over the workers. Returns the tiles
+        """
+        return self.run(bitunpack.pack16tolj,self.packLJJobs(rawdata,width,height,tileWidth,tileLength,delinearization))
+    def packLJJobs(self,rawdata,width,height,tileWidth,tileLength,delinearization=""):
+        """
+        pack16tolj arguments for each tile of a frame. Edge tiles are
+        padded by repeating the last row and column. tileLength must be
+        even, as each LJ92 row holds two rows of the tile
+        """
+        across = (width+tileWidth-1)/tileWidth
+        down = (height+tileLength-1)/tileLength
+        if across*tileWidth!=width or down*tileLength!=height:
+            frame = np.frombuffer(rawdata,dtype=np.uint16)[:width*height].reshape(height,width)
+            rawdata = np.pad(frame,((0,down*tileLength-height),(0,across*tileWidth-width)),mode='edge').tostring()
+            width = across*tileWidth
+        return [(rawdata,tileWidth*2,tileLength/2,16,(ty*tileLength*width+tx*tileWidth)*2,tileWidth,width-tileWidth,delinearization) for ty in range(down) for tx in range(across)]
+    def reduced(self,rawdata,width,height,bits,byteSwap,factor,black,cfa=0):
+        """
+        Linear RGB image at 1/factor size (2, 4 or 8) with black
+        subtracted, made straight from the Bayer data. Only the rows
+        sampled are unpacked. Returns a (height/factor,width/factor,3)
+        uint16 array
+        """
+        ow,oh = width/factor,height/factor
+        output = np.empty((oh,ow,3),dtype=np.uint16)
+        pieces = max(1,min(self.threads,(width*oh*2)/self.MinimumPiece))
+        step = max(1,(oh+pieces-1)/pieces)
+        jobs = [(rawdata,bits,byteSwap,width,height,factor,int(black),cfa,output,first,min(step,oh-first)) for first in range(0,oh,step)]
+        self.run(bitunpack.unpackreduced,jobs)
+        return output
 
-    def demosaic12(self,rawdata,width,height,black,byteSwap=0,cfa=0):
-        self.serq.put(True) # Let us run
-        demosaicer = self.getdemosaicer(width,height)
-        bitunpack.predemosaic12(demosaicer,rawdata,width,height,black,byteSwap)
-        self.doDemosaic(demosaicer,width,height,cfa)
-        result = bitunpack.postdemosaic(demosaicer)
-        self.serq.get() # Let someone else work
-        return np.frombuffer(result,dtype=np.float32)
+UnpackThreads = ParallelUnpack()
 
-    def demosaic14(self,rawdata,width,height,black,byteSwap=0,cfa=0):
-        self.serq.put(True) # Let us run
-        demosaicer = self.getdemosaicer(width,height)
-        bitunpack.predemosaic14(demosaicer,rawdata,width,height,black,byteSwap)
-        self.doDemosaic(demosaicer,width,height,cfa)
-        result = bitunpack.postdemosaic(demosaicer)
-        self.serq.get() # Let someone else work
-        return np.frombuffer(result,dtype=np.float32)
-
-    def demosaic16(self,rawdata,width,height,black,byteSwap=0,cfa=0):
-        self.serq.put(True) # Let us run
-        demosaicer = self.getdemosaicer(width,height)
-        bitunpack.predemosaic16(demosaicer,rawdata,width,height,black,byteSwap)
-        self.doDemosaic(demosaicer,width,height,cfa)
-        result = bitunpack.postdemosaic(demosaicer)
-        self.serq.get() # Let someone else work
-        return np.frombuffer(result,dtype=np.float32)
-
-DemosaicThread = SerialiseCPUDemosaic()
-
-def testdemosaicer():
-    d = bitunpack.demosaicer(128,128)
-    del d
-    d1 = bitunpack.demosaicer(3000,2000)
-    d2 = bitunpack.demosaicer(1024,1024)
-    del d2
-    del d1
-    d3 = bitunpack.demosaicer(1024,768)
-    buf = (np.arange(1024*768,dtype=np.uint32)%256).astype(np.uint8)
-    len14 = 1024*768*14/8
-    len16 = 1024*768*2
-    bitunpack.predemosaic14(d3,buf[:len14],1024,768,2000,0)
-    bitunpack.predemosaic16(d3,buf[:len16],1024,768,2000,0)
-    dembuf = DemosaicThread.demosaic14(buf[:len14],1024,768,2000,0)
-    #print buf,dembuf.shape,dembuf.reshape((1024,768,3))[:,300]
-
-#testdemosaicer()
-#print "test demosaicer done"
-
-def unpacks12np16(rawdata,width,height,byteSwap=0):
-    tounpack = (width*height*3)/2
-    unpacked,stats = bitunpack.unpack12to16(rawdata[:tounpack],byteSwap)
-    return np.frombuffer(unpacked,dtype=np.uint16),stats
-
-def unpacks14np16(rawdata,width,height,byteSwap=0):
-    tounpack = width*height*14/8
-    unpacked,stats = bitunpack.unpack14to16(rawdata[:tounpack],byteSwap)
-    return np.frombuffer(unpacked,dtype=np.uint16),stats
+# Unpacked frames are written into buffers from here. A buffer is used
+# again once the frame using it has been dropped
+FrameBuffers = MlvIndex.BufferPool(keep=16)
+
+def unpacksnp16(rawdata,width,height,bits,byteSwap=0,black=None,white=None,cfa=0,rows=None):
+    """
+    Unpack a 10, 12 or 14bit Bayer frame to 16bit, measuring levels
+    on the way if black is given. Packing is the Canon one of MSB first
+    bits in little endian 16bit words, or big endian words with byteSwap
+    """
+    tounpack = (width*height*bits+7)/8
+    if black != None:
+        return UnpackThreads.unpackStats(buffer(rawdata,0,tounpack),width,height,bits,byteSwap,black,white,cfa,rows=rows)
+    unpacked = UnpackThreads.unpack(buffer(rawdata,0,tounpack),width*height,bits,byteSwap)
+    return unpacked,None
+
+def unpacks12np16(rawdata,width,height,byteSwap=0,black=None,white=None,cfa=0):
+    # 12bit DNG data is always a big endian byte stream
+    return unpacksnp16(rawdata,width,height,12,1,black,white,cfa)
+
+def unpacks14np16(rawdata,width,height,byteSwap=0,black=None,white=None,cfa=0):
+    return unpacksnp16(rawdata,width,height,14,byteSwap,black,white,cfa)
+
+def demosaicbits(rawdata,width,height,black,bits,byteSwap=0,cfa=0,window=None,dtype=np.float32,scale=1.0,quality=CPUDemosaic.AMAZE):
+    return DemosaicThread.demosaicbits(rawdata,width,height,black,bits,byteSwap,cfa,window,dtype,scale,quality)
 
 def demosaic12(rawdata,width,height,black,byteSwap=0,cfa=0):
-    raw = DemosaicThread.demosaic12(rawdata,width,height,black,byteSwap,cfa)
-    return np.frombuffer(raw,dtype=np.float32)
+    return DemosaicThread.demosaic12(rawdata,width,height,black,byteSwap,cfa)
 
 def demosaic14(rawdata,width,height,black,byteSwap=0,cfa=0):
-    raw = DemosaicThread.demosaic14(rawdata,width,height,black,byteSwap,cfa)
-    return np.frombuffer(raw,dtype=np.float32)
-
-def demosaic16(rawdata,width,height,black,byteSwap=0,cfa=0):
-    raw = DemosaicThread.demosaic16(rawdata,width,height,black,byteSwap,cfa)
-    return np.frombuffer(raw,dtype=np.float32)
-
-class FrameConverter(threading.Thread):
-    def __init__(self):
-        threading.Thread.__init__(self)
-        self.daemon = True
-        self.iq = Queue.Queue()
-        self.start()
-    def process(self,frame):
-        self.iq.put(frame)
-    def run(self):
-        while 1:
-            nextFrame = self.iq.get()
-            PLOG(PLOG_CPU,"Threaded convert for frame starts")
-            try:
-                res = nextFrame._convert()
+    return DemosaicThread.demosaic14(rawdata,width,height,black,byteSwap,cfa)
+
+def demosaic16(rawdata,width,height,black,byteSwap=0,cfa=0,window=None,dtype=np.float32,scale=1.0,quality=CPUDemosaic.AMAZE):
+    return DemosaicThread.demosaic16(rawdata,width,height,black,byteSwap,cfa,window,dtype,scale,quality)
+
+class ConversionPool(object):
+    """
+    Workers converting frames to 16bit, taking the most urgent frame
+    first. Frames being watched go ahead of export frames, which go
+    ahead of thumbnails. Counts queue depth, time spent waiting and time
+    spent converting for each priority
+    """
+    INTERACTIVE = 0
+    EXPORT = 1
+    THUMBNAIL = 2
+    Priorities = ("interactive","export","thumbnail")
+    class ConvertWorker(threading.Thread):
+        def __init__(self,pool):
+            threading.Thread.__init__(self)
+            self.daemon = True
+            self.pool = pool
+            self.start()
+        def run(self):
+            while 1:
+                priority,order,queued,nextFrame = self.pool.iq.get()
+                self.pool.started(priority,queued)
+                PLOG(PLOG_CPU,"Threaded convert for frame starts")
+                before = time.time()
+                try:
+                    res = nextFrame._convert()
+                    PLOG(PLOG_CPU,"Threaded convert for frame complete")
+                except:
+                    import traceback
+                    traceback.print_exc()
+                    res = None
+                self.pool.finished(priority,time.time()-before)
                 nextFrame.convertQ.put(res)
-                PLOG(PLOG_CPU,"Threaded convert for frame complete")
-            except:
-                import traceback
-                traceback.print_exc()
-                nextFrame.convertQ.put(None)
 
-FrameConverterThread = FrameConverter()
+    def __init__(self,threads=None):
+        if threads == None:
+            # Each conversion is already split over the unpack threads.
+            # More than one worker lets urgent frames start while
+            # background ones are still being converted
+            threads = min(4,max(2,multiprocessing.cpu_count()))
+        self.threads = threads
+        self.iq = Queue.PriorityQueue()
+        self.lock = threading.Lock()
+        self.order = 0 # Keeps frames of the same priority first in, first out
+        levels = len(self.Priorities)
+        self.depth = [0]*levels
+        self.converted = [0]*levels
+        self.waited = [0.0]*levels
+        self.maxWaited = [0.0]*levels
+        self.converting = [0.0]*levels
+        self.pool = [self.ConvertWorker(self) for i in range(threads)]
+    def process(self,frame,priority=INTERACTIVE):
+        self.lock.acquire()
+        self.order += 1
+        order = self.order
+        self.depth[priority] += 1
+        self.lock.release()
+        self.iq.put((priority,order,time.time(),frame))
+    def started(self,priority,queued):
+        waited = time.time()-queued
+        self.lock.acquire()
+        self.depth[priority] -= 1
+        self.waited[priority] += waited
+        self.maxWaited[priority] = max(self.maxWaited[priority],waited)
+        self.lock.release()
+    def finished(self,priority,elapsed):
+        self.lock.acquire()
+        self.converted[priority] += 1
+        self.converting[priority] += elapsed
+        self.lock.release()
+    def queueDepth(self,priority=None):
+        if priority == None:
+            return sum(self.depth)
+        return self.depth[priority]
+    def stats(self):
+        """
+        Counters for each priority by name. Times are in seconds
+        """
+        self.lock.acquire()
+        result = {}
+        for p,name in enumerate(self.Priorities):
+            done = self.converted[p]
+            result[name] = {
+                "depth":self.depth[p],
+                "converted":done,
+                "meanWait":self.waited[p]/done if done else 0.0,
+                "maxWait":self.maxWaited[p],
+                "meanConvert":self.converting[p]/done if done else 0.0,
+            }
+        self.lock.release()
+        return result
+
+FrameConverters = ConversionPool()
 
 class Frame:
+    WindowMargin = 32 # Rows decoded beyond the window. Demosaicing looks up to 16 rows away
+    RgbDtype = np.uint16 # CPU demosaiced counts above black, as uploaded to the 16bit RGB textures
     def __init__(self,rawfile,rawdata,width,height,black,white,byteSwap=0,bitsPerSample=14,bayer=True,rgb=False,convert=True,rtc=None,lens=None,expo=None,wbal=None,ljpeg=False,linearization="",cfa=0):
         #print "opening frame",len(rawdata),width,height
         #print width*height
@@ -235,18 +545,24 @@ class Frame:
         self.rawwbal = (1.0,1.0,1.0)
         self.convertQ = Queue.Queue(1)
         self.cfa = cfa
+        self.framestats = None # FrameStats once converted
+        self.window = False # Not yet known, see decodeWindow
         if bayer==False and rgb==True:
             self.rgbimage = rawdata
         else:
             self.rgbimage = None
+        self.rgbquality = None # CPUDemosaic quality of rgbimage, or None when it came as RGB
         if convert:
             self.convertQueued = True
-            FrameConverterThread.process(self)
+            FrameConverters.process(self,self.conversionPriority())
+
+    def conversionPriority(self):
+        return getattr(self.rawfile,"conversionPriority",ConversionPool.INTERACTIVE)
 
     def convert(self):
         if not self.convertQueued:
             self.convertQueued = True
-            FrameConverterThread.process(self)
+            FrameConverters.process(self,self.conversionPriority())
 
         if self.conversionResult == None:
             self.conversionResult = self.convertQ.get() # Will block until conversion completed
@@ -260,37 +576,88 @@ class Frame:
         if self.rawdata != None:
             if self.ljpeg:
                 # rawdata contains multiple LJPEG tiles
-                self.rawimage = np.empty((self.width*self.height),dtype=np.uint16)
-                tw,tl = self.rawdata[:2]
-                for i,t in enumerate(self.rawdata[2]):
-                    bitunpack.unpackljto16(t,self.rawimage,i*tw*2,tw,self.width-tw,self.linearization)
-            elif self.bitsPerSample == 14:
-                self.rawimage,self.framestats = unpacks14np16(self.rawdata,self.width,self.height,self.byteSwap)
-            elif self.bitsPerSample == 12:
-                self.rawimage,self.framestats = unpacks12np16(self.rawdata,self.width,self.height,self.byteSwap)
+                tw,tl,tiles = self.rawdata
+                self.rawimage,status = UnpackThreads.unpackLJ(tiles,self.width,self.height,tw,tl,self.linearization)
+                if any(status):
+                    print "LJ92 tiles failed to decode:",status
+                # Measure in place
+                self.rawimage,self.framestats = UnpackThreads.unpackStats(self.rawimage,self.width,self.height,16,0,self.black,self.white,self.cfa,output=self.rawimage)
+            elif self.bitsPerSample in (10,12,14):
+                rows = self.decodedRows()
+                rawimage,self.framestats = unpacksnp16(self.rawdata,self.width,self.height,self.bitsPerSample,self.byteSwap,self.black,self.white,self.cfa,rows)
+                self.rawimage = self._blackOutside(rawimage,rows)
             elif self.bitsPerSample == 16:
-                self.rawimage,self.framestats = np.fromstring(self.rawdata,dtype=np.uint16),(0,0)
+                rows = self.decodedRows()
+                rawimage,self.framestats = UnpackThreads.unpackStats(self.rawdata,self.width,self.height,16,0,self.black,self.white,self.cfa,rows=rows)
+                self.rawimage = self._blackOutside(rawimage,rows)
         else:
             rawimage = np.empty(self.width*self.height,dtype=np.uint16)
             rawimage.fill(self.black)
             self.rawimage = rawimage.tostring()
         return True
-    def demosaic(self):
-        # CPU based demosaic -> SLOW!
-        if self.rgbimage is not None:
-            return # Done already
-        elif self.rawimage is not None:
+    def decodeWindow(self):
+        """
+        (x,y,w,h) of the frame that is wanted, or None for all of it.
+        Taken from the sequence the first time it is needed so that
+        every stage of one frame agrees
+        """
+        if self.window == False:
+            self.window = getattr(self.rawfile,"decodeWindow",None)
+        return self.window
+    def decodedRows(self):
+        """
+        Rows (first,count) holding decoded data. Other rows are black.
+        LJ92 tiles can only be decoded whole
+        """
+        window = self.decodeWindow()
+        if window == None or self.ljpeg or self.rawdata == None:
+            return 0,self.height
+        x,y,w,h = window
+        first = max(0,(y-self.WindowMargin)&~1)
+        end = min(self.height,y+h+self.WindowMargin)
+        return first,end-first
+    def decodedImage(self,image,channels=1):
+        """
+        The decoded rows of image, a whole frame of values, as (data,yoff,rows)
+        for uploading only those rows to a texture
+        """
+        first,count = self.decodedRows()
+        if (first == 0 and count == self.height) or not isinstance(image,np.ndarray):
+            return image,0,self.height
+        rowlen = self.width*channels
+        return image[first*rowlen:(first+count)*rowlen],first,count
+    def _blackOutside(self,image,rows):
+        first,count = rows
+        image[:first*self.width] = self.black
+        image[(first+count)*self.width:] = self.black
+        return image
+    def demosaic(self,quality=CPUDemosaic.AMAZE):
+        """
+        CPU demosaic into rgbimage, which is returned. AMaZE is best but
+        slow, bilinear and nearest are much faster. A result of the same
+        or better quality is kept. SUPERPIXEL is half size, so it is only
+        returned and rgbimage is left alone
+        """
+        if quality == CPUDemosaic.SUPERPIXEL:
+            return self._demosaicRaw(quality)
+        if self.rgbimage is not None and (self.rgbquality == None or self.rgbquality <= quality):
+            return self.rgbimage # Done already
+        self.rgbimage = self._demosaicRaw(quality)
+        self.rgbquality = quality
+        return self.rgbimage
+    def _demosaicRaw(self,quality):
+        # CPU based demosaic -> SLOW for AMaZE!
+        window = self.decodeWindow()
+        if self.rawimage is not None:
             # Already converted 14bit to 16bit, or preprocessed
-            self.rgbimage = demosaic16(self.rawimage,self.width,self.height,self.black,byteSwap=0,cfa=self.cfa)
+            return demosaic16(self.rawimage,self.width,self.height,self.black,byteSwap=0,cfa=self.cfa,window=window,dtype=self.RgbDtype,quality=quality)
         elif self.rawdata is not None:
-            if self.bitsPerSample == 14:
-                self.rgbimage = demosaic14(self.rawdata,self.width,self.height,self.black,self.byteSwap,cfa=self.cfa)
-            elif self.bitsPerSample == 16:
-                self.rgbimage = demosaic16(self.rawdata,self.width,self.height,self.black,byteSwap=0,cfa=self.cfa) # Hmm...what about byteSwapping?
-            elif self.bitsPerSample == 12:
-                self.rgbimage = demosaic12(self.rawdata,self.width,self.height,self.black,byteSwap=0,cfa=self.cfa)
-        else:
-            self.rgbimage = np.zeros(self.width*self.height*3,dtype=np.uint16).tostring()
+            if self.bitsPerSample == 16:
+                return demosaic16(self.rawdata,self.width,self.height,self.black,byteSwap=0,cfa=self.cfa,window=window,dtype=self.RgbDtype,quality=quality) # Hmm...what about byteSwapping?
+            elif self.bitsPerSample in (10,12,14):
+                return demosaicbits(self.rawdata,self.width,self.height,self.black,self.bitsPerSample,self.byteSwap,cfa=self.cfa,window=window,dtype=self.RgbDtype,quality=quality)
+        w,h = DemosaicThread.outputSize(self.width,self.height,quality)
+        return np.zeros(w*h*3,dtype=np.uint16)
     def thumb(self,balance=None,brightness=None):
         """
         Try to make a thumbnail from the data we have
@@ -309,54 +676,30 @@ class Frame:
             # Map to 16bit uint range
             PLOG(PLOG_CPU,"Frame thumb gen done")
             return (ssnrgb*65536.0).astype(np.uint16)
-        if self.rawdata and self.bitsPerSample==14:
-            # Extract low-quality downscaled RGB image
-            # from packed 14bit bayer data
-            # Take first 2 14bit values from every block of 8
-            # (packed into 14 bytes) on 2 out of 8 rows.
-            # That gives R,G1,G2,B values. Make 1 pixel from those
-            h = 8*(self.height/8)
-            bayer = np.fromstring(self.rawdata[:self.height*self.width*14/8],dtype=np.uint16).reshape(self.height,(self.width*7)/8)[:h,:].astype(np.uint16) # Clip to height divisible by 8
-            r1 = bayer[2::8,::7]
-            r2 = bayer[2::8,1::7]
-            b1 = bayer[1::8,::7]
-            b2 = bayer[1::8,1::7]
-            nrgb = np.zeros(shape=(self.height/8,self.width/8,3),dtype=np.uint16)+self.black
-            nrgb[:,:,0] = r1>>2
-            nrgb[:,:,1] = ((r1&0x3)<<12) | (r2>>4)
-            nrgb[:,:,2] = ((b1&0x3)<<12) | (b2>>4)
-            # Random brightness and colour balance
-            ssnrgb = (((brightness*6.0)/(2.0**14))*np.array(balance))*(nrgb.astype(np.float32)-self.black)
-            ssnrgb = np.clip(ssnrgb,0.0,1000000.0)
-            # Tone map
-            ssnrgb = ssnrgb/(1.0 + ssnrgb)
-            # Map to 16bit uint range
-            PLOG(PLOG_CPU,"Frame thumb gen done")
-            return (ssnrgb*65536.0).astype(np.uint16)
-        else: # Convert to 16 bit and make thumbnail from that
-            self.convert()
-            ri = np.array(self.rawimage,dtype=np.uint16).reshape(self.height,self.width)
-            nrgb = np.zeros(shape=(self.height/8,self.width/8,3),dtype=np.uint16)+self.black
-            if self.cfa==0:
-                nrgb[:,:,0] = ri[::8,0::8][:nrgb.shape[0],:nrgb.shape[1]]
-                nrgb[:,:,1] = ri[::8,1::8][:nrgb.shape[0],:nrgb.shape[1]]
-                nrgb[:,:,2] = ri[1::8,1::8][:nrgb.shape[0],:nrgb.shape[1]]
-            else:
-                nrgb[:,:,1] = ri[::8,::8][:nrgb.shape[0],:nrgb.shape[1]]
-                nrgb[:,:,2] = ri[1::8,::8][:nrgb.shape[0],:nrgb.shape[1]]
-                nrgb[:,:,0] = ri[::8,1::8][:nrgb.shape[0],:nrgb.shape[1]]
-            #nrgb[:,:,0] = self.rawimage
-            #nrgb[:,:,1] = ((r1&0x3)<<12) | (r2>>4)
-            #nrgb[:,:,2] = ((b1&0x3)<<12) | (b2>>4)
-            # Random brightness and colour balance
-            ssnrgb = (((brightness*6.0)/65536.0)*np.array(balance))*(nrgb.astype(np.float32)-self.black)
-            ssnrgb = np.clip(ssnrgb,0.0,1000000.0)
-            # Tone map
-            ssnrgb = ssnrgb/(1.0 + ssnrgb)
-            # Map to 16bit uint range
-            PLOG(PLOG_CPU,"Frame thumb gen done")
-            return (ssnrgb*65536.0).astype(np.uint16)
+        # Low-quality downscaled RGB image straight from the bayer data
+        nrgb = self.reduced(8)
+        # Random brightness and colour balance
+        ssnrgb = (((brightness*6.0)/(2.0**self.bitsPerSample))*np.array(balance))*nrgb.astype(np.float32)
+        # Tone map
+        ssnrgb = ssnrgb/(1.0 + ssnrgb)
+        # Map to 16bit uint range
         PLOG(PLOG_CPU,"Frame thumb gen done")
+        return (ssnrgb*65536.0).astype(np.uint16)
+    def reduced(self,factor=2):
+        """
+        Linear RGB image at 1/2, 1/4 or 1/8 size with black subtracted,
+        for scrubbing and proxies. Packed data is decoded directly without
+        a full unpack or demosaic. LJ92 frames have to be decoded first
+        """
+        if self.rawimage is None and (self.rawdata is None or self.ljpeg):
+            self.convert()
+        if self.rawimage is not None:
+            data,bits,byteSwap = self.rawimage,16,0
+        elif self.bitsPerSample == 16:
+            data,bits,byteSwap = self.rawdata,16,0
+        else:
+            data,bits,byteSwap = self.rawdata,self.bitsPerSample,self.byteSwap
+        return UnpackThreads.reduced(data,self.width,self.height,bits,byteSwap,factor,self.black,self.cfa)
 
 def colorMatrix(raw_info):
     vals = np.array(raw_info[-19:-1]).astype(np.float32)
@@ -402,6 +745,10 @@ which contain additional derived or user-set data. Examples include:
 """
 
 class ImageSequence(object):
+    PreloadWorkers = 2 # Frames loaded at the same time by preloadFrame
+    PreloadBudget = 512*1024*1024 # Bytes of loaded frames kept until collected
+    conversionPriority = ConversionPool.INTERACTIVE # Set by exports and thumbnailers
+    decodeWindow = None # (x,y,w,h) of each frame to decode, or None for all of it
     def __init__(self,userMetadataFilename=None,**kwds):
         self._metadataLock = threading.Lock()
         self._userMetadata = {}
@@ -410,6 +757,24 @@ class ImageSequence(object):
         self._readUserMetadata()
         self._metadataLock.release()
         super(ImageSequence,self).__init__(**kwds)
+    def activeWindow(self):
+        """
+        The active area as (x,y,w,h). Whole frame in either direction
+        where the area is missing or too big
+        """
+        aa = self.activeArea
+        fw = self.width()
+        fh = self.height()
+        tlx,tly = aa[1],aa[0]
+        aw = aa[3]-aa[1]
+        ah = aa[2]-aa[0]
+        if aw>=fw or aw<=0:
+            aw = fw
+            tlx = 0
+        if ah>=fh or ah<=0:
+            ah = fh
+            tly = 0
+        return tlx,tly,aw,ah
     def getMeta(self,key):
         #print "getMeta acquiring lock",key
         self._metadataLock.acquire()
@@ -481,6 +846,152 @@ class ImageSequence(object):
     @staticmethod
     def userMetadataNameFromOriginal(original):
         return os.path.splitext(original)[0]+".MRX"
+    @staticmethod
+    def frameIndexNameFromOriginal(original):
+        """
+        Bulk frame index data lives next to the MRX so it can be mapped
+        """
+        return os.path.splitext(original)[0]+".MRI"
+    def initPreloader(self):
+        """
+        Start the pool of threads which load frames asked for with
+        preloadFrame. Loaded frames are kept by index until collected
+        with frame() or nextFrame(), up to PreloadBudget bytes
+        """
+        if getattr(self,"preloaders",None) != None:
+            return
+        self.preloaderArgs = Queue.Queue()
+        self.preloaderResults = {} # Loaded frames by index
+        self.preloaderOrder = [] # Indexes of loaded frames, in order of completion
+        self.preloaderPending = set() # Requested and not yet loaded
+        self.preloaderWaiting = set() # Indexes frame() is waiting for
+        self.preloaderCond = threading.Condition()
+        self.preloadStats = {"requested":0,"duplicates":0,"loaded":0,"wasted":0}
+        self.preloaders = []
+        for i in range(self.PreloadWorkers):
+            preloader = threading.Thread(target=self.preloaderMain)
+            preloader.daemon = True
+            preloader.start()
+            self.preloaders.append(preloader)
+    def closePreloader(self):
+        for preloader in self.preloaders:
+            self.preloaderArgs.put(None) # So that preloader threads exit
+        for preloader in self.preloaders:
+            preloader.join() # Wait for them to finish
+        self.preloadStats["wasted"] += len(self.preloaderResults) # Never collected
+        PLOG(PLOG_CPU,"Preload stats %s"%str(self.preloadStats))
+    def preloadDepth(self):
+        """
+        Number of frames worth having requested at once
+        """
+        return len(self.preloaders)
+    def preloadStatistics(self):
+        """
+        Counts of frame requests, requests for frames already loaded
+        or loading, frames loaded and loaded frames thrown away unused
+        """
+        self.preloaderCond.acquire()
+        stats = dict(self.preloadStats)
+        self.preloaderCond.release()
+        return stats
+    def preloaderIdle(self):
+        """
+        Called by the preloader threads between frames. Returns how
+        long to wait for a frame request before calling it again, or
+        None to wait until there is one
+        """
+        return None
+    def preloaderMain(self):
+        try:
+            while 1:
+                wait = self.preloaderIdle()
+                try:
+                    arg = self.preloaderArgs.get(True,wait) # Will wait for a job
+                except Queue.Empty:
+                    continue
+                if arg==None:
+                    break
+                try:
+                    frame = self._loadframe(arg)
+                except Exception,err:
+                    print "Error reading frame %d, %s"%(arg,str(err))
+                    traceback.print_exc()
+                    frame = None
+                self.preloaderCond.acquire()
+                self.preloaderPending.discard(arg)
+                self.preloaderOrder.append(arg)
+                self.preloaderResults[arg] = frame
+                self.preloadStats["loaded"] += 1
+                self._trimPreloaded()
+                self.preloaderCond.notifyAll()
+                self.preloaderCond.release()
+        except:
+            pass # Can happen if shutting down
+    def _trimPreloaded(self):
+        """
+        Drop the oldest uncollected frames while over budget.
+        Frames being waited for are kept. Call with preloaderCond held
+        """
+        # Sized each time, as frames grow when their conversion completes
+        sizes = dict([(i,FrameCache.frameBytes(f)) for i,f in self.preloaderResults.iteritems()])
+        held = sum(sizes.itervalues())
+        for index in self.preloaderOrder[:]:
+            if held <= self.PreloadBudget:
+                break
+            if index in self.preloaderWaiting:
+                continue
+            self.preloaderOrder.remove(index)
+            held -= sizes[index]
+            del self.preloaderResults[index]
+            self.preloadStats["wasted"] += 1
+    def _takePreloaded(self,index):
+        self.preloaderOrder.remove(index)
+        frame = self.preloaderResults.pop(index)
+        return frame
+    def preloadFrame(self,index):
+        """
+        Ask for a frame to be loaded. Asking again for a frame which
+        is loading or loaded and not yet collected does nothing
+        """
+        self.preloaderCond.acquire()
+        self.preloadStats["requested"] += 1
+        if index in self.preloaderPending or index in self.preloaderResults:
+            self.preloadStats["duplicates"] += 1
+            self.preloaderCond.release()
+            return
+        self.preloaderPending.add(index)
+        self.preloaderCond.release()
+        self.preloaderArgs.put(index)
+    def isPreloadedFrameAvailable(self):
+        return len(self.preloaderOrder)>0
+    def nextFrame(self):
+        """
+        The next frame to finish loading, as (index,frame)
+        """
+        self.preloaderCond.acquire()
+        while len(self.preloaderOrder)==0:
+            self.preloaderCond.wait()
+        index = self.preloaderOrder[0]
+        frame = self._takePreloaded(index)
+        self.preloaderCond.release()
+        return index,frame
+    def frame(self,index):
+        """
+        Wait for a particular frame, requesting it if needed.
+        Other loaded frames are left for later
+        """
+        self.preloaderCond.acquire()
+        self.preloaderWaiting.add(index)
+        if index not in self.preloaderResults and index not in self.preloaderPending:
+            self.preloaderCond.release()
+            self.preloadFrame(index)
+            self.preloaderCond.acquire()
+        while index not in self.preloaderResults:
+            self.preloaderCond.wait()
+        self.preloaderWaiting.discard(index)
+        frame = self._takePreloaded(index)
+        self.preloaderCond.release()
+        return frame
 
 """
 ML RAW - need to handle spanning files
@@ -506,6 +1017,7 @@ class MLRAW(ImageSequence):
         #print "FPS:",self.fps
         self.info = struct.unpack("40i",footerdata[8*4:])
         #print self.footer,self.info
+        self.bitsPerSample = self.info[6]
         self.black = self.info[7]
         self.white = self.info[8]
         self.cropOrigin = (self.info[9],self.info[10])
@@ -518,22 +1030,16 @@ class MLRAW(ImageSequence):
         self.framefiles = []
         for framefilename in allfiles:
             fullframefilename = os.path.join(dirname,framefilename)
-            framefile = file(fullframefilename,'rb')
-            framefile.seek(0,os.SEEK_END)
-            framefilelen = framefile.tell()
-            self.framefiles.append((framefile,framefilelen))
+            self.framefiles.append(file(fullframefilename,'rb'))
+        self.spanned = MlvIndex.SpannedFile(self.framefiles) # Frames run on across the span files
         self.firstFrame = self._loadframe(0,convert=False)
-        self.preloader = threading.Thread(target=self.preloaderMain)
-        self.preloaderArgs = Queue.Queue(2)
-        self.preloaderResults = Queue.Queue(2)
-        self.preloader.daemon = True
-        self.preloader.start()
+        self.initPreloader()
         super(MLRAW,self).__init__(userMetadataFilename=ImageSequence.userMetadataNameFromOriginal(indexfile),**kwds)
     def close(self):
-        self.preloaderArgs.put(None) # So that preloader thread exits
-        self.preloader.join() # Wait for it to finish
+        self.closePreloader()
         self.indexfile.close()
-        for filehandle,filelen in self.framefiles:
+        self.spanned.close()
+        for filehandle in self.framefiles:
             filehandle.close()
     def indexingStatus(self):
         return 1.0 # RAW doesn't get indexed. It is sequential
@@ -551,53 +1057,14 @@ class MLRAW(ImageSequence):
         return "EOS"
     def audioFrames(self):
         return 0
-    def preloaderMain(self):
-        while 1:
-            arg = self.preloaderArgs.get() # Will wait for a job
-            if arg==None:
-                break
-            frame = self._loadframe(arg)
-            self.preloaderResults.put((arg,frame))
-    def preloadFrame(self,index):
-        self.preloaderArgs.put(index)
-    def isPreloadedFrameAvailable(self):
-        return not self.preloaderResults.empty()
-    def nextFrame(self):
-        return self.preloaderResults.get()
-    def frame(self,index):
-        preloadedindex = -1
-        frame = None
-        while preloadedindex!=index:
-            preloadedindex,frame = self.preloaderResults.get()
-            if preloadedindex==index:
-                break
-            self.preloadFrame(index)
-        return frame
     def _loadframe(self,index,convert=True):
         if index>=0 and index<self.frames():
-            offset = index*self.footer[3]
-            needed = self.footer[3]
-            framedata = ""
-            for filehandle,filelen in self.framefiles:
-                if offset>=filelen:
-                    offset -= filelen
-                    continue
-                filecontains = filelen-offset
-                needfromfile = min(filecontains,needed)
-                filehandle.seek(offset)
-                PLOG(PLOG_CPU,"Reading frame %d size %d"%(index,needfromfile))
-                newframedata = filehandle.read(needfromfile)
-                PLOG(PLOG_CPU,"Read frame %d size %d"%(index,needfromfile))
-                needed -= len(newframedata)
-                framedata += newframedata
-                if needed==0:
-                    break
-                offset += len(newframedata)
-                if offset>=filelen:
-                    offset -= filelen
-            if needed!=0:
+            PLOG(PLOG_CPU,"Reading frame %d size %d"%(index,self.footer[3]))
+            framedata = self.spanned.view(self.footer[3],index*self.footer[3])
+            PLOG(PLOG_CPU,"Read frame %d size %d"%(index,len(framedata)))
+            if len(framedata)!=self.footer[3]:
                 return Frame(self,None,self.width(),self.height(),self.black,self.white)
-            return Frame(self,framedata,self.width(),self.height(),self.black,self.white,convert=convert)
+            return Frame(self,framedata,self.width(),self.height(),self.black,self.white,bitsPerSample=self.bitsPerSample,convert=convert)
         return Frame(self,None,self.width(),self.height(),self.black,self.white)
 
 
@@ -633,16 +1100,39 @@ class MLV(ImageSequence):
     BlockTypeValues = [getattr(BlockType,n) for n in BlockTypeNames]
     BlockTypeLookup = dict(zip(BlockTypeValues,BlockTypeNames))
 
-    def __init__(self,filename,preindex=True,**kwds):
+    # Blocks (other than video frames) handled while preindexing
+    PreindexParsers = {
+        BlockType.AudioFrame:"parseAudioFrame",
+        BlockType.LensInfo:"parseLens",
+        BlockType.ExposureInfo:"parseExpo",
+        BlockType.RealTimeClock:"parseRtc",
+        BlockType.WhiteBalance:"parseWbal"}
+    SeekBlocks = 1024 # Block headers decoded per step when seeking
+    SeekRunBlocks = 64 # Blocks indexed after a frame found by bisection
+    ScanWait = 0.05 # Seconds to wait for the span scanners before checking for frame requests
+    FollowInterval = 0.5 # Seconds between checks for new data when following a growing clip
+    FollowSaveInterval = 10.0 # Seconds between index saves when following
+    FollowStopInterval = 30.0 # Seconds without new data before a followed clip is taken as complete
+
+    def __init__(self,filename,preindex=True,follow=False,**kwds):
+        """
+        With follow, the clip is assumed to still be growing (for example
+        while being copied from a card). The spans are checked for new
+        data and new span files, the index is extended as it lands, and
+        frames() counts the frames indexed so far. Following stops once
+        the spans have not grown for FollowStopInterval, or on stopFollowing()
+        """
         self.filename = filename
         #print "Opening MLV file",filename
         dirname,allfiles = getRawFileSeries(filename)
         mlvfile = file(filename,'rb')
         self.fhs = [mlvfile] # Creates an fh-index to fh table for the index data
+        self.spanNames = [filename]
+        self.spans = [MlvIndex.SpanMap(mlvfile)] # Mapped views of the same files
         self.wav = None
         self.whiteBalance = None # Not yet read from MLVs
         self.brightness = 1.0 # Not meaningful in MLV
-        self.framepos = {}
+        self.framepos = MlvIndex.FrameIndex()
         self.audioframepos = {}
         self.metadata = [] # Store small info blocks so frames can reference them
         self.currentExpo = None
@@ -651,6 +1141,20 @@ class MLV(ImageSequence):
         self.currentRtc = None
         self.identity = ("Canon","EOS","",None)
         self.allParsed = False
+        self.xref = None
+        self.xrefIndex = None
+        self.scanner = None
+        self.spanMetadata = {} # Metadata current at the end of each span's header
+        self.indexingSpan = None
+        self.indexLock = threading.RLock() # Held while the index is extended
+        self.wantedLock = threading.Lock()
+        self.indexWanted = 0 # Frame loads waiting for the index
+        self.following = follow
+        self.availableFrames = 0 # Frames indexed so far, for following
+        self.lastRefresh = 0.0
+        self.lastSave = 0.0
+        self.lastGrowth = time.time()
+        self.resumeInfo = None
         header,raw,parsedTo,size,ts = self.parseFile(0,self.framepos)
         self.fps = float(header[16])/float(header[17])
         self.fpsnum = header[16]
@@ -672,44 +1176,133 @@ class MLV(ImageSequence):
         for spanfilename in allfiles[1:]:
             fullspanfile = os.path.join(dirname,spanfilename)
             #print fullspanfile
-            spanfile = file(fullspanfile,'rb')
-            self.fhs.append(spanfile)
-            header,raw,parsedTo,size,ts = self.parseFile(len(self.fhs)-1,self.framepos)
-            #print fullspanfile,len(header)
-            self.files.append((len(self.fhs)-1,self.framecount,header[14],header,parsedTo, size))
-            self.framecount += header[14]
-            self.audioFrameCount += header[15]
-            self.totalSize += size
-            self.totalParsed += parsedTo
+            self.addSpan(fullspanfile)
         super(MLV,self).__init__(userMetadataFilename=ImageSequence.userMetadataNameFromOriginal(filename),**kwds)
-        oldframepos = self.getMeta("frameIndex_v1")
-        if oldframepos != None and self.wav==None:
+        self.indexSaved = False
+        oldframepos = None
+        if self.wav==None:
             # If there is wav, it means we must reindex to generate it
+            oldframepos = self.loadIndex(filename)
+        if oldframepos != None:
             #print "Existing index data found"
             self.framepos = oldframepos
-            self.metadata = self.getMeta("sequenceMetadata_v1")
-            self.allParsed = True # No need to reindex
+            if self.resumeInfo != None:
+                self.resumeIndex(self.resumeInfo)
+            else:
+                self.metadata = self.getMeta("sequenceMetadata_v1")
+                self.allParsed = True # No need to reindex
             #print "Loaded index data"
-        self.preloader = None
-        self.preindexing = preindex
+        indexed = self.framepos.frames()
+        if len(indexed)>0:
+            self.availableFrames = max(self.availableFrames,int(indexed[-1])+1)
+        self.preindexing = preindex or follow
+        if not self.allParsed and self.wav==None and not follow:
+            # Frames are located from the XREF as needed. Preindexing
+            # still runs when idle, to fill in metadata blocks met mid-clip
+            self.loadXref(filename)
         #print "Audio frame count",self.audioFrameCount
         self.initPreloader()
+    def addSpan(self,fullspanfile):
+        """
+        Open another span file and read its header.
+        Returns False if the header is not all there yet
+        """
+        spanfile = file(fullspanfile,'rb')
+        fhi = len(self.fhs)
+        self.fhs.append(spanfile)
+        self.spanNames.append(fullspanfile)
+        self.spans.append(MlvIndex.SpanMap(spanfile))
+        header,raw,parsedTo,size,ts = self.parseFile(fhi,self.framepos)
+        if header == None:
+            self.spans.pop().close()
+            self.spanNames.pop()
+            self.fhs.pop().close()
+            return False
+        #print fullspanfile,len(header)
+        self.files.append((fhi,self.framecount,header[14],header,parsedTo, size))
+        self.framecount += header[14]
+        self.audioFrameCount += header[15]
+        self.totalSize += size
+        self.totalParsed += parsedTo
+        return True
+    def resumeIndex(self,info):
+        """
+        Carry on indexing a growing clip from where a saved index stopped.
+        The metadata read from the span headers on opening is kept
+        after the saved metadata
+        """
+        saved = self.getMeta("sequenceMetadata_v1")
+        offset = len(saved)
+        def moved(md):
+            return tuple([m if m==None else m+offset for m in md])
+        self.metadata = saved + self.metadata
+        for fhi,md in self.spanMetadata.items():
+            self.spanMetadata[fhi] = moved(md)
+        self.currentRtc,self.currentExpo,self.currentWbal,self.currentLens = moved(self.currentMetadata())
+        parsedTo = info.get("parsedTo",None)
+        if parsedTo == None:
+            parsedTo = [span[1] for span in info["spans"]] # Saved when complete
+        for index,(fhi,firstframe,frames,header,pos,size) in enumerate(self.files):
+            # Spans new since the save are indexed from the start, as
+            # their first frames are not in the saved index
+            resumeAt = 0
+            if fhi<len(parsedTo):
+                resumeAt = parsedTo[fhi]
+            self.totalParsed += resumeAt-pos
+            self.files[index] = (fhi,firstframe,frames,header,resumeAt,size)
+        indexing = info.get("indexing",None)
+        if indexing != None and indexing[0] != None:
+            self.indexingSpan = indexing[0]
+            self.currentRtc,self.currentExpo,self.currentWbal,self.currentLens = indexing[1]
+    def refreshSpans(self):
+        """
+        Look for data written to the spans, and new span files, since
+        they were last checked. Returns True if there is more to index
+        """
+        now = time.time()
+        if now-self.lastRefresh < MLV.FollowInterval:
+            return False
+        self.lastRefresh = now
+        grown = False
+        for index,(fhi,firstframe,frames,header,parsedTo,size) in enumerate(self.files):
+            span = self.spans[fhi]
+            span.refresh()
+            if span.size > size:
+                self.totalSize += span.size-size
+                self.files[index] = (fhi,firstframe,frames,header,parsedTo,span.size)
+                grown = True
+        dirname,allfiles = getRawFileSeries(self.filename)
+        opened = [os.path.basename(n) for n in self.spanNames]
+        for spanfilename in allfiles:
+            if spanfilename in opened:
+                continue
+            if not self.addSpan(os.path.join(dirname,spanfilename)):
+                break # Try again once the header has landed
+            grown = True
+        if grown:
+            self.allParsed = False
+            self.lastGrowth = now
+        return grown
+    def stopFollowing(self):
+        """
+        The clip has stopped growing. Indexing finishes as normal
+        """
+        self.following = False
+        self.framecount = max(self.framecount,self.availableFrames)
     def indexingStatus(self):
         if self.preindexing:
             return float(self.totalParsed)/float(self.totalSize)
         else:
             return 1.0
-    def initPreloader(self):
-        if (self.preloader == None):
-            self.preloader = threading.Thread(target=self.preloaderMain)
-            self.preloaderArgs = Queue.Queue(2)
-            self.preloaderResults = Queue.Queue(2)
-            self.preloader.daemon = True
-            self.preloader.start()
     def close(self):
-        self.preloaderArgs.put(None) # So that preloader thread exits
-        self.preloader.join() # Wait for it to finish
+        self.closePreloader()
+        if self.scanner != None:
+            self.scanner.stop()
+            self.scanner = None
+        if self.following:
+            self.saveIndex() # So indexing can carry on when opened again
         for fhi,firstframe,frames,header,parsedTo,size in self.files:
+            self.spans[fhi].close()
             self.fhs[fhi].close()
     def currentMetadata(self):
         return (self.currentRtc,self.currentExpo,self.currentWbal,self.currentLens)
@@ -718,58 +1311,109 @@ class MLV(ImageSequence):
                 "expo":self.metadata[ix[1]],
                 "wbal":self.metadata[ix[2]],
                 "lens":self.metadata[ix[3]]}
+    def loadIndex(self,filename):
+        """
+        Map the saved frame index if it still matches the span files.
+        Older dict based indexes are converted
+        """
+        info = self.getMeta("frameIndex_v2")
+        if info != None:
+            signature = MlvIndex.spanSignature(self.spanNames)
+            try:
+                index = MlvIndex.FrameIndex.load(ImageSequence.frameIndexNameFromOriginal(filename),info,signature,growing=self.following)
+            except:
+                index = None
+            if index == None:
+                print "Saved index does not match clip. Reindexing."
+            else:
+                self.indexSaved = info["spans"]==signature
+                if self.following:
+                    self.resumeInfo = info
+            return index
+        oldframepos = self.getMeta("frameIndex_v1")
+        if oldframepos != None and not self.following: # No record of how far it got
+            return MlvIndex.FrameIndex.fromDict(oldframepos)
+        return None
+    def saveIndex(self):
+        if self.indexSaved:
+            return
+        try:
+            info = self.framepos.save(ImageSequence.frameIndexNameFromOriginal(self.filename),MlvIndex.spanSignature(self.spanNames))
+        except:
+            import traceback
+            traceback.print_exc()
+            return
+        # Where indexing got to, so it can be resumed if the spans grow
+        parsedTo = [0]*len(self.fhs)
+        for fhi,firstframe,frames,header,pos,size in self.files:
+            parsedTo[fhi] = pos
+        info["parsedTo"] = parsedTo
+        info["indexing"] = (self.indexingSpan,self.currentMetadata())
+        update = {"frameIndex_v2":info,"frameIndex_v1":None,"sequenceMetadata_v1":self.metadata}
+        self.setMetaValues(update)
+        self.indexSaved = True
     def parseFile(self,fhi,framepos):
-        fh = self.fhs[fhi]
-        fh.seek(0,os.SEEK_END)
-        size = fh.tell()
+        span = self.spans[fhi]
+        size = span.size
         pos = 0
-        count = 0
         header = None
         raw = None
         ts = None
         while pos<size-8:
-            fh.seek(pos)
-            blockType,blockSize = struct.unpack("II",fh.read(8))
-            if blockSize <= 0:
+            recs,nextpos = span.blocks(pos,maxblocks=16)
+            if len(recs)==0:
                 break # Corrupt!
-            """
-            try:
-                blockName = MLV.BlockTypeLookup[blockType]
-                print blockName,blockSize,pos,size,size-pos
-            except:
-                print "Unknown block type %08x"%blockType
-                pass
-            """
-            if blockType==MLV.BlockType.FileHeader:
-                header = self.parseFileHeader(fh,pos,blockSize)
-            elif blockType==MLV.BlockType.RawInfo:
-                raw = self.parseRawInfo(fh,pos,blockSize)
-            elif blockType==MLV.BlockType.RealTimeClock:
-                ts = self.parseRtc(fh,pos,blockSize)
-            elif blockType==MLV.BlockType.VideoFrame:
-                videoFrameHeader = self.parseVideoFrame(fh,pos,blockSize)
-                framepos[videoFrameHeader[1]] = (fhi,pos,self.currentMetadata())
-                pos += blockSize
-                break # Only get first frame in this file
-                #print videoFrameHeader[1],pos
-            elif blockType==MLV.BlockType.Wavi:
-                wavi = self.parseWavi(fh,pos,blockSize)
-            elif blockType==MLV.BlockType.XREF:
-                xref = self.parseXref(fh,pos,blockSize)
-            elif blockType==MLV.BlockType.AudioFrame:
-                audio = self.parseAudioFrame(fh,pos,blockSize)
-            elif blockType==MLV.BlockType.Identity:
-                self.identity = self.parseIdentity(fh,pos,blockSize)
-            elif blockType==MLV.BlockType.LensInfo:
-                lens = self.parseLens(fh,pos,blockSize)
-            elif blockType==MLV.BlockType.ExposureInfo:
-                expo = self.parseExpo(fh,pos,blockSize)
-            elif blockType==MLV.BlockType.WhiteBalance:
-                wbal = self.parseWbal(fh,pos,blockSize)
-            count += 1
-            pos += blockSize
-            count += 1
+            for blockType,blockSize,blockPos,frameNumber,frameSpace in recs.tolist():
+                pos = blockPos + blockSize
+                if blockType==MLV.BlockType.FileHeader:
+                    header = self.parseFileHeader(span,blockPos,blockSize)
+                elif blockType==MLV.BlockType.RawInfo:
+                    raw = self.parseRawInfo(span,blockPos,blockSize)
+                elif blockType==MLV.BlockType.RealTimeClock:
+                    ts = self.parseRtc(span,blockPos,blockSize)
+                elif blockType==MLV.BlockType.VideoFrame:
+                    framepos.set(frameNumber,fhi,blockPos,blockSize,self.currentMetadata())
+                    self.spanMetadata[fhi] = self.currentMetadata()
+                    return header, raw, pos, size, ts # Only get first frame in this file
+                elif blockType==MLV.BlockType.Wavi:
+                    wavi = self.parseWavi(span,blockPos,blockSize)
+                elif blockType==MLV.BlockType.XREF:
+                    xref = self.parseXref(span,blockPos,blockSize)
+                elif blockType==MLV.BlockType.AudioFrame:
+                    audio = self.parseAudioFrame(span,blockPos,blockSize)
+                elif blockType==MLV.BlockType.Identity:
+                    self.identity = self.parseIdentity(span,blockPos,blockSize)
+                elif blockType==MLV.BlockType.LensInfo:
+                    lens = self.parseLens(span,blockPos,blockSize)
+                elif blockType==MLV.BlockType.ExposureInfo:
+                    expo = self.parseExpo(span,blockPos,blockSize)
+                elif blockType==MLV.BlockType.WhiteBalance:
+                    wbal = self.parseWbal(span,blockPos,blockSize)
+        self.spanMetadata[fhi] = self.currentMetadata()
         return header, raw, pos, size, ts
+    def indexBlocks(self,fhi,span,recs,parsers):
+        """
+        Add the video frames in a run of scanned block records to the index.
+        Other blocks are handed to the named parsers in file order so that
+        frames pick up the metadata current at their position.
+        Returns the number of video frames indexed.
+        """
+        isVideo = recs['type']==MLV.BlockType.VideoFrame
+        others = np.flatnonzero(~isVideo).tolist()
+        others.append(len(recs))
+        start = 0
+        for other in others:
+            if other>start:
+                run = recs[start:other]
+                md = self.currentMetadata()
+                self.framepos.addRun(run['frame'],fhi,run['pos'],run['size'],md)
+                self.availableFrames = max(self.availableFrames,min(int(run['frame'].max())+1,MlvIndex.FrameIndex.MAX_FRAMES))
+            if other<len(recs):
+                parser = parsers.get(int(recs[other]['type']),None)
+                if parser != None:
+                    getattr(self,parser)(span,int(recs[other]['pos']),int(recs[other]['size']))
+            start = other+1
+        return int(isVideo.sum())
     def parseFileHeader(self,fh,pos,size):
         fh.seek(pos+8)
         headerData = fh.read(size-8)
@@ -793,6 +1437,7 @@ class MLV(ImageSequence):
         fh.seek(pos+8)
         rawData = fh.read(size-8)
         raw = struct.unpack("<Q2H40i",rawData[:(8+2*2+40*4)])
+        self.bitsPerSample = raw[9]
         self.black = raw[10]
         self.white = raw[11]
         self.colorMatrix = colorMatrix(raw)
@@ -883,21 +1528,49 @@ class MLV(ImageSequence):
         return wavi
     def parseXref(self,fh,pos,size):
         """
-        The Xref info is not very useful for us since we still need to
-        read all the chunks in order to find frame numbers
+        The Xref lists the position of every frame. Keep it so frames
+        can be located without reading all the chunks
         """
         fh.seek(pos+8)
         xrefData = fh.read(size-8)
-        offset = 8+4+4
-        xref = struct.unpack("<QII",xrefData[:offset])
-        xrefCount = xref[2]
-        xrefs = []
-        for x in range(xrefCount):
-            xrefEntry = struct.unpack("<HHQ",xrefData[offset:offset+12])
-            offset += 12
-            #print xrefEntry
+        xref,entries = MlvIndex.parseXrefData(xrefData)
+        self.xref = (xref,entries)
         #print "Xref:",xref
         return xref
+    def loadXref(self,filename):
+        """
+        Use an XREF, either from the clip or from an .IDX sidecar
+        file, to locate frames on demand instead of scanning
+        """
+        xref = self.xref
+        if xref == None:
+            # Written after the frames, so usually at the end of the last span
+            for fhi,firstframe,frames,header,parsedTo,size in reversed(self.files):
+                xref = MlvIndex.findTailXref(self.spans[fhi],self.framecount+self.audioFrameCount)
+                if xref != None:
+                    self.xref = xref
+                    break
+        if xref == None:
+            base = os.path.splitext(filename)[0]
+            for idxname in (base+".IDX",base+".idx"):
+                if os.path.exists(idxname):
+                    try:
+                        idx = MlvIndex.readXrefFile(idxname)
+                    except:
+                        idx = None
+                    if idx != None and idx[0] != None and idx[0][8] == self.header[8]: # Same GUID
+                        xref = idx[1]
+                    break
+        if xref == None:
+            return False
+        xrefHeader,entries = xref
+        fileNumbers = dict([(header[9],fhi) for fhi,firstframe,frames,header,parsedTo,size in self.files])
+        xrefIndex = MlvIndex.XrefIndex(self.spans,fileNumbers,entries,xrefHeader[1])
+        if not xrefIndex.spotCheck():
+            print "XREF does not match clip. Indexing by scanning."
+            return False
+        self.xrefIndex = xrefIndex
+        return True
     def parseVideoFrame(self,fh,pos,size):
         fh.seek(pos+8)
         rawData = fh.read(8+4+2+2+2+2+4+4)
@@ -925,6 +1598,8 @@ class MLV(ImageSequence):
     def height(self):
         return self.raw[2]
     def frames(self):
+        if self.following:
+            return self.availableFrames
         return self.framecount
     def make(self):
         return self.identity[0]
@@ -944,96 +1619,99 @@ class MLV(ImageSequence):
     def preindex(self):
         if not self.preindexing:
             return
+        if not self.indexLock.acquire(False):
+            return # Another preloader thread is indexing
+        try:
+            self._preindex()
+        finally:
+            self.indexLock.release()
+    def _preindex(self):
         while 1:
             if self.allParsed:
+                if self.scanner != None:
+                    self.scanner.stop()
+                    self.scanner = None
+                if self.following:
+                    if self.refreshSpans():
+                        continue # More of the clip has landed
+                    if time.time()-self.lastGrowth >= MLV.FollowStopInterval:
+                        print "Clip stopped growing. No longer following",self.filename
+                        self.stopFollowing()
+                        continue # Finish indexing
+                    if time.time()-self.lastSave >= MLV.FollowSaveInterval:
+                        self.saveIndex() # So indexing can carry on if closed during ingest
+                        self.lastSave = time.time()
+                    return
                 self.preindexing = False
                 if self.wav:
                     self.wav.close()
                 #print "Writing index"
-                update = {"frameIndex_v1":self.framepos,"sequenceMetadata_v1":self.metadata}
-                self.setMetaValues(update)
+                self.saveIndex()
                 #print "Index written"
                 return
             preindexStep = 10
             indexinfo = self.nextUnindexedFile()
             if indexinfo == None:
-                if len(self.framepos) < self.framecount:
+                if len(self.framepos) < self.framecount and not self.following:
                     print "Set indexed. Frames missing:",self.framecount - len(self.framepos)
                 else:
                     pass
                     #print "Set indexed. No frames missing."
-                return
+                continue # Save the index
+            if self.scanner == None:
+                # Scan all remaining spans at once. Results are merged here in file order
+                ranges = [(f[0],f[4],f[5]) for f in self.files if f[4]<f[5]]
+                self.scanner = MlvIndex.ParallelScanner(self.fhs,ranges)
             index,info = indexinfo
             fhi, firstframe, frames, header, pos, size = info
-            fh = self.fhs[fhi]
-            while (pos < size) and ((preindexStep > 0) or self.preloaderArgs.empty()):
-                fh.seek(pos)
-                blockType,blockSize = struct.unpack("II",fh.read(8))
-                """
+            span = self.spans[fhi]
+            if self.indexingSpan != fhi:
+                # Spans are merged in order, each starting from the metadata in its own header
+                self.indexingSpan = fhi
+                if fhi in self.spanMetadata:
+                    self.currentRtc,self.currentExpo,self.currentWbal,self.currentLens = self.spanMetadata[fhi]
+            while (pos < size) and ((preindexStep > 0) or not self.framesWanted()):
                 try:
-                    blockName = MLV.BlockTypeLookup[blockType]
-                    print blockName,blockSize,pos,size,size-pos
-                except:
-                    print "Unknown block type %08x"%blockType
-                    pass
-                """
-
-                if blockType==MLV.BlockType.VideoFrame:
-                    videoFrameHeader = self.parseVideoFrame(fh,pos,blockSize)
-                    self.framepos[videoFrameHeader[1]] = (fhi,pos,self.currentMetadata())
-                    #print videoFrameHeader[1],pos
-                    preindexStep -= 1
-                elif blockType==MLV.BlockType.AudioFrame:
-                    audioFrameHeader = self.parseAudioFrame(fh,pos,blockSize)
-                elif blockType==MLV.BlockType.LensInfo:
-                    lens = self.parseLens(fh,pos,blockSize)
-                elif blockType==MLV.BlockType.ExposureInfo:
-                    expo = self.parseExpo(fh,pos,blockSize)
-                elif blockType==MLV.BlockType.RealTimeClock:
-                    ts = self.parseRtc(fh,pos,blockSize)
-                elif blockType==MLV.BlockType.WhiteBalance:
-                    wbal = self.parseWbal(fh,pos,blockSize)
-                pos += blockSize
-                self.totalParsed += blockSize
+                    if not self.framesWanted():
+                        chunk = self.scanner.next(fhi,MLV.ScanWait)
+                    else:
+                        chunk = self.scanner.next(fhi)
+                except Queue.Empty:
+                    if not self.framesWanted():
+                        continue
+                    break # Frames are wanted, and this span is not scanned yet
+                if chunk == None:
+                    if self.following and pos < size:
+                        # The rest has not all landed yet. Scanned again once the span grows
+                        self.totalSize -= size-pos
+                        size = pos
+                    nextpos = size # Scanner finished this span
+                else:
+                    recs,start,nextpos = chunk
+                    if nextpos <= pos:
+                        continue # Already indexed when seeking
+                    if start < pos:
+                        recs = recs[recs['pos']>=pos]
+                    preindexStep -= self.indexBlocks(fhi,span,recs,MLV.PreindexParsers)
+                    self.indexSaved = False
+                self.totalParsed += nextpos-pos
+                pos = nextpos
             self.files[index] = (fhi, firstframe, frames, header, pos, size)
-            if not self.preloaderArgs.empty():
+            if self.framesWanted():
                 break
 
-    def preloaderMain(self):
-        #while self.preindexing:
-        #    self.preindex() # Do some preindexing if still needed
-        # Now we can load frames
-        try:
-            while 1:
-                self.preindex() # Do some preindexing if still needed
-                arg = self.preloaderArgs.get() # Will wait for a job
-                if arg==None:
-                    break
-                try:
-                    frame = self._loadframe(arg)
-                except Exception,err:
-                    print "Error reading frame %d, %s"%(arg,str(err))
-                    traceback.print_exc()
-                    frame = None
-                self.preloaderResults.put((arg,frame))
-        except:
-            pass # Can happen if shutting down during preindexing
-    def preloadFrame(self,index):
-        self.initPreloader()
-        self.preloaderArgs.put(index)
-    def isPreloadedFrameAvailable(self):
-        return not self.preloaderResults.empty()
-    def nextFrame(self):
-        return self.preloaderResults.get()
-    def frame(self,index):
-        preloadedindex = -1
-        frame = None
-        while preloadedindex!=index:
-            preloadedindex,frame = self.preloaderResults.get()
-            if preloadedindex==index:
-                break
-            self.preloadFrame(index)
-        return frame
+    def preloaderIdle(self):
+        self.preindex() # Do some preindexing if still needed
+        if self.following:
+            return MLV.FollowInterval # Look for more of the clip
+        if self.preindexing:
+            return MLV.FollowInterval # Carry on if frame loads broke off preindexing
+        return None
+    def framesWanted(self):
+        """
+        True if frame loads are waiting on the index
+        """
+        return self.indexWanted>0 or not self.preloaderArgs.empty()
     def _getframedata(self,index,checkNextFile=True):
         printWhenFound = False
         try:
@@ -1041,36 +1719,43 @@ class MLV(ImageSequence):
             return fhi, framepos, metadata
         except:
             # Do not have that frame (yet)
+            if self.xrefIndex != None:
+                try:
+                    located = self.xrefIndex.locate(index)
+                    if located == None:
+                        self.framepos[index] = (None,None,None) # Not in the clip
+                        return None
+                    fhi,framepos = located
+                    # Refined by preindexing once it reaches the frame
+                    self.framepos[index] = (fhi,framepos,self.spanMetadata.get(fhi,self.currentMetadata()))
+                    return self.framepos[index]
+                except MlvIndex.XrefIndex.Mismatch:
+                    print "XREF does not match clip. Falling back to scanning."
+                    self.xrefIndex = None
             # Find which file should contain that frame
             for fileindex,info in enumerate(self.files):
                 fhi, firstframe, frames, header, parsedTo, size = info
-                fh = self.fhs[fhi]
+                span = self.spans[fhi]
                 if index>=firstframe and index<(firstframe+frames):
+                    result = self.seekFrame(index,fhi,firstframe+frames,size)
+                    if result != None:
+                        return result
                     break
             # Parse through file until we find frame
             pos = parsedTo
             notFound = True
             while pos < size:
-                fh.seek(pos)
-                blockType,blockSize = struct.unpack("II",fh.read(8))
-                """
-                try:
-                    blockName = MLV.BlockTypeLookup[blockType]
-                    print blockName,blockSize,pos,size,size-pos
-                except:
-                    pass
-                    print "Unknown block type:",blockType
-                """
-                #print blockName,blockSize
-                if blockType==MLV.BlockType.VideoFrame:
-                    videoFrameHeader = self.parseVideoFrame(fh,pos,blockSize)
-                    self.framepos[videoFrameHeader[1]] = (fhi,pos,self.currentMetadata())
-                    #print videoFrameHeader[1],index,fh,pos
-                    if videoFrameHeader[1]==index:
-                        pos += blockSize
-                        notFound = False
-                        break # Found it
-                pos += blockSize
+                recs,nextpos = span.blocks(pos,size,MLV.SeekBlocks)
+                if len(recs)==0:
+                    if self.following:
+                        break # Rest of the span has not landed yet
+                    nextpos = size # Corrupt or truncated
+                else:
+                    self.indexBlocks(fhi,span,recs,{})
+                pos = nextpos
+                if index in self.framepos:
+                    notFound = False
+                    break # Found it
                 if pos>=size and notFound:
                     self.files[fileindex] = (fhi, firstframe, frames, header, pos, size)
                     if checkNextFile:
@@ -1082,7 +1767,7 @@ class MLV(ImageSequence):
                         if fileindex<len(self.files):
                             #print "TRYING NEXT FILE"
                             fhi, firstframe, frames, header, parsedTo, size = self.files[fileindex]
-                            fh = self.fhs[fhi]
+                            span = self.spans[fhi]
                             pos = parsedTo
                     else:
                         print "FAILED TO FIND FRAME",index
@@ -1096,32 +1781,68 @@ class MLV(ImageSequence):
                     print "FOUND",index
             except:
                 print "FAILED TO FIND FRAME AFTER SCAN",index
-                self.framepos[index] = (None,None,None)
+                if not self.following:
+                    self.framepos[index] = (None,None,None)
             return result
+    def seekFrame(self,index,fhi,endframe,size):
+        """
+        Find a frame ahead of the indexed part of a span by bisection
+        instead of scanning up to it. Frames found are added to the index
+        with the span header metadata. The preindex position is not moved,
+        so preindexing later fills in the exact metadata
+        """
+        span = self.spans[fhi]
+        lo,hi = self.framepos.neighbours(index,fhi)
+        if lo == None:
+            return None
+        if hi == None:
+            hi = (endframe,size)
+        found = MlvIndex.bisectFrame(span,index,lo,hi,MLV.BlockTypeValues)
+        if found == None:
+            return None
+        # Index a few blocks from there so following frames are already known
+        recs,nextpos = span.blocks(found,size,MLV.SeekRunBlocks)
+        video = recs[recs['type']==MLV.BlockType.VideoFrame]
+        md = self.spanMetadata.get(fhi,self.currentMetadata())
+        self.framepos.addRun(video['frame'],fhi,video['pos'],video['size'],md)
+        if index in self.framepos:
+            return self.framepos[index]
+        return None
     def _loadframe(self,index,convert=True):
-        fhframepos = self._getframedata(index)
+        # Finding frames can extend the index, so wait for any preindexing
+        self.wantedLock.acquire()
+        self.indexWanted += 1
+        self.wantedLock.release()
+        self.indexLock.acquire()
+        try:
+            fhframepos = self._getframedata(index)
+        finally:
+            self.indexLock.release()
+            self.wantedLock.acquire()
+            self.indexWanted -= 1
+            self.wantedLock.release()
         if fhframepos==None: # Return black frame
             return Frame(self,None,self.width(),self.height(),self.black,self.white)
         fhi,framepos,md = fhframepos
         if fhi==None: # Return black frame
             return Frame(self,None,self.width(),self.height(),self.black,self.white)
-        fh = self.fhs[fhi]
-        fh.seek(framepos)
-        blockType,blockSize = struct.unpack("II",fh.read(8))
-        videoFrameHeader = self.parseVideoFrame(fh,framepos,blockSize)
+        span = self.spans[fhi]
+        # Read at explicit positions, as other preloader threads share the span
+        blockType,blockSize = struct.unpack("II",span.read(8,framepos))
+        videoFrameHeader = struct.unpack("<QI4H2I",span.read(28,framepos+8))
         rawstarts = framepos + 32 + videoFrameHeader[-2]
         rawsize = blockSize - 32 - videoFrameHeader[-2]
-        fh.seek(rawstarts)
         PLOG(PLOG_CPU,"Reading frame %d size %d"%(index,rawsize))
-        rawdata = fh.read(rawsize)
+        rawdata = span.view(rawsize,rawstarts)
         PLOG(PLOG_CPU,"Read frame %d size %d"%(index,rawsize))
         mdkw = self.toMetadata(md)
-        return Frame(self,rawdata,self.width(),self.height(),self.black,self.white,convert=convert,**mdkw)
+        return Frame(self,rawdata,self.width(),self.height(),self.black,self.white,bitsPerSample=self.bitsPerSample,convert=convert,**mdkw)
 
 class CDNG(ImageSequence):
     """
     Treat a directory of DNG files as sequential frames
     """
+    PreloadWorkers = 4 # One file per frame, so reads can overlap on fast or networked storage
     def __init__(self,filename,preindex=False,**kwds):
         #print "Opening CinemaDNG",filename
         self.filename = filename
@@ -1242,11 +1963,7 @@ class CDNG(ImageSequence):
 
         self.firstFrame = self._loadframe(0,convert=False)
 
-        self.preloader = threading.Thread(target=self.preloaderMain)
-        self.preloaderArgs = Queue.Queue(2)
-        self.preloaderResults = Queue.Queue(2)
-        self.preloader.daemon = True
-        self.preloader.start()
+        self.initPreloader()
         super(CDNG,self).__init__(userMetadataFilename=ImageSequence.userMetadataNameFromOriginal(firstDngName),**kwds)
     def tag(self,dng,tag):
         if tag[0] in dng.FULL_IFD.tags: return dng.FULL_IFD.tags[tag[0]]
@@ -1261,8 +1978,7 @@ class CDNG(ImageSequence):
         return os.path.join(self.cdngpath,"["+name+"-"+lastname+"]"+ext)
 
     def close(self):
-        self.preloaderArgs.put(None) # So that preloader thread exits
-        self.preloader.join() # Wait for it to finish
+        self.closePreloader()
         self.firstDng.close()
     def indexingStatus(self):
         return 1.0
@@ -1280,28 +1996,6 @@ class CDNG(ImageSequence):
         return self.identity[2]
     def audioFrames(self):
         return 0
-    def preloaderMain(self):
-        while 1:
-            arg = self.preloaderArgs.get() # Will wait for a job
-            if arg==None:
-                break
-            frame = self._loadframe(arg)
-            self.preloaderResults.put((arg,frame))
-    def preloadFrame(self,index):
-        self.preloaderArgs.put(index)
-    def isPreloadedFrameAvailable(self):
-        return not self.preloaderResults.empty()
-    def nextFrame(self):
-        return self.preloaderResults.get()
-    def frame(self,index):
-        preloadedindex = -1
-        frame = None
-        while preloadedindex!=index:
-            preloadedindex,frame = self.preloaderResults.get()
-            if preloadedindex==index:
-                break
-            self.preloadFrame(index)
-        return frame
     def _loadframe(self,index,convert=True):
         if index>=0 and index<self.frames():
             filename = self.dngs[index]
@@ -1323,6 +2017,7 @@ class TIFFSEQ(ImageSequence):
     """
     Treat a directory of (e.g. 16bit) TIFF files as sequential frames
     """
+    PreloadWorkers = 4
     def __init__(self,filename,preindex=False,**kwds):
         print "Opening TIFF sequence",filename
         self.filename = filename
@@ -1363,11 +2058,7 @@ class TIFFSEQ(ImageSequence):
 
         self.firstFrame = self._loadframe(0,convert=False)
 
-        self.preloader = threading.Thread(target=self.preloaderMain)
-        self.preloaderArgs = Queue.Queue(2)
-        self.preloaderResults = Queue.Queue(2)
-        self.preloader.daemon = True
-        self.preloader.start()
+        self.initPreloader()
         super(TIFFSEQ,self).__init__(userMetadataFilename=ImageSequence.userMetadataNameFromOriginal(firstName),**kwds)
     def description(self):
         firstName = self.tiffs[0]
@@ -1377,8 +2068,7 @@ class TIFFSEQ(ImageSequence):
         return os.path.join(self.path,"["+name+"-"+lastname+"]"+ext)
 
     def close(self):
-        self.preloaderArgs.put(None) # So that preloader thread exits
-        self.preloader.join() # Wait for it to finish
+        self.closePreloader()
         self.firstTiff.close()
     def indexingStatus(self):
         return 1.0
@@ -1390,28 +2080,6 @@ class TIFFSEQ(ImageSequence):
         return len(self.tiffs)
     def audioFrames(self):
         return 0
-    def preloaderMain(self):
-        while 1:
-            arg = self.preloaderArgs.get() # Will wait for a job
-            if arg==None:
-                break
-            frame = self._loadframe(arg)
-            self.preloaderResults.put((arg,frame))
-    def preloadFrame(self,index):
-        self.preloaderArgs.put(index)
-    def isPreloadedFrameAvailable(self):
-        return not self.preloaderResults.empty()
-    def nextFrame(self):
-        return self.preloaderResults.get()
-    def frame(self,index):
-        preloadedindex = -1
-        frame = None
-        while preloadedindex!=index:
-            preloadedindex,frame = self.preloaderResults.get()
-            if preloadedindex==index:
-                break
-            self.preloadFrame(index)
-        return frame
     def _loadframe(self,index,convert=True):
         if index>=0 and index<self.frames():
             filename = self.tiffs[index]
@@ -1484,11 +2152,7 @@ class RAWSEQ(ImageSequence):
 
         self.firstFrame = self._loadframe(0,convert=False)
 
-        self.preloader = threading.Thread(target=self.preloaderMain)
-        self.preloaderArgs = Queue.Queue(2)
-        self.preloaderResults = Queue.Queue(2)
-        self.preloader.daemon = True
-        self.preloader.start()
+        self.initPreloader()
         super(RAWSEQ,self).__init__(userMetadataFilename=ImageSequence.userMetadataNameFromOriginal(firstName),**kwds)
     def description(self):
         firstName = self.raws[0]
@@ -1498,8 +2162,7 @@ class RAWSEQ(ImageSequence):
         return os.path.join(self.path,"["+name+"-"+lastname+"]"+ext)
 
     def close(self):
-        self.preloaderArgs.put(None) # So that preloader thread exits
-        self.preloader.join() # Wait for it to finish
+        self.closePreloader()
     def indexingStatus(self):
         return 1.0
     def width(self):
@@ -1510,34 +2173,12 @@ class RAWSEQ(ImageSequence):
         return len(self.raws)
     def audioFrames(self):
         return 0
-    def preloaderMain(self):
-        while 1:
-            arg = self.preloaderArgs.get() # Will wait for a job
-            if arg==None:
-                break
-            frame = self._loadframe(arg)
-            self.preloaderResults.put((arg,frame))
-    def preloadFrame(self,index):
-        self.preloaderArgs.put(index)
-    def isPreloadedFrameAvailable(self):
-        return not self.preloaderResults.empty()
-    def nextFrame(self):
-        return self.preloaderResults.get()
     def make(self):
         return "Unknown"
     def model(self):
         return "Unknown"
     def bodySerialNumber(self):
         return 0
-    def frame(self,index):
-        preloadedindex = -1
-        frame = None
-        while preloadedindex!=index:
-            preloadedindex,frame = self.preloaderResults.get()
-            if preloadedindex==index:
-                break
-            self.preloadFrame(index)
-        return frame
     def _loadframe(self,index,convert=True):
         if index>=0 and index<self.frames():
             filename = self.raws[index]
@@ -1557,12 +2198,12 @@ def candidatesInDir(fn):
     fl.sort()
     return fl
 
-def loadRAWorMLV(filename,preindex=True):
+def loadRAWorMLV(filename,preindex=True,follow=False):
     fl = filename.lower()
     if fl.endswith(".raw"):
         return MLRAW(filename,preindex)
     elif fl.endswith(".mlv"):
-        return MLV(filename,preindex)
+        return MLV(filename,preindex,follow=follow)
     elif fl.endswith(".dng"):
         return CDNG(os.path.dirname(filename),preindex)
     elif fl.endswith(".tif") or fl.endswith(".tiff"):
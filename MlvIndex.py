@@ -0,0 +1,774 @@
+"""
+MlvIndex.py
+(c) Andrew Baldwin 2014
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# standard python imports
+import sys,os,mmap,struct,threading,Queue,multiprocessing,bisect
+
+import numpy as np
+
+import bitunpack
+
+# Layout of the records returned by bitunpack.scanmlv
+BLOCK_RECORD = np.dtype([('type','<u4'),('size','<u4'),('pos','<u8'),('frame','<u4'),('space','<u4')])
+
+# Entries of an XREF block
+XREF_ENTRY = np.dtype([('fileNumber','<u2'),('empty','<u2'),('offset','<u8')])
+XREF_VIDEO = 1
+XREF_AUDIO = 2
+XREF_TAIL_SLACK = 65536 # Bytes searched beyond the expected size of a trailing XREF
+
+VIDF = 0x46444956
+AUDF = 0x46445541
+
+# Threads used to scan spans in parallel
+SCAN_THREADS = multiprocessing.cpu_count()
+SCAN_BLOCKS = 4096 # Block headers per queued chunk
+
+# Map big spans piecewise when the address space is small (32bit python)
+MAP_WINDOW = 256*1024*1024
+
+class SpanMap(object):
+    """
+    Read-only memory map of one MLV span file.
+
+    Block headers are walked in C over the mapped data, so indexing
+    needs no python file calls per block. seek/read/tell are provided
+    so the map can be handed to the MLV block parsers in place of a
+    file handle.
+
+    view() hands out buffers onto the map without copying. Maps are
+    only ever dropped, never closed, so such buffers stay valid for
+    as long as they are kept.
+    """
+    def __init__(self,fh):
+        self.fh = fh
+        self.size = os.fstat(fh.fileno()).st_size
+        self.window = None # (map,base). Replaced whole so threads can share the span
+        self.windowed = sys.maxsize <= 2**32
+        self.pos = 0
+        self._map(0,0)
+    def _map(self,pos,length):
+        """
+        Make sure pos..pos+length is mapped. Returns (map,base)
+        """
+        if self.size == 0:
+            return None,0
+        window = self.window
+        if window != None and pos>=window[1] and (pos+length)<=(window[1]+len(window[0])):
+            return window
+        if not self.windowed:
+            try:
+                window = (mmap.mmap(self.fh.fileno(),0,access=mmap.ACCESS_READ),0)
+            except (mmap.error,OverflowError,MemoryError,ValueError):
+                self.windowed = True # Fall back to mapping pieces
+                return self._map(pos,length)
+        else:
+            base = pos - (pos % mmap.ALLOCATIONGRANULARITY)
+            maplen = min(max(MAP_WINDOW,pos+length-base),self.size-base)
+            window = (mmap.mmap(self.fh.fileno(),maplen,access=mmap.ACCESS_READ,offset=base),base)
+        self.window = window
+        return window
+    def close(self):
+        self.window = None # Unmapped once no views of it are left
+    def refresh(self):
+        """
+        Pick up data written to the file since it was mapped.
+        Returns True if the file has grown
+        """
+        size = os.fstat(self.fh.fileno()).st_size
+        if size <= self.size:
+            return False
+        self.size = size
+        # Drop the old map rather than closing it, in case a read
+        # on another thread is still using it
+        self.window = None
+        return True
+    def blocks(self,pos,end=None,maxblocks=256):
+        """
+        Decode up to maxblocks block headers from pos onwards.
+        Returns a BLOCK_RECORD array and the position after the last
+        complete block. A block which runs past end is not returned.
+        """
+        if end == None or end > self.size:
+            end = self.size
+        if pos+8 > end:
+            return np.zeros((0,),dtype=BLOCK_RECORD),pos
+        mm,base = self._map(pos,8)
+        if base+len(mm) < end:
+            # Window does not reach the end, so blocks crossing
+            # the window edge get picked up by the next call
+            recs,nextpos = bitunpack.scanmlv(mm,pos-base,len(mm),maxblocks)
+            if nextpos == pos-base:
+                # Next block does not fit in the window. Remap around it
+                blocksize = np.frombuffer(mm[pos-base:pos-base+8],dtype=np.uint32)[1]
+                mm,base = self._map(pos,min(int(blocksize),end-pos))
+                recs,nextpos = bitunpack.scanmlv(mm,pos-base,min(end-base,len(mm)),maxblocks)
+        else:
+            recs,nextpos = bitunpack.scanmlv(mm,pos-base,end-base,maxblocks)
+        recs = np.frombuffer(recs,dtype=BLOCK_RECORD)
+        if base != 0 and len(recs)>0:
+            recs = recs.copy()
+            recs['pos'] += base
+        return recs,nextpos+base
+    def read(self,length,pos=None):
+        """
+        Read from the current position like a file, or from pos
+        without moving the current position
+        """
+        if pos == None:
+            pos = self.pos
+            self.pos = pos+max(0,min(length,self.size-pos))
+        length = max(0,min(length,self.size-pos))
+        mm,base = self._map(pos,length)
+        if mm == None:
+            return ""
+        return mm[pos-base:pos-base+length]
+    def view(self,length,pos):
+        """
+        Like read, but returns a read-only buffer onto the map
+        instead of a copy of the data
+        """
+        length = max(0,min(length,self.size-pos))
+        mm,base = self._map(pos,length)
+        if mm == None:
+            return buffer("")
+        return buffer(mm,pos-base,length)
+    def find(self,sub,start,end):
+        """
+        Offset of the first sub string in start..end, or -1
+        """
+        while start+len(sub)<=end:
+            mm,base = self._map(start,len(sub))
+            stop = min(end,base+len(mm))
+            found = mm.find(sub,start-base,stop-base)
+            if found>=0:
+                return found+base
+            start = stop-len(sub)+1
+        return -1
+    def seek(self,pos,whence=os.SEEK_SET):
+        if whence == os.SEEK_END:
+            pos += self.size
+        elif whence == os.SEEK_CUR:
+            pos += self.pos
+        self.pos = pos
+    def tell(self):
+        return self.pos
+
+class BufferPool(object):
+    """
+    Reusable bytearrays for data that has to be copied together.
+    A buffer is handed out again once nothing but the pool refers to it
+    """
+    def __init__(self,keep=8):
+        self.buffers = []
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.allocated = 0
+        self.reused = 0
+    def get(self,size):
+        self.lock.acquire()
+        try:
+            for buf in self.buffers:
+                # References from the list, buf and getrefcount only
+                if len(buf)==size and sys.getrefcount(buf)==3:
+                    self.reused += 1
+                    return buf
+            buf = bytearray(size)
+            self.allocated += 1
+            self.buffers.append(buf)
+            if len(self.buffers)>self.keep:
+                del self.buffers[0] # Users of it keep it alive
+            return buf
+        finally:
+            self.lock.release()
+
+class SpannedFile(object):
+    """
+    A set of span files (.RAW,.R00,.R01... or MLV spans) mapped as
+    one address space.
+
+    Data within one span comes back as a buffer onto its map, with no
+    copy. Data which straddles spans is put together in a pooled buffer.
+    """
+    def __init__(self,fhs):
+        self.spans = [SpanMap(fh) for fh in fhs]
+        self.starts = []
+        self.size = 0
+        for span in self.spans:
+            self.starts.append(self.size)
+            self.size += span.size
+        self.pool = BufferPool()
+    def view(self,length,pos):
+        """
+        Read-only buffer of up to length bytes from logical position pos
+        """
+        length = max(0,min(length,self.size-pos))
+        i = bisect.bisect_right(self.starts,pos)-1
+        offset = pos-self.starts[i]
+        if offset+length <= self.spans[i].size:
+            return self.spans[i].view(length,offset)
+        buf = self.pool.get(length)
+        self.readinto(buf,pos)
+        return buffer(buf)
+    def readinto(self,buf,pos):
+        """
+        Fill buf with data from logical position pos.
+        Returns the number of bytes filled
+        """
+        done = 0
+        i = bisect.bisect_right(self.starts,pos)-1
+        offset = pos-self.starts[i]
+        while done<len(buf) and i<len(self.spans):
+            span = self.spans[i]
+            n = min(len(buf)-done,span.size-offset)
+            if n>0:
+                buf[done:done+n] = span.view(n,offset)
+                done += n
+            i += 1
+            offset = 0
+        return done
+    def close(self):
+        for span in self.spans:
+            span.close()
+
+class ParallelScanner(object):
+    """
+    Walk the blocks of several span files at the same time on a pool
+    of threads. scanmlv releases the GIL, so on storage with deep queues
+    (NVMe, RAID) each span is read on its own core.
+
+    Records come back per span in file order, for the caller to merge
+    one span after another so that metadata blocks and audio still get
+    handled in sequence.
+    """
+    def __init__(self,fhs,ranges,threads=None):
+        """
+        fhs is the list of span file handles. ranges is a list
+        of (fhi,start,end) regions to scan
+        """
+        if threads == None:
+            threads = SCAN_THREADS
+        self.fhs = fhs
+        self.stopped = False
+        self.jobs = Queue.Queue()
+        self.results = {}
+        self.scanned = {}
+        for fhi,start,end in ranges:
+            self.results[fhi] = Queue.Queue()
+            self.scanned[fhi] = 0
+            self.jobs.put((fhi,start,end))
+        self.threads = []
+        for i in range(max(1,min(threads,len(ranges)))):
+            t = threading.Thread(target=self.worker)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+    def worker(self):
+        while not self.stopped:
+            try:
+                fhi,pos,end = self.jobs.get_nowait()
+            except Queue.Empty:
+                return
+            span = SpanMap(self.fhs[fhi]) # Own map so windows can move independently
+            while pos<end and not self.stopped:
+                recs,nextpos = span.blocks(pos,end,SCAN_BLOCKS)
+                if len(recs)==0:
+                    break # Corrupt or truncated. Caller decides whether to skip the rest
+                self.results[fhi].put((recs,pos,nextpos))
+                self.scanned[fhi] += nextpos-pos
+                pos = nextpos
+            span.close()
+            self.results[fhi].put(None) # Span done
+    def next(self,fhi,timeout=None):
+        """
+        Next (records,start,end) chunk for a span, None when the span
+        is finished. Raises Queue.Empty if nothing arrives in time
+        """
+        if timeout == None:
+            return self.results[fhi].get_nowait()
+        return self.results[fhi].get(True,timeout)
+    def progress(self):
+        return sum(self.scanned.values())
+    def stop(self):
+        self.stopped = True
+        for t in self.threads:
+            t.join()
+
+def resyncVideoFrame(span,start,end,blockTypes):
+    """
+    Find the first plausible VIDF block at or after start. A match must
+    fit in the file and be followed by another known block type, so
+    "VIDF" bytes inside frame data are skipped.
+    Returns (pos,frameNumber,blockSize) or None
+    """
+    pos = start
+    while pos<end:
+        found = span.find("VIDF",pos,end)
+        if found<0:
+            return None
+        header = span.read(20,found)
+        if len(header)==20:
+            blockType,blockSize,timestamp,frameNumber = struct.unpack("<IIQI",header)
+            following = found+blockSize
+            if blockSize>=32 and following<=span.size:
+                if following+8>span.size:
+                    return found,frameNumber,blockSize # Last block in file
+                nextType,nextSize = struct.unpack("<II",span.read(8,following))
+                if nextType in blockTypes and nextSize>=8:
+                    return found,frameNumber,blockSize
+        pos = found+1
+    return None
+
+def bisectFrame(span,frame,lo,hi,blockTypes,maxProbes=32):
+    """
+    Find a video frame in an unindexed part of a span with a handful of
+    small reads. lo and hi are (frameNumber,pos) of the nearest known
+    frames either side (hi may be the end of the file). The next probe
+    position is interpolated between them, resynchronised on the next
+    VIDF signature, and the bracket narrowed on the frame number found.
+    Once the bracket is small, blocks are walked from lo.
+    Returns the block position of the frame or None
+    """
+    loFrame,loPos = lo
+    hiFrame,hiPos = hi
+    for probe in range(maxProbes):
+        if hiFrame-loFrame<=2 or hiPos-loPos<=(1<<16):
+            break
+        guess = loPos + ((frame-loFrame)*(hiPos-loPos))/(hiFrame-loFrame)
+        guess = min(max(guess,loPos+1),hiPos-1)
+        found = resyncVideoFrame(span,guess,hiPos,blockTypes)
+        if found == None:
+            if guess==loPos+1:
+                break
+            hiPos = guess # Nothing between guess and hi
+            continue
+        pos,frameNumber,blockSize = found
+        if frameNumber==frame:
+            return pos
+        elif frameNumber<frame and frameNumber>=loFrame:
+            loFrame,loPos = frameNumber,pos
+        elif frameNumber>frame and frameNumber<=hiFrame:
+            hiFrame,hiPos = frameNumber,pos
+        else:
+            break # Numbering does not fit. Walk instead
+    # Walk the blocks from the lower bound
+    pos = loPos
+    while pos<hiPos:
+        recs,nextpos = span.blocks(pos,None,256)
+        if len(recs)==0:
+            return None
+        match = recs[(recs['type']==VIDF) & (recs['frame']==frame)]
+        if len(match)>0:
+            return int(match['pos'][0])
+        pos = nextpos
+    return None
+
+def parseXrefData(xrefData):
+    """
+    Decode the body (after type and size) of an XREF block.
+    Returns the (timestamp,frameType,entryCount) header and the entries
+    """
+    header = struct.unpack("<QII",xrefData[:16])
+    count = min(header[2],(len(xrefData)-16)/XREF_ENTRY.itemsize)
+    entries = np.frombuffer(xrefData[16:16+count*XREF_ENTRY.itemsize],dtype=XREF_ENTRY)
+    return header,entries
+
+def readXrefFile(filename):
+    """
+    Read the file header and XREF block from an .IDX file
+    as written by mlv_dump and MLV App. Returns (fileHeader,xref) or None
+    """
+    fh = file(filename,'rb')
+    span = SpanMap(fh)
+    fileHeader = None
+    result = None
+    pos = 0
+    while result == None and pos<span.size:
+        recs,pos = span.blocks(pos,maxblocks=16)
+        if len(recs)==0:
+            break
+        for blockType,blockSize,blockPos,frameNumber,frameSpace in recs.tolist():
+            if blockType==0x49564c4d: # MLVI
+                fileHeader = struct.unpack("<8cQHHIHHIIII",span.read(44,blockPos+8))
+            elif blockType==0x46455258: # XREF
+                result = fileHeader,parseXrefData(span.read(blockSize-8,blockPos+8))
+                break
+    span.close()
+    fh.close()
+    return result
+
+def findTailXref(span,entries):
+    """
+    Look for an XREF block at the end of a span, where it is written
+    after the frames. Only the tail which could hold a table of about
+    entries entries is searched. Returns (header,entries) or None
+    """
+    tail = min(span.size,24+XREF_ENTRY.itemsize*entries+XREF_TAIL_SLACK)
+    start = span.size-tail
+    data = span.read(tail,start)
+    hit = data.rfind("XREF")
+    while hit>=0:
+        if hit+24<=len(data):
+            blockSize,timestamp,frameType,count = struct.unpack("<IQII",data[hit+4:hit+24])
+            # Must be a whole block ending the span, sized for its entries
+            if start+hit+blockSize==span.size and blockSize==24+XREF_ENTRY.itemsize*count:
+                return parseXrefData(data[hit+8:])
+        hit = data.rfind("XREF",0,hit)
+    return None
+
+class XrefIndex(object):
+    """
+    Frame positions taken from an XREF table. Only the block headers
+    needed to confirm a frame number are ever read, so opening a clip
+    costs nothing per frame. Audio entries of a mixed table are skipped
+    as they are met. Frame numbers of the video entries must increase
+    with entry order, which lets a missing or out-of-place frame be
+    found by bisection.
+    """
+    class Mismatch(Exception):
+        pass
+    def __init__(self,spans,fhis,entries,frameType):
+        """
+        spans is the list of SpanMaps, fhis maps MLV fileNum to span index
+        """
+        self.spans = spans
+        fhi = np.array([fhis.get(fn,-1) for fn in range(max(fhis.keys())+1)],dtype=np.int32)
+        known = entries['fileNumber']<len(fhi)
+        entries = entries[known]
+        self.fhi = fhi[entries['fileNumber']]
+        self.offset = entries['offset'].astype(np.int64)
+        self.mixed = (frameType & XREF_AUDIO) != 0
+        self.blockTypes = {} # Entry index -> block type, filled in as read
+        self.frameNumbers = {} # Entry index -> frame number, filled in as read
+    def __len__(self):
+        return len(self.offset)
+    def _readHeader(self,i):
+        """
+        Read the block header of entry i, caching its type, and its
+        frame number if it is a video frame. Raises Mismatch if the
+        entry points outside the clip
+        """
+        fhi = self.fhi[i]
+        if fhi<0:
+            raise XrefIndex.Mismatch()
+        data = self.spans[fhi].read(20,int(self.offset[i]))
+        if len(data)<20:
+            raise XrefIndex.Mismatch()
+        blockType,blockSize,timestamp,frameNumber = struct.unpack("<IIQI",data)
+        if (self.offset[i]+blockSize)>self.spans[fhi].size:
+            raise XrefIndex.Mismatch()
+        self.blockTypes[i] = blockType
+        if blockType==VIDF:
+            self.frameNumbers[i] = frameNumber
+        return blockType
+    def _videoEntry(self,i,end):
+        """
+        Index of the first video entry from i towards end (inclusive),
+        or None. Only mixed tables hold other entries
+        """
+        step = 1 if end>=i else -1
+        while i != end+step:
+            if not self.mixed:
+                return i # frameAt checks it
+            blockType = self.blockTypes.get(i,None)
+            if blockType == None:
+                blockType = self._readHeader(i)
+            if blockType==VIDF:
+                return i
+            elif blockType!=AUDF:
+                raise XrefIndex.Mismatch()
+            i += step
+        return None
+    def frameAt(self,i):
+        """
+        Read the frame number of entry i. Raises Mismatch if the
+        entry does not point at a video frame
+        """
+        if i in self.frameNumbers:
+            return self.frameNumbers[i]
+        if i in self.blockTypes or self._readHeader(i)!=VIDF:
+            raise XrefIndex.Mismatch()
+        return self.frameNumbers[i]
+    def spotCheck(self):
+        """
+        Check the first, middle and last video entries are video
+        frames in increasing order
+        """
+        n = len(self.offset)
+        if n==0:
+            return False
+        try:
+            first = self._videoEntry(0,n-1)
+            if first == None:
+                return False
+            entries = [first,self._videoEntry(n/2,first),self._videoEntry(n-1,first)]
+            checks = [self.frameAt(i) for i in sorted(set(entries))]
+        except XrefIndex.Mismatch:
+            return False
+        return checks==sorted(checks)
+    def locate(self,frame):
+        """
+        Return (fhi,offset) of the frame, or None if the table does not
+        contain it. Raises Mismatch if the table does not fit the clip
+        """
+        n = len(self.offset)
+        if n==0:
+            return None
+        lo = 0
+        hi = n-1
+        first = self._videoEntry(0,hi)
+        if first == None:
+            return None
+        # Frames are usually at the entry of the same index, unless audio is interleaved
+        if self.mixed:
+            guess = (lo+hi)/2
+        else:
+            guess = min(max(frame-self.frameAt(first),0),hi)
+        while lo<=hi:
+            video = self._videoEntry(guess,hi)
+            if video == None:
+                hi = guess-1 # Only audio from guess up
+            else:
+                found = self.frameAt(video)
+                if found==frame:
+                    return int(self.fhi[video]),int(self.offset[video])
+                elif found<frame:
+                    lo = video+1
+                else:
+                    hi = guess-1
+            guess = (lo+hi)/2
+        return None
+
+class FrameIndex(object):
+    """
+    Frame number -> (fhi,pos,metadata) table for an MLV clip, held in
+    numpy arrays instead of a dict of tuples. Metadata tuples are
+    interned so each frame only stores a small index.
+
+    Saved indexes are split in two: the arrays go into a .npy file
+    which is memory mapped when loaded, and the small parts (version,
+    span sizes and mtimes, metadata change points) are returned as a
+    dict to be kept with the other user metadata.
+    """
+    VERSION = 2
+    NOT_INDEXED = -1
+    MISSING = -2
+    MAX_FRAMES = 1<<24 # Protection against corrupt frame numbers
+    RECORD = np.dtype([('fhi','<i2'),('pos','<i8'),('size','<u4')])
+    def __init__(self,frames=0):
+        self.fhi = np.empty((0,),dtype=np.int16)
+        self.pos = np.empty((0,),dtype=np.int64)
+        self.size = np.empty((0,),dtype=np.uint32)
+        self.mdi = np.empty((0,),dtype=np.int32)
+        self.mdtable = []
+        self.mdlookup = {}
+        self.count = 0
+        self._ensure(frames)
+    def _ensure(self,frames):
+        """
+        Make the arrays writable and big enough for frames entries
+        """
+        if frames > FrameIndex.MAX_FRAMES:
+            return False
+        capacity = len(self.fhi)
+        if frames > capacity:
+            capacity = max(frames,capacity*2)
+        if capacity == len(self.fhi) and self.fhi.flags.writeable and self.pos.flags.writeable:
+            return True
+        grown = len(self.fhi)
+        fhi = np.empty((capacity,),dtype=np.int16)
+        fhi[:grown] = self.fhi
+        fhi[grown:] = FrameIndex.NOT_INDEXED
+        pos = np.zeros((capacity,),dtype=np.int64)
+        pos[:grown] = self.pos
+        size = np.zeros((capacity,),dtype=np.uint32)
+        size[:grown] = self.size
+        mdi = np.zeros((capacity,),dtype=np.int32)
+        mdi[:grown] = self.mdi
+        self.fhi,self.pos,self.size,self.mdi = fhi,pos,size,mdi
+        return True
+    def _intern(self,md):
+        mdi = self.mdlookup.get(md,None)
+        if mdi == None:
+            mdi = len(self.mdtable)
+            self.mdtable.append(md)
+            self.mdlookup[md] = mdi
+        return mdi
+    def __len__(self):
+        return self.count
+    def __contains__(self,frame):
+        return frame>=0 and frame<len(self.fhi) and self.fhi[frame]!=FrameIndex.NOT_INDEXED
+    def __getitem__(self,frame):
+        if frame not in self:
+            raise KeyError(frame)
+        fhi = self.fhi[frame]
+        if fhi == FrameIndex.MISSING:
+            return (None,None,None)
+        return (int(fhi),int(self.pos[frame]),self.mdtable[self.mdi[frame]])
+    def __setitem__(self,frame,value):
+        fhi,pos,md = value
+        if fhi == None:
+            self.set(frame,FrameIndex.MISSING,0,0,md)
+        else:
+            self.set(frame,fhi,pos,0,md)
+    def set(self,frame,fhi,pos,size,md):
+        if frame<0 or not self._ensure(frame+1):
+            return
+        if self.fhi[frame] == FrameIndex.NOT_INDEXED:
+            self.count += 1
+        self.fhi[frame] = fhi
+        self.pos[frame] = pos
+        self.size[frame] = size
+        self.mdi[frame] = self._intern(md)
+    def addRun(self,frames,fhi,pos,size,md):
+        """
+        Add a run of frames from the same file which share metadata
+        """
+        if len(frames)==0:
+            return
+        keep = frames < FrameIndex.MAX_FRAMES
+        if not keep.all():
+            frames,pos,size = frames[keep],pos[keep],size[keep]
+            if len(frames)==0:
+                return
+        self._ensure(int(frames.max())+1)
+        new = np.unique(frames[self.fhi[frames]==FrameIndex.NOT_INDEXED])
+        self.count += len(new)
+        self.fhi[frames] = fhi
+        self.pos[frames] = pos
+        self.size[frames] = size
+        self.mdi[frames] = self._intern(md)
+    def neighbours(self,frame,fhi):
+        """
+        (frame,pos) of the nearest indexed frames from span fhi
+        before and after frame. Either may be None
+        """
+        n = len(self.fhi)
+        lo = None
+        hi = None
+        below = np.flatnonzero(self.fhi[:min(frame,n)]==fhi)
+        if len(below)>0:
+            lo = (int(below[-1]),int(self.pos[below[-1]]))
+        if frame+1<n:
+            above = np.flatnonzero(self.fhi[frame+1:]==fhi)
+            if len(above)>0:
+                f = int(above[0])+frame+1
+                hi = (f,int(self.pos[f]))
+        return lo,hi
+    def frames(self):
+        """
+        Frame numbers that have been indexed
+        """
+        return np.flatnonzero(self.fhi!=FrameIndex.NOT_INDEXED)
+    @staticmethod
+    def fromDict(framepos):
+        """
+        Convert an old (frameIndex_v1) dict based index
+        """
+        index = FrameIndex(len(framepos))
+        for frame,value in framepos.iteritems():
+            index[frame] = value
+        return index
+    def save(self,filename,spans):
+        """
+        Write the arrays to filename and return the rest of the index
+        """
+        n = 0
+        indexed = self.frames()
+        if len(indexed)>0:
+            n = int(indexed[-1])+1
+        records = np.empty((n,),dtype=FrameIndex.RECORD)
+        records['fhi'] = self.fhi[:n]
+        records['pos'] = self.pos[:n]
+        records['size'] = self.size[:n]
+        mdi = self.mdi[:n]
+        if n>0:
+            changes = np.flatnonzero(np.diff(mdi))+1
+            changes = np.concatenate(([0],changes)).astype(np.int32)
+        else:
+            changes = np.empty((0,),dtype=np.int32) # No frames indexed yet
+        tempname = filename+".tmp"
+        f = file(tempname,'wb')
+        np.save(f,records)
+        f.close()
+        if os.path.exists(filename):
+            os.remove(filename) # Needed for rename on windows
+        os.rename(tempname,filename)
+        return {"version":FrameIndex.VERSION,
+                "frames":n,
+                "count":self.count,
+                "spans":spans,
+                "changeFrames":changes.tolist(),
+                "changeMetadata":mdi[changes].tolist(),
+                "metadata":self.mdtable}
+    @staticmethod
+    def load(filename,info,spans,growing=False):
+        """
+        Map a saved index. Returns None if it does not fit the spans.
+        If growing, an index of an earlier, shorter state of the spans
+        is also accepted so indexing can carry on from it
+        """
+        if info.get("version",None)!=FrameIndex.VERSION:
+            return None
+        if info["spans"]!=spans and not (growing and spansGrown(info["spans"],spans)):
+            return None
+        if not os.path.exists(filename):
+            return None
+        records = np.load(filename,mmap_mode='r')
+        n = info["frames"]
+        if records.shape!=(n,) or records.dtype!=FrameIndex.RECORD:
+            return None
+        index = FrameIndex()
+        index.fhi = records['fhi']
+        index.pos = records['pos']
+        index.size = records['size']
+        changes = np.array(info["changeFrames"],dtype=np.int64)
+        lengths = np.diff(np.concatenate((changes,[n])))
+        index.mdi = np.repeat(info["changeMetadata"],lengths).astype(np.int32)
+        index.mdtable = list(info["metadata"])
+        index.mdlookup = dict([(md,i) for i,md in enumerate(index.mdtable)])
+        index.count = info["count"]
+        return index
+
+def spanSignature(filenames):
+    """
+    Names, sizes and modification times of the span files, used to
+    notice when a saved index no longer matches the clip
+    """
+    signature = []
+    for name in filenames:
+        st = os.stat(name)
+        signature.append((os.path.basename(name),st.st_size,st.st_mtime))
+    return signature
+
+def spansGrown(saved,current):
+    """
+    True if the spans in a saved signature have only been appended
+    to (or more spans added) since, as when a clip is still being copied
+    """
+    if len(current)<len(saved):
+        return False
+    for (name,size,mtime),(curname,cursize,curmtime) in zip(saved,current):
+        if name!=curname or cursize<size:
+            return False
+    return True
@@ -34,6 +34,7 @@ PLOG_CPU = PerformanceLog.PLOG_TYPE(2,"CPU")
 PLOG_GPU = PerformanceLog.PLOG_TYPE(3,"GPU")
 
 import MlRaw
+import FrameCache
 import GLCompute
 import GLComputeUI as ui
 import ExportQueue
@@ -72,7 +73,9 @@ class Viewer(GLCompute.GLCompute):
         self.neededFrame = 0
         self.drawnFrameNumber = None
         self.playFrame = None #self.raw.firstFrame
-        self.frameCache = {} # {0:self.raw.firstFrame}
+        frameCacheBytes = config.getState("frameCacheBytes")
+        if frameCacheBytes == None: frameCacheBytes = FrameCache.DEFAULT_BUDGET
+        self.frameCache = FrameCache.FrameCache(frameCacheBytes)
         self.preloadingFrame = []
         self.preloadingFrames = []
         #self.preloadFrame(1) # Immediately try to preload the next frame
@@ -126,6 +129,8 @@ class Viewer(GLCompute.GLCompute):
         if self.setting_encodeType == None: self.setting_encodeType = (ENCODE_TYPE_MOV,)
         self.setting_histogram = config.getState("histogramType")
         if self.setting_histogram == None: self.setting_histogram = 0
+        self.setting_follow = config.getState("followGrowingClips") # Keep indexing clips still being copied
+        if self.setting_follow == None: self.setting_follow = False
         self.svbo = None
         self.svbostatic = None
         self.fpsMeasure = None
@@ -165,7 +170,7 @@ class Viewer(GLCompute.GLCompute):
         if self.dialog:
             self.dialog.removeThumb(newname)
         try:
-            r = MlRaw.loadRAWorMLV(newname)
+            r = MlRaw.loadRAWorMLV(newname,follow=self.setting_follow)
         except:
             import traceback
             traceback.print_exc()
@@ -187,7 +192,7 @@ class Viewer(GLCompute.GLCompute):
             if self.dialog:
                 self.dialog.removeThumb(newname)
             try:
-                r = MlRaw.loadRAWorMLV(newname)
+                r = MlRaw.loadRAWorMLV(newname,follow=self.setting_follow)
                 found = True
             except:
                 pass
@@ -218,16 +223,19 @@ class Viewer(GLCompute.GLCompute):
         if self.raw:
             self.raw.close()
         self.raw = raw
+        self.raw.decodeWindow = self.decodeWindow()
         if self.raw.frames()>1:
             self.raw.preloadFrame(1)
             self.playFrame = self.raw.frame(1)
-            self.frameCache = {1:self.playFrame}
+            self.frameCache.clear()
+            self.frameCache[1] = self.playFrame
             self.playFrameNumber = 1
             self.nextFrameNumber = 1
             self.neededFrame = 1
         else:
             self.playFrame = self.raw.firstFrame
-            self.frameCache = {0:self.raw.firstFrame}
+            self.frameCache.clear()
+            self.frameCache[0] = self.raw.firstFrame
             self.playFrameNumber = 0
             self.nextFrameNumber = 0
             self.neededFrame = 0
@@ -268,7 +276,7 @@ class Viewer(GLCompute.GLCompute):
             if self.browser:
                 self.toggleBrowser()
         else:
-            r = MlRaw.loadRAWorMLV(fn)
+            r = MlRaw.loadRAWorMLV(fn,follow=self.setting_follow)
             if r:
                 self.loadSet(r,fn)
             if self.browser:
@@ -524,7 +532,10 @@ class Viewer(GLCompute.GLCompute):
                 self.toggleLutImport()
 
         elif k==self.KEY_G:
-            self.loadBalance()
+            if m==0:
+                self.loadBalance()
+            elif m==1:
+                self.toggleFollow()
         elif k==self.KEY_H:
             if m==0:
                 self.saveBalance()
@@ -805,7 +816,18 @@ class Viewer(GLCompute.GLCompute):
     def toggleStripes(self):
         self.setting_preprocess = not self.setting_preprocess
         config.setState("preprocess",self.setting_preprocess)
+        # Frames decoded for the old setting cover the wrong rows
+        self.raw.decodeWindow = self.decodeWindow()
+        self.frameCache.clear()
+        self.playFrame = self.raw.frame(self.playFrameNumber)
+        self.frameCache[self.playFrameNumber] = self.playFrame
         self.refresh()
+    def decodeWindow(self):
+        # Only the active area is shown, so only that needs decoding.
+        # Stripe correction measures the whole frame though
+        if self.setting_preprocess:
+            return None
+        return self.raw.activeWindow()
     def toggleAnamorphic(self):
         self.anamorphic = not self.anamorphic
         self.refresh()
@@ -823,6 +845,12 @@ class Viewer(GLCompute.GLCompute):
         self.setting_loop = not self.setting_loop
         config.setState("loopPlayback",self.setting_loop)
         self.refresh()
+    def toggleFollow(self):
+        self.setting_follow = not self.setting_follow
+        config.setState("followGrowingClips",self.setting_follow)
+        if not self.setting_follow and getattr(self.raw,"following",False):
+            self.raw.stopFollowing() # Index the clip as it is now
+        self.refresh()
     def toggleDropFrames(self):
         self.setting_dropframes = not self.setting_dropframes
         if self.setting_dropframes:
@@ -1328,26 +1356,19 @@ class Viewer(GLCompute.GLCompute):
             if len(self.preloadingFrames)==0:
                 return
             nextindex = self.preloadingFrames.pop() # Last in list
-        if len(self.preloadingFrame) == 2:
-            return # Don't preload more than 2 frames
+        if len(self.preloadingFrame) >= self.raw.preloadDepth():
+            return # Don't preload more frames than the sequence loads at once
         self.preloadingFrame.append(nextindex)
         #print "preloading",index
         PLOG(PLOG_FRAME,"Calling preload for frame %d"%nextindex)
         self.raw.preloadFrame(nextindex)
         PLOG(PLOG_FRAME,"Returned from preload for frame %d"%nextindex)
     def manageFrameCache(self):
-        if len(self.frameCache)>10: # Cache 10 frames at most
-            # Don't remove currently showing frame
-            indexes = [k for k in self.frameCache.keys() if k != self.playFrameNumber]
-            indexes.sort()
-            #print indexes
-            if indexes[0] < self.neededFrame:
-                # Remove the one furthest behind the current frame number
-                PLOG(PLOG_FRAME,"Calling head %d from frame cache"%indexes[0])
-                del self.frameCache[indexes[0]]
-            else: # Otherwise delete the last one
-                PLOG(PLOG_FRAME,"Calling tip %d from frame cache"%indexes[-1])
-                del self.frameCache[indexes[-1]]
+        # Don't remove currently showing frame, or the frames at marks
+        pinned = [self.playFrameNumber]
+        if getattr(self,"marks",None):
+            pinned.extend([frame for frame,mt in self.marks])
+        self.frameCache.trim(self.neededFrame,pinned)
     def manageFrameLoading(self):
         if self.neededFrame != None:
             #print "looking for neededFrame",self.neededFrame
@@ -1370,7 +1391,8 @@ class Viewer(GLCompute.GLCompute):
         if len(self.preloadingFrame) > 0:
             if self.raw.isPreloadedFrameAvailable():
                 frameIndex,preloadedFrame = self.raw.nextFrame()
-                self.preloadingFrame.remove(frameIndex)
+                if frameIndex in self.preloadingFrame:
+                    self.preloadingFrame.remove(frameIndex)
                 PLOG(PLOG_FRAME,"Received preloaded frame %d"%frameIndex)
                 # Add it to the cache
                 self.frameCache[frameIndex] = preloadedFrame
@@ -1507,9 +1529,9 @@ class Viewer(GLCompute.GLCompute):
             f2 = f[:bufsize].reshape(self.raw.height(),self.raw.width(),3)
             bx = int(x)
             by = int(y)
-            red = f2[by,bx,0]
-            green = (f2[by,bx,1]+f2[by,bx,1])/2
-            blue = f2[by,bx,2]
+            red = float(f2[by,bx,0])
+            green = float(f2[by,bx,1])
+            blue = float(f2[by,bx,2])
             haveColour = True
         if haveColour:
             red = red/self.playFrame.rawwbal[0]
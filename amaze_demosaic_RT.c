@@ -267,7 +267,7 @@ struct s_hv {
 
 #define CLF 1
 	// assign working space
-	buffer = (char *) malloc(29*sizeof(float)*TS*TS - sizeof(float)*TS*TSH + sizeof(char)*TS*TSH+24*CLF*64);
+	buffer = (char *) calloc(1,29*sizeof(float)*TS*TS - sizeof(float)*TS*TSH + sizeof(char)*TS*TSH+24*CLF*64);
 	char 	*data;
     data = (char*)( ( (uintptr_t)(buffer) + (uintptr_t)(63)) / 64 * 64);
 
@@ -530,22 +530,23 @@ struct s_hv {
 			}
 */
 			//also, fill the image corners
+			// Not vectorised: the corners are mirrored, and 4 wide loads
+			// from winx+width-2 would read past the window into pixels
+			// which another tile may be working on at the same time
 			if (rrmin>0 && ccmin>0) {
 				for (rr=0; rr<16; rr++)
-					for (cc=0; cc<16; cc+=4) {
-						indx1 = (rr)*TS+cc;
-						tempv = LVFU(rawData[winy+32-rr][winx+32-cc]) / d65535v;
-						_mm_store_ps( &cfa[indx1], tempv );
-						_mm_store_ps( &rgbgreen[indx1], tempv );
+					for (cc=0; cc<16; cc++) {
+						cfa[(rr)*TS+cc] = (rawData[winy+32-rr][winx+32-cc])/65535.0f;
+						if(FC(rr,cc)==1)
+							rgbgreen[(rr)*TS+cc] = cfa[(rr)*TS+cc];
 					}
 			}
 			if (rrmax<rr1 && ccmax<cc1) {
 				for (rr=0; rr<16; rr++)
-					for (cc=0; cc<16; cc+=4) {
-						indx1 = (rrmax+rr)*TS+ccmax+cc;
-						tempv = LVFU(rawData[(winy+height-rr-2)][(winx+width-cc-2)]) / d65535v;
-						_mm_storeu_ps( &cfa[indx1], tempv );
-						_mm_storeu_ps( &rgbgreen[indx1], tempv );
+					for (cc=0; cc<16; cc++) {
+						cfa[(rrmax+rr)*TS+ccmax+cc] = (rawData[(winy+height-rr-2)][(winx+width-cc-2)])/65535.0f;
+						if(FC(rr,cc)==1)
+							rgbgreen[(rrmax+rr)*TS+ccmax+cc] = cfa[(rrmax+rr)*TS+ccmax+cc];
 					}
 			}
 			if (rrmin>0 && ccmax<cc1) {
@@ -1,6 +1,11 @@
 #include <Python.h>
+#include <stdint.h>
+#include <string.h>
 
 #include "liblj92/lj92.h"
+#include "unpack_simd.h"
+#include "workpool.h"
+#include "demosaic_fast.h"
 
 void demosaic(
     float** rawData,    /* holds preprocessed pixel values, rawData[i][j] corresponds to the ith row and jth column */
@@ -211,6 +216,8 @@ bitunpack_demosaic16(PyObject* self, PyObject *args)
 typedef struct _demosaicer {
     int width;
     int height;
+    int outwidth; /* Size of the RGB planes from the last demosaic */
+    int outheight;
     float* raw;
     float** rrows;
     float* red;
@@ -252,6 +259,8 @@ bitunpack_demosaicer(PyObject* self, PyObject *args)
     demosaicer* dem = (demosaicer*)calloc(1,sizeof(demosaicer));
     dem->width = width;
     dem->height = height;
+    dem->outwidth = width;
+    dem->outheight = height;
     dem->raw = (float*)malloc(elements*sizeof(float));
     dem->rrows = (float**)malloc(dem->height*sizeof(float*));
     int rr = 0;
@@ -277,6 +286,29 @@ bitunpack_demosaicer(PyObject* self, PyObject *args)
     return PyCapsule_New(dem,DEMOSAICER_NAME,bitunpack_freedemosaicer);
 }
 
+static int unpackLevel = UNPACK_SCALAR;
+
+static PyObject*
+bitunpack_predemosaicn(PyObject* demosaicerobj, unsigned const char* input, int length, int width, int height, int black, int bits, int byteSwap)
+{
+    demosaicer* dem = (demosaicer*)PyCapsule_GetPointer(demosaicerobj,DEMOSAICER_NAME);
+    if (dem == NULL)
+        return NULL;
+    if (dem->width != width || dem->height != height) {
+        PyErr_SetString(PyExc_ValueError, "Demosaicer is for a different size");
+        return NULL;
+    }
+    if (bits!=10 && bits!=12 && bits!=14 && bits!=16) {
+        PyErr_Format(PyExc_ValueError, "Unsupported bit depth %d", bits);
+        return NULL;
+    }
+    int level = unpackLevel;
+    Py_BEGIN_ALLOW_THREADS;
+    unpack_tofloat(input,length,dem->raw,width*height,bits,byteSwap,black,level);
+    Py_END_ALLOW_THREADS;
+    Py_RETURN_NONE;
+}
+
 static PyObject*
 bitunpack_predemosaic12(PyObject* self, PyObject *args)
 {
@@ -289,53 +321,8 @@ bitunpack_predemosaic12(PyObject* self, PyObject *args)
     PyObject* demosaicerobj;
     if (!PyArg_ParseTuple(args, "Ot#iiii", &demosaicerobj, &input, &length, &width, &height, &black, &byteSwap))
         return NULL;
-    demosaicer* dem = (demosaicer*)PyCapsule_GetPointer(demosaicerobj,DEMOSAICER_NAME);
-    if (dem == NULL)
-        return NULL;
-    if (dem->width != width || dem->height != height)
-        return NULL;
-
-    int elements = (width*height*3)/2;
-    int i = 0;
-    unsigned int out = 0;
-    unsigned char* read = (unsigned char*)input;
-    float* write = dem->raw;
-
-    Py_BEGIN_ALLOW_THREADS;
-    while (i<elements) {
-        unsigned int r1 = *read++;
-        unsigned int r2 = *read++;
-        unsigned int r3 = *read++;
-        out = (r1<<4)|(r2>>4);
-        if (out==0) { // Dead pixel masking
-            float old = *(write-2);
-            *write++ = old;
-        } else {
-            int ival = out-black;
-            // To avoid artifacts from demosaicing at low levels
-            ival += 15.0;
-            if (ival<15) ival=15; // Don't want log2(0)
-
-            float val = (float)ival;//64.0*log2((float)ival);
-            *write++ = val;
-        }
-        out = ((r2&0xF)<<8)|r3;
-        if (out==0) { // Dead pixel masking
-            float old = *(write-2);
-            *write++ = old;
-        } else {
-            int ival = out-black;
-            // To avoid artifacts from demosaicing at low levels
-            ival += 15.0;
-            if (ival<15) ival=15; // Don't want log2(0)
-
-            float val = (float)ival;//64.0*log2((float)ival);
-            *write++ = val;
-        }
-        i+=3;
-    }
-    Py_END_ALLOW_THREADS;
-    Py_RETURN_NONE;
+    // 12bit data is always a big endian byte stream
+    return bitunpack_predemosaicn(demosaicerobj,input,length,width,height,black,12,1);
 }
 
 static PyObject*
@@ -350,52 +337,7 @@ bitunpack_predemosaic14(PyObject* self, PyObject *args)
     PyObject* demosaicerobj;
     if (!PyArg_ParseTuple(args, "Ot#iiii", &demosaicerobj, &input, &length, &width, &height, &black, &byteSwap))
         return NULL;
-    demosaicer* dem = (demosaicer*)PyCapsule_GetPointer(demosaicerobj,DEMOSAICER_NAME);
-    if (dem == NULL)
-        return NULL;
-    if (dem->width != width || dem->height != height)
-        return NULL;
-
-    int elements = width * height;
-    int i = 0;
-    int sparebits = 0;
-    unsigned int acc = 0;
-    unsigned int out = 0;
-    short unsigned int* read = (short unsigned int*)input;
-    float* write = dem->raw;
-
-    Py_BEGIN_ALLOW_THREADS;
-    while (i<elements) {
-        if (sparebits<14) {
-            short unsigned int r = *read++;
-            if (byteSwap) 
-                r = (r&0xFF00)>>8 | ((r&0x00FF)<<8);
-            acc |= r;
-            sparebits += 2;
-            out = (acc>>sparebits)&0x3FFF;
-        } else {
-            sparebits += 2;
-            out = (acc>>sparebits)&0x3FFF;
-            sparebits = 0;
-            acc = 0;
-        }
-        if (out==0) { // Dead pixel masking
-            float old = *(write-2);
-            *write++ = old;
-        } else {
-            int ival = out-black;
-            // To avoid artifacts from demosaicing at low levels
-            ival += 15.0;
-            if (ival<15) ival=15; // Don't want log2(0)
-
-            float val = (float)ival;//64.0*log2((float)ival);
-            *write++ = val;
-        }
-        acc = (acc&((1<<sparebits)-1))<<16;
-        i++;
-    }
-    Py_END_ALLOW_THREADS;
-    Py_RETURN_NONE;
+    return bitunpack_predemosaicn(demosaicerobj,input,length,width,height,black,14,byteSwap);
 }
 
 static PyObject*
@@ -410,41 +352,23 @@ bitunpack_predemosaic16(PyObject* self, PyObject *args)
     PyObject* demosaicerobj;
     if (!PyArg_ParseTuple(args, "Ot#iiii", &demosaicerobj, &input, &length, &width, &height, &black, &byteSwap))
         return NULL;
-    demosaicer* dem = (demosaicer*)PyCapsule_GetPointer(demosaicerobj,DEMOSAICER_NAME);
-    if (dem == NULL)
-        return NULL;
-    if (dem->width != width || dem->height != height)
-        return NULL;
-
-    int elements = width*height;
-    int i = 0;
-    unsigned int out = 0;
-    short unsigned int* read = (short unsigned int*)input;
-    float* write = dem->raw;
-    //printf("Decoding frame\n");
-
-    Py_BEGIN_ALLOW_THREADS;
-    while (i<elements) {
-        short unsigned int r = *read++;
-        if (byteSwap)
-            r = (r&0xFF00)>>8 | ((r&0x00FF)<<8);
-        out = r;
-        if (out==0) { // Dead pixel masking
-            float old = *(write-2);
-            *write++ = old;
-        } else {
-            int ival = out-black;
-            // To avoid artifacts from demosaicing at low levels
-            ival += 15.0;
-            if (ival<15) ival=15; // Don't want log2(0)
+    return bitunpack_predemosaicn(demosaicerobj,input,length,width,height,black,16,byteSwap);
+}
 
-            float val = (float)ival;//64.0*log2((float)ival);
-            *write++ = val;
-        }
-        i++;
-    }
-    Py_END_ALLOW_THREADS;
-    Py_RETURN_NONE;
+static PyObject*
+bitunpack_predemosaicbits(PyObject* self, PyObject *args)
+{
+    unsigned const char* input = 0;
+    int length = 0;
+    int width = 0;
+    int height = 0;
+    int black = 2000;
+    int bits = 14;
+    int byteSwap = 0;
+    PyObject* demosaicerobj;
+    if (!PyArg_ParseTuple(args, "Ot#iiiii", &demosaicerobj, &input, &length, &width, &height, &black, &bits, &byteSwap))
+        return NULL;
+    return bitunpack_predemosaicn(demosaicerobj,input,length,width,height,black,bits,byteSwap);
 }
 
 static PyObject*
@@ -462,69 +386,246 @@ bitunpack_demosaic(PyObject* self, PyObject *args)
     if (dem == NULL)
         return NULL;
 
+    dem->outwidth = dem->width;
+    dem->outheight = dem->height;
     Py_BEGIN_ALLOW_THREADS;
     demosaic(dem->rrows,dem->redrows,dem->greenrows,dem->bluerows,x,y,width,height,cfa);
     Py_END_ALLOW_THREADS;
     Py_RETURN_NONE;
 }
 
+/* AMaZE mirrors 32 pixels into each tile for its borders */
+#define AMAZE_MIN_TILE 34
+
+typedef struct {
+    demosaicer* dem;
+    const int* tiles; /* x,y,width,height for each */
+    int cfa;
+} demosaicjob;
+
+static void
+demosaic_tile(void* ctx, int item, int worker)
+{
+    demosaicjob* job = (demosaicjob*)ctx;
+    const int* t = job->tiles + item*4;
+    demosaicer* dem = job->dem;
+    demosaic(dem->rrows,dem->redrows,dem->greenrows,dem->bluerows,t[0],t[1],t[2],t[3],job->cfa);
+}
+
+static PyObject*
+bitunpack_demosaictiles(PyObject* self, PyObject *args)
+{
+    PyObject* demosaicerobj;
+    PyObject* tilesobj;
+    int cfa = 0;
+    int threads = 1;
+    if (!PyArg_ParseTuple(args, "OOii", &demosaicerobj, &tilesobj, &cfa, &threads))
+        return NULL;
+    demosaicer* dem = (demosaicer*)PyCapsule_GetPointer(demosaicerobj,DEMOSAICER_NAME);
+    if (dem == NULL)
+        return NULL;
+    PyObject* seq = PySequence_Fast(tilesobj,"tiles must be a sequence of (x,y,width,height)");
+    if (seq == NULL)
+        return NULL;
+    int count = PySequence_Fast_GET_SIZE(seq);
+    int* tiles = (int*)malloc((count+1)*4*sizeof(int));
+    if (tiles == NULL) {
+        Py_DECREF(seq);
+        return PyErr_NoMemory();
+    }
+    int i;
+    for (i=0;i<count;i++) {
+        int* t = tiles + i*4;
+        if (!PyArg_ParseTuple(PySequence_Fast_GET_ITEM(seq,i),"iiii;tiles must be a sequence of (x,y,width,height)",t,t+1,t+2,t+3)) {
+            free(tiles);
+            Py_DECREF(seq);
+            return NULL;
+        }
+        if (t[0]<0 || t[1]<0 || t[2]<=0 || t[3]<=0 || t[0]+t[2]>dem->width || t[1]+t[3]>dem->height) {
+            PyErr_SetString(PyExc_ValueError,"tile outside the demosaicer frame");
+            free(tiles);
+            Py_DECREF(seq);
+            return NULL;
+        }
+        if (t[2]<AMAZE_MIN_TILE || t[3]<AMAZE_MIN_TILE) {
+            PyErr_SetString(PyExc_ValueError,"tile too small to demosaic");
+            free(tiles);
+            Py_DECREF(seq);
+            return NULL;
+        }
+    }
+    Py_DECREF(seq);
+    demosaicjob job;
+    job.dem = dem;
+    job.tiles = tiles;
+    job.cfa = cfa;
+    dem->outwidth = dem->width;
+    dem->outheight = dem->height;
+    Py_BEGIN_ALLOW_THREADS;
+    workpool_run(threads,count,demosaic_tile,&job);
+    Py_END_ALLOW_THREADS;
+    free(tiles);
+    Py_RETURN_NONE;
+}
+
+/* Output rows in each unit of fast demosaic work */
+#define DEMOSAIC_FAST_BAND 32
+
+typedef struct {
+    demosaicer* dem;
+    int method;
+    int cfa;
+    int first;
+    int end;
+} demosaicfastjob;
+
+static void
+demosaic_fast_band(void* ctx, int item, int worker)
+{
+    demosaicfastjob* job = (demosaicfastjob*)ctx;
+    demosaicer* dem = job->dem;
+    int first = job->first+item*DEMOSAIC_FAST_BAND;
+    int count = job->end-first;
+    if (count>DEMOSAIC_FAST_BAND)
+        count = DEMOSAIC_FAST_BAND;
+    demosaic_fast_rows(job->method,dem->rrows,dem->red,dem->green,dem->blue,dem->width,dem->height,job->cfa,first,count);
+}
+
+static PyObject*
+bitunpack_demosaicfast(PyObject* self, PyObject *args)
+{
+    PyObject* demosaicerobj;
+    int method = 0;
+    int cfa = 0;
+    int threads = 1;
+    int first = 0;
+    int rows = -1;
+    if (!PyArg_ParseTuple(args, "Oiii|ii", &demosaicerobj, &method, &cfa, &threads, &first, &rows))
+        return NULL;
+    demosaicer* dem = (demosaicer*)PyCapsule_GetPointer(demosaicerobj,DEMOSAICER_NAME);
+    if (dem == NULL)
+        return NULL;
+    int outwidth,outheight;
+    if (!demosaic_fast_size(method,dem->width,dem->height,&outwidth,&outheight)) {
+        PyErr_SetString(PyExc_ValueError,"Unknown fast demosaic method");
+        return NULL;
+    }
+    if (dem->width<2 || dem->height<2) {
+        PyErr_SetString(PyExc_ValueError,"Frame too small to demosaic");
+        return NULL;
+    }
+    if (rows<0)
+        rows = outheight-first;
+    if (first<0 || rows<0 || first+rows>outheight) {
+        PyErr_SetString(PyExc_ValueError,"Rows outside the demosaiced frame");
+        return NULL;
+    }
+    demosaicfastjob job;
+    job.dem = dem;
+    job.method = method;
+    job.cfa = cfa;
+    job.first = first;
+    job.end = first+rows;
+    dem->outwidth = outwidth;
+    dem->outheight = outheight;
+    Py_BEGIN_ALLOW_THREADS;
+    workpool_run(threads,(rows+DEMOSAIC_FAST_BAND-1)/DEMOSAIC_FAST_BAND,demosaic_fast_band,&job);
+    Py_END_ALLOW_THREADS;
+    return Py_BuildValue("ii",outwidth,outheight);
+}
+
 static PyObject*
 bitunpack_postdemosaic(PyObject* self, PyObject *args)
 {
     PyObject* demosaicerobj;
-    if (!PyArg_ParseTuple(args, "O", &demosaicerobj))
+    char format = 'f';
+    float scale = 1.0f;
+    if (!PyArg_ParseTuple(args, "O|cf", &demosaicerobj, &format, &scale))
         return NULL;
     demosaicer* dem = (demosaicer*)PyCapsule_GetPointer(demosaicerobj,DEMOSAICER_NAME);
     if (dem == NULL)
         return NULL;
+    // Formats are numpy dtype chars: float32, uint16 (rounded, clamped), float16
+    int size;
+    if (format=='f') size = 4;
+    else if (format=='H' || format=='e') size = 2;
+    else {
+        PyErr_SetString(PyExc_ValueError,"format must be 'f' (float32), 'H' (uint16) or 'e' (float16)");
+        return NULL;
+    }
 
-    PyObject* ba = PyByteArray_FromStringAndSize("",0);
-    int elements = dem->width * dem->height;
-    int resres = PyByteArray_Resize(ba,elements*12); // Demosaiced as RGB 32bit float data
-    if (resres < 0) return NULL;
-    // Now interleave into final RGB float array
-    float* outptr = (float*)PyByteArray_AS_STRING(ba);
+    int elements = dem->outwidth * dem->outheight;
+    PyObject* ba = PyByteArray_FromStringAndSize(NULL,(Py_ssize_t)elements*3*size); // Demosaiced as interleaved RGB
+    if (ba == NULL) return NULL;
     float* rptr = dem->red;
     float* gptr = dem->green;
     float* bptr = dem->blue;
     int rr;
-    for (rr=0;rr<elements;rr++) {
-           *outptr++ = (*rptr++);
-           *outptr++ = (*gptr++);
-           *outptr++ = (*bptr++);
+    // The demosaicer belongs to the caller, so other frames can go on meanwhile
+    Py_BEGIN_ALLOW_THREADS;
+    if (format=='f') {
+        float* outptr = (float*)PyByteArray_AS_STRING(ba);
+        if (scale==1.0f) {
+            for (rr=0;rr<elements;rr++) {
+                *outptr++ = (*rptr++);
+                *outptr++ = (*gptr++);
+                *outptr++ = (*bptr++);
+            }
+        } else {
+            for (rr=0;rr<elements;rr++) {
+                *outptr++ = (*rptr++)*scale;
+                *outptr++ = (*gptr++)*scale;
+                *outptr++ = (*bptr++)*scale;
+            }
+        }
+    } else if (format=='H') {
+        unpack_rgb_uint16(rptr,gptr,bptr,(uint16_t*)PyByteArray_AS_STRING(ba),elements,scale,unpackLevel);
+    } else {
+        unpack_rgb_half(rptr,gptr,bptr,(uint16_t*)PyByteArray_AS_STRING(ba),elements,scale,unpackLevel);
     }
+    Py_END_ALLOW_THREADS;
     return ba;
 }
 
+/*
+ * Find where to write results. With no out object a new bytearray is made.
+ * Otherwise out can be anything with a writable buffer (bytearray,
+ * numpy array...) of at least size bytes.
+ */
 static PyObject*
-bitunpack_unpack12to16(PyObject* self, PyObject *args)
+bitunpack_output(PyObject* out, Py_ssize_t size, char** outptr)
 {
-    unsigned const char* input = 0;
-    int length = 0;
-    int byteSwap = 0;
-    if (!PyArg_ParseTuple(args, "t#i", &input, &length, &byteSwap))
+    if (out==NULL || out==Py_None) {
+        PyObject* ba = PyByteArray_FromStringAndSize(NULL,size);
+        if (ba==NULL)
+            return NULL;
+        *outptr = PyByteArray_AS_STRING(ba);
+        return ba;
+    }
+    void* buf = NULL;
+    Py_ssize_t buflen = 0;
+    if (PyObject_AsWriteBuffer(out,&buf,&buflen)<0)
+        return NULL;
+    if (buflen<size) {
+        PyErr_Format(PyExc_ValueError, "Output buffer too small (%zd bytes, need %zd)", buflen, size);
         return NULL;
-    PyObject* ba = PyByteArray_FromStringAndSize("",0);
-    int elements = length;
-    PyByteArray_Resize(ba,(elements*4)/3);
-    unsigned char* baptr = (unsigned char*)PyByteArray_AS_STRING(ba);
-    int i = 0;
-    unsigned int out = 0;
-    unsigned char* read = (unsigned char*)input;
-    short unsigned int* write = (short unsigned int*)baptr;
-    Py_BEGIN_ALLOW_THREADS;
-    while (i<elements) {
-        unsigned char r1 = *read++;
-        unsigned char r2 = *read++;
-        unsigned char r3 = *read++;
-        out = (r1<<4)|(r2>>4);
-        if (out==0) out = *(write-2); // Dead pixel masking
-        *write++ = out;
-        out = ((r2&0xF)<<8)|r3;
-        if (out==0) out = *(write-2); // Dead pixel masking
-        *write++ = out;
-        i+=3;
     }
+    *outptr = (char*)buf;
+    Py_INCREF(out);
+    return out;
+}
+
+static PyObject*
+bitunpack_unpackbits(unsigned const char* input, int length, int bits, int byteSwap, PyObject* out)
+{
+    int elements = (int)(((long long)length*8)/bits);
+    char* outptr = NULL;
+    PyObject* ba = bitunpack_output(out,elements*2,&outptr);
+    if (ba==NULL)
+        return NULL;
+    int level = unpackLevel;
+    Py_BEGIN_ALLOW_THREADS;
+    unpack_bits(input,length,(uint16_t*)outptr,0,elements,bits,byteSwap,level);
     Py_END_ALLOW_THREADS;
     PyObject *stat = Py_BuildValue("II",0,0);
     PyObject *rslt = PyTuple_New(2);
@@ -533,54 +634,204 @@ bitunpack_unpack12to16(PyObject* self, PyObject *args)
     return rslt;
 }
 
+static PyObject*
+bitunpack_unpack12to16(PyObject* self, PyObject *args)
+{
+    unsigned const char* input = 0;
+    int length = 0;
+    int byteSwap = 0;
+    PyObject* out = NULL;
+    if (!PyArg_ParseTuple(args, "t#i|O", &input, &length, &byteSwap, &out))
+        return NULL;
+    // 12bit data is always a big endian byte stream
+    return bitunpack_unpackbits(input,length,12,1,out);
+}
+
 static PyObject*
 bitunpack_unpack14to16(PyObject* self, PyObject *args)
 {
     unsigned const char* input = 0;
     int length = 0;
     int byteSwap = 0;
-    if (!PyArg_ParseTuple(args, "t#i", &input, &length, &byteSwap))
+    PyObject* out = NULL;
+    if (!PyArg_ParseTuple(args, "t#i|O", &input, &length, &byteSwap, &out))
         return NULL;
-    PyObject* ba = PyByteArray_FromStringAndSize("",0);
-    int elements = length*8/14;
-    PyByteArray_Resize(ba,elements*2);
-    unsigned char* baptr = (unsigned char*)PyByteArray_AS_STRING(ba);
-    int i = 0;
-    int sparebits = 0;
-    unsigned int acc = 0;
-    unsigned int out = 0;
-    short unsigned int* read = (short unsigned int*)input;
-    short unsigned int* write = (short unsigned int*)baptr;
-    //printf("Decoding frame\n");
+    return bitunpack_unpackbits(input,length,14,byteSwap,out);
+}
 
+static PyObject*
+bitunpack_unpackto16(PyObject* self, PyObject *args)
+{
+    unsigned const char* input = 0;
+    int length = 0;
+    int bits = 0;
+    int byteSwap = 0;
+    PyObject* out = NULL;
+    if (!PyArg_ParseTuple(args, "t#ii|O", &input, &length, &bits, &byteSwap, &out))
+        return NULL;
+    if (bits!=10 && bits!=12 && bits!=14) {
+        PyErr_Format(PyExc_ValueError, "Unsupported bit depth %d", bits);
+        return NULL;
+    }
+    return bitunpack_unpackbits(input,length,bits,byteSwap,out);
+}
+
+static PyObject*
+bitunpack_unpackrange(PyObject* self, PyObject *args)
+{
+    unsigned const char* input = 0;
+    int length = 0;
+    int bits = 0;
+    int byteSwap = 0;
+    char* output = 0;
+    int outlen = 0;
+    int first = 0;
+    int count = 0;
+    if (!PyArg_ParseTuple(args, "t#iiw#ii", &input, &length, &bits, &byteSwap, &output, &outlen, &first, &count))
+        return NULL;
+    if (bits!=10 && bits!=12 && bits!=14) {
+        PyErr_Format(PyExc_ValueError, "Unsupported bit depth %d", bits);
+        return NULL;
+    }
+    if (first<0 || count<0 || (first&7)!=0 || ((long long)first+count)*2>outlen) {
+        PyErr_SetString(PyExc_ValueError, "Bad unpack range");
+        return NULL;
+    }
+    int level = unpackLevel;
     Py_BEGIN_ALLOW_THREADS;
-    while (i<elements) {
-        if (sparebits<14) {
-            short unsigned int r = *read++;
-            if (byteSwap) 
-                r = (r&0xFF00)>>8 | ((r&0x00FF)<<8);
-            acc |= r;
-            sparebits += 2;
-            out = (acc>>sparebits)&0x3FFF;
-        } else {
-            sparebits += 2;
-            out = (acc>>sparebits)&0x3FFF;
-            sparebits = 0;
-            acc = 0;
-        }
-        if (out==0) out = *(write-2); // Dead pixel masking
-        *write++ = out;
-        acc = (acc&((1<<sparebits)-1))<<16;
-        i++;
+    unpack_bits(input,length,(uint16_t*)output,first,count,bits,byteSwap,level);
+    Py_END_ALLOW_THREADS;
+    Py_RETURN_NONE;
+}
+
+static PyObject*
+bitunpack_unpackreduced(PyObject* self, PyObject *args)
+{
+    unsigned const char* input = 0;
+    int length = 0;
+    int bits = 0;
+    int byteSwap = 0;
+    int width = 0;
+    int height = 0;
+    int factor = 0;
+    int black = 0;
+    int cfa = 0;
+    char* output = 0;
+    int outlen = 0;
+    int first = 0;
+    int rows = 0;
+    if (!PyArg_ParseTuple(args, "t#iiiiiiiw#ii", &input, &length, &bits, &byteSwap, &width, &height, &factor, &black, &cfa,
+        &output, &outlen, &first, &rows))
+        return NULL;
+    if (bits!=10 && bits!=12 && bits!=14 && bits!=16) {
+        PyErr_Format(PyExc_ValueError, "Unsupported bit depth %d", bits);
+        return NULL;
+    }
+    if (factor!=2 && factor!=4 && factor!=8) {
+        PyErr_Format(PyExc_ValueError, "Unsupported reduction %d", factor);
+        return NULL;
     }
+    if (width<2 || height<2 || first<0 || rows<0 || first+rows>height/factor
+        || (long long)(width/factor)*(first+rows)*3*2>outlen) {
+        PyErr_SetString(PyExc_ValueError, "Bad reduced range");
+        return NULL;
+    }
+    int level = unpackLevel;
+    int res;
+    Py_BEGIN_ALLOW_THREADS;
+    res = unpack_reduced(input,length,(uint16_t*)output,width,height,bits,byteSwap,factor,black,cfa,level,first,rows);
     Py_END_ALLOW_THREADS;
-    PyObject *stat = Py_BuildValue("II",0,0);
-    PyObject *rslt = PyTuple_New(2);
-    PyTuple_SetItem(rslt, 0, ba);
-    PyTuple_SetItem(rslt, 1, stat);
+    if (res<0)
+        return PyErr_NoMemory();
+    Py_RETURN_NONE;
+}
+
+static PyObject*
+bitunpack_unpackstats(PyObject* self, PyObject *args)
+{
+    unsigned const char* input = 0;
+    int length = 0;
+    int bits = 0;
+    int byteSwap = 0;
+    char* output = 0;
+    int outlen = 0;
+    int first = 0;
+    int count = 0;
+    unpack_process proc;
+    unsigned const char* lin = 0;
+    int linlen = 0;
+    if (!PyArg_ParseTuple(args, "t#iiw#iiiiiiit#", &input, &length, &bits, &byteSwap, &output, &outlen, &first, &count,
+        &proc.width, &proc.black, &proc.white, &proc.cfa, &proc.subtract, &lin, &linlen))
+        return NULL;
+    if (bits!=10 && bits!=12 && bits!=14 && bits!=16) {
+        PyErr_Format(PyExc_ValueError, "Unsupported bit depth %d", bits);
+        return NULL;
+    }
+    if (first<0 || count<0 || (first&7)!=0 || ((long long)first+count)*2>outlen || proc.width<=0) {
+        PyErr_SetString(PyExc_ValueError, "Bad unpack range");
+        return NULL;
+    }
+    proc.lin = (const uint16_t*)lin;
+    proc.linlen = linlen/2;
+    unpack_stats stats;
+    unpack_stats_init(&stats);
+    int level = unpackLevel;
+    Py_BEGIN_ALLOW_THREADS;
+    unpack_frame(input,length,(uint16_t*)output,first,count,bits,byteSwap,level,&proc,&stats);
+    Py_END_ALLOW_THREADS;
+    PyObject* hist = PyByteArray_FromStringAndSize((char*)stats.hist,sizeof(stats.hist));
+    PyObject* rslt = Py_BuildValue("((IIII)(IIII)(KKKK)(IIII)(IIII)N)",
+        stats.min[0],stats.min[1],stats.min[2],stats.min[3],
+        stats.max[0],stats.max[1],stats.max[2],stats.max[3],
+        stats.sum[0],stats.sum[1],stats.sum[2],stats.sum[3],
+        stats.count[0],stats.count[1],stats.count[2],stats.count[3],
+        stats.clipped[0],stats.clipped[1],stats.clipped[2],stats.clipped[3],
+        hist);
     return rslt;
 }
 
+static PyObject*
+bitunpack_simd(PyObject* self, PyObject *args)
+{
+    if (!PyArg_ParseTuple(args, ""))
+        return NULL;
+    return PyString_FromString(unpack_simd_name(unpackLevel));
+}
+
+static PyObject*
+bitunpack_setsimd(PyObject* self, PyObject *args)
+{
+    const char* name = 0;
+    if (!PyArg_ParseTuple(args, "s", &name))
+        return NULL;
+    int level = unpack_simd_level(name);
+    if (level<0) {
+        PyErr_Format(PyExc_ValueError, "Unknown unpack variant %s", name);
+        return NULL;
+    }
+    int best = unpack_simd_detect();
+    if (level>best)
+        level = best;
+    unpackLevel = level;
+    return PyString_FromString(unpack_simd_name(unpackLevel));
+}
+
+static PyObject*
+bitunpack_simdvariants(PyObject* self, PyObject *args)
+{
+    if (!PyArg_ParseTuple(args, ""))
+        return NULL;
+    int best = unpack_simd_detect();
+    PyObject* variants = PyList_New(0);
+    int level;
+    for (level=UNPACK_SCALAR;level<=best;level++) {
+        PyObject* name = PyString_FromString(unpack_simd_name(level));
+        PyList_Append(variants,name);
+        Py_DECREF(name);
+    }
+    return variants;
+}
+
 static PyObject*
 bitunpack_unpackljto16(PyObject* self, PyObject *args)
 {
@@ -611,12 +862,144 @@ bitunpack_unpackljto16(PyObject* self, PyObject *args)
             lj92_decode(ljp,(uint16_t*)(output+outindex),outwrite,outskip,NULL,0);
         }
         //printf("Decoding complete\n");
+        lj92_close(ljp);
     }
     Py_END_ALLOW_THREADS;
     PyObject *stat = Py_BuildValue("I",ret);
     return stat;
 }
 
+typedef struct {
+    const uint8_t** data;
+    const int* lengths;
+    int* status;
+    uint16_t* output;
+    int width;
+    int height;
+    int tilewidth;
+    int tilelength;
+    int across;
+    uint16_t* lin;
+    int linlen;
+} ljtilesjob;
+
+static void
+decode_ljtile(void* ctx, int item, int worker)
+{
+    ljtilesjob* job = (ljtilesjob*)ctx;
+    int x = (item%job->across)*job->tilewidth;
+    int y = (item/job->across)*job->tilelength;
+    int tw = job->tilewidth;
+    int tl = job->tilelength;
+    lj92 ljp;
+    int iw,ih,ib;
+    int ret = lj92_open(&ljp,(uint8_t*)job->data[item],job->lengths[item],&iw,&ih,&ib);
+    if (ret!=LJ92_ERROR_NONE) {
+        job->status[item] = ret;
+        return;
+    }
+    if (iw*ih!=tw*tl) {
+        /* Would write outside the tile */
+        ret = LJ92_ERROR_CORRUPT;
+    } else if (x+tw<=job->width && y+tl<=job->height) {
+        ret = lj92_decode(ljp,job->output+(size_t)y*job->width+x,tw,job->width-tw,job->lin,job->linlen);
+    } else {
+        /* Edge tiles are padded past the frame, so decode aside and copy what is in it */
+        uint16_t* tile = (uint16_t*)malloc((size_t)tw*tl*sizeof(uint16_t));
+        if (tile==NULL) {
+            ret = LJ92_ERROR_NO_MEMORY;
+        } else {
+            ret = lj92_decode(ljp,tile,tw,0,job->lin,job->linlen);
+            int w = job->width-x<tw?job->width-x:tw;
+            int h = job->height-y<tl?job->height-y:tl;
+            int r;
+            for (r=0;r<h;r++)
+                memcpy(job->output+(size_t)(y+r)*job->width+x,tile+(size_t)r*tw,w*sizeof(uint16_t));
+            free(tile);
+        }
+    }
+    lj92_close(ljp);
+    job->status[item] = ret;
+}
+
+static PyObject*
+bitunpack_unpackljtiles(PyObject* self, PyObject *args)
+{
+    PyObject* tilesobj;
+    char* output;
+    int outlen = 0;
+    int width = 0;
+    int height = 0;
+    int tilewidth = 0;
+    int tilelength = 0;
+    unsigned const char* lin = 0;
+    int linlen = 0;
+    int threads = 1;
+    if (!PyArg_ParseTuple(args, "Ow#iiiit#i", &tilesobj, &output, &outlen,
+        &width, &height, &tilewidth, &tilelength, &lin, &linlen, &threads))
+        return NULL;
+    if (width<=0 || height<=0 || tilewidth<=0 || tilelength<=0) {
+        PyErr_SetString(PyExc_ValueError,"Bad frame or tile size");
+        return NULL;
+    }
+    if (outlen<width*height*2) {
+        PyErr_SetString(PyExc_ValueError,"Output too small");
+        return NULL;
+    }
+    PyObject* seq = PySequence_Fast(tilesobj,"tiles must be a sequence of LJ92 strings");
+    if (seq == NULL)
+        return NULL;
+    int count = PySequence_Fast_GET_SIZE(seq);
+    int across = (width+tilewidth-1)/tilewidth;
+    if (count>across*((height+tilelength-1)/tilelength)) {
+        PyErr_SetString(PyExc_ValueError,"More tiles than the frame holds");
+        Py_DECREF(seq);
+        return NULL;
+    }
+    const uint8_t** data = (const uint8_t**)malloc((count+1)*sizeof(uint8_t*));
+    int* lengths = (int*)malloc((count+1)*sizeof(int));
+    int* status = (int*)malloc((count+1)*sizeof(int));
+    if (data==NULL || lengths==NULL || status==NULL) {
+        free(data); free(lengths); free(status);
+        Py_DECREF(seq);
+        return PyErr_NoMemory();
+    }
+    int i;
+    for (i=0;i<count;i++) {
+        const void* buf;
+        Py_ssize_t len;
+        if (PyObject_AsReadBuffer(PySequence_Fast_GET_ITEM(seq,i),&buf,&len)<0) {
+            free(data); free(lengths); free(status);
+            Py_DECREF(seq);
+            return NULL;
+        }
+        data[i] = (const uint8_t*)buf;
+        lengths[i] = (int)len;
+    }
+    ljtilesjob job;
+    job.data = data;
+    job.lengths = lengths;
+    job.status = status;
+    job.output = (uint16_t*)output;
+    job.width = width;
+    job.height = height;
+    job.tilewidth = tilewidth;
+    job.tilelength = tilelength;
+    job.across = across;
+    job.lin = linlen>0?(uint16_t*)lin:NULL;
+    job.linlen = linlen/2;
+    // The sequence keeps the tiles alive while the GIL is released
+    Py_BEGIN_ALLOW_THREADS;
+    workpool_run(threads,count,decode_ljtile,&job);
+    Py_END_ALLOW_THREADS;
+    Py_DECREF(seq);
+    PyObject* result = PyTuple_New(count);
+    for (i=0;result!=NULL && i<count;i++)
+        PyTuple_SET_ITEM(result,i,PyInt_FromLong(status[i]));
+    free(data); free(lengths); free(status);
+    return result;
+}
+
 static PyObject*
 bitunpack_pack16tolj(PyObject* self, PyObject *args)
 {
@@ -630,14 +1013,18 @@ bitunpack_pack16tolj(PyObject* self, PyObject *args)
     int inskip = 0;
     unsigned const char* delin = 0;
     int delinlen = 0;
+    PyObject* out = NULL;
 
-    if (!PyArg_ParseTuple(args, "t#iiiiiit#", &input, &inlen,
+    if (!PyArg_ParseTuple(args, "t#iiiiiit#|O", &input, &inlen,
         &width, &height, &bitdepth,
-        &inindex, &inread, &inskip, &delin, &delinlen))
+        &inindex, &inread, &inskip, &delin, &delinlen, &out))
         return NULL;
 
     //printf("width=%d,height=%d,inlen=%d\n",width,height,inlen);
-    if (width*height*sizeof(uint16_t) > inlen) return NULL;
+    if (width*height*sizeof(uint16_t) > inlen) {
+        PyErr_SetString(PyExc_ValueError, "Input too small");
+        return NULL;
+    }
 
     int ret = 0;
     uint8_t* encoded;
@@ -650,27 +1037,126 @@ bitunpack_pack16tolj(PyObject* self, PyObject *args)
         ret = lj92_encode((uint16_t*)&input[inindex],width,height,bitdepth,
                 inread,inskip,(uint16_t*)delin,delinlen,&encoded,&encodedLength);
     }
-    //printf("lj92_encode ret=%d\n",ret);
-    if (ret != LJ92_ERROR_NONE) return NULL;
     Py_END_ALLOW_THREADS;
-    PyObject* ba = PyByteArray_FromStringAndSize((char*)encoded,encodedLength);
+    //printf("lj92_encode ret=%d\n",ret);
+    if (ret != LJ92_ERROR_NONE) {
+        PyErr_Format(PyExc_RuntimeError, "LJ92 encoding failed (%d)", ret);
+        return NULL;
+    }
+    if (out==NULL || out==Py_None) {
+        PyObject* ba = PyByteArray_FromStringAndSize((char*)encoded,encodedLength);
+        free(encoded);
+        return ba;
+    }
+    // Write into the given buffer and return how much of it was used
+    char* outptr = NULL;
+    PyObject* ob = bitunpack_output(out,encodedLength,&outptr);
+    if (ob==NULL) {
+        free(encoded);
+        return NULL;
+    }
+    memcpy(outptr,encoded,encodedLength);
     free(encoded);
-    return ba;
+    Py_DECREF(ob);
+    return PyInt_FromLong(encodedLength);
+}
+
+/*
+ * MLV block scanning. Records describing each block are written
+ * into a bytearray so that python can wrap them with numpy and
+ * handle a whole run of blocks at once.
+ */
+typedef struct _mlvblock {
+    uint32_t type;
+    uint32_t size;
+    uint64_t pos;
+    uint32_t frame; /* VIDF frameNumber, otherwise 0xFFFFFFFF */
+    uint32_t space; /* VIDF frameSpace, otherwise 0 */
+} mlvblock;
+
+#define MLV_VIDF 0x46444956
+
+static PyObject*
+bitunpack_scanmlv(PyObject* self, PyObject *args)
+{
+    PyObject* bufobj;
+    PY_LONG_LONG start = 0;
+    PY_LONG_LONG end = 0;
+    int maxblocks = 0;
+    if (!PyArg_ParseTuple(args, "OLLi", &bufobj, &start, &end, &maxblocks))
+        return NULL;
+    const void* vbuf = 0;
+    Py_ssize_t buflen = 0;
+    if (PyObject_AsReadBuffer(bufobj, &vbuf, &buflen) < 0)
+        return NULL;
+    if (end > buflen) end = buflen;
+    if (maxblocks < 1) maxblocks = 1;
+
+    PyObject* ba = PyByteArray_FromStringAndSize("",0);
+    if (PyByteArray_Resize(ba,maxblocks*sizeof(mlvblock)) < 0) {
+        Py_DECREF(ba);
+        return NULL;
+    }
+    mlvblock* rec = (mlvblock*)PyByteArray_AS_STRING(ba);
+    const unsigned char* buf = (const unsigned char*)vbuf;
+    PY_LONG_LONG pos = start;
+    int count = 0;
+
+    Py_BEGIN_ALLOW_THREADS;
+    while (count<maxblocks && pos+8<=end) {
+        uint32_t blockType, blockSize;
+        memcpy(&blockType,buf+pos,4);
+        memcpy(&blockSize,buf+pos+4,4);
+        if (blockSize < 8) break; /* Corrupt */
+        if (pos+blockSize > end) break; /* Incomplete block */
+        rec->type = blockType;
+        rec->size = blockSize;
+        rec->pos = pos;
+        rec->frame = 0xFFFFFFFF;
+        rec->space = 0;
+        if (blockType == MLV_VIDF) {
+            if (blockSize < 32) break; /* Corrupt */
+            memcpy(&rec->frame,buf+pos+16,4);
+            memcpy(&rec->space,buf+pos+28,4);
+        }
+        rec++;
+        count++;
+        pos += blockSize;
+    }
+    Py_END_ALLOW_THREADS;
+
+    PyByteArray_Resize(ba,count*sizeof(mlvblock));
+    PyObject *rslt = PyTuple_New(2);
+    PyTuple_SetItem(rslt, 0, ba);
+    PyTuple_SetItem(rslt, 1, PyLong_FromLongLong(pos));
+    return rslt;
 }
 
 static PyMethodDef methods[] = {
-    { "unpack14to16", bitunpack_unpack14to16, METH_VARARGS, "Unpack a string of 14bit values to 16bit values" },
-    { "unpack12to16", bitunpack_unpack12to16, METH_VARARGS, "Unpack a string of 12bit values to 16bit values" },
+    { "unpack14to16", bitunpack_unpack14to16, METH_VARARGS, "Unpack a string of 14bit values to 16bit values, optionally into a given buffer" },
+    { "unpack12to16", bitunpack_unpack12to16, METH_VARARGS, "Unpack a string of 12bit values to 16bit values, optionally into a given buffer" },
+    { "unpackto16", bitunpack_unpackto16, METH_VARARGS, "Unpack a string of 10, 12 or 14bit values to 16bit values, optionally into a given buffer" },
+    { "unpackrange", bitunpack_unpackrange, METH_VARARGS, "Unpack part of a string of 10, 12 or 14bit values into a 16bit buffer. Can be from any thread" },
+    { "unpackstats", bitunpack_unpackstats, METH_VARARGS, "Unpack part of a frame into a 16bit buffer, linearizing, subtracting black and measuring per channel levels on the way. Can be from any thread" },
+    { "unpackreduced", bitunpack_unpackreduced, METH_VARARGS, "Decode rows of a 1/2, 1/4 or 1/8 size linear RGB image straight from Bayer data. Can be from any thread" },
+    { "simd", bitunpack_simd, METH_VARARGS, "Name of the unpack variant in use" },
+    { "setsimd", bitunpack_setsimd, METH_VARARGS, "Choose the unpack variant, limited to what the CPU supports" },
+    { "simdvariants", bitunpack_simdvariants, METH_VARARGS, "Unpack variants this CPU supports" },
     { "unpackljto16", bitunpack_unpackljto16, METH_VARARGS, "Unpack a string of LJPEG values to 16bit values" },
-    { "pack16tolj", bitunpack_pack16tolj, METH_VARARGS, "Pack a string of 16bit values to LJPEG" },
+    { "unpackljtiles", bitunpack_unpackljtiles, METH_VARARGS, "Decode a frame of LJ92 tiles into a 16bit buffer on native threads. Returns the status of each tile" },
+    { "pack16tolj", bitunpack_pack16tolj, METH_VARARGS, "Pack a string of 16bit values to LJPEG. With a buffer given, writes into it and returns the length" },
     { "demosaic14", bitunpack_demosaic14, METH_VARARGS, "Demosaic a 14bit RAW image into RGB float" },
     { "demosaic16", bitunpack_demosaic16, METH_VARARGS, "Demosaic a 16bit RAW image into RGB float" },
     { "demosaicer", bitunpack_demosaicer, METH_VARARGS, "Create a demosaicer object" },
     { "predemosaic12", bitunpack_predemosaic12, METH_VARARGS, "Prepare to demosaic a 12bit RAW image into RGB float" },
     { "predemosaic14", bitunpack_predemosaic14, METH_VARARGS, "Prepare to demosaic a 14bit RAW image into RGB float" },
     { "predemosaic16", bitunpack_predemosaic16, METH_VARARGS, "Prepare to demosaic a 16bit RAW image into RGB float" },
+    { "predemosaicbits", bitunpack_predemosaicbits, METH_VARARGS, "Prepare to demosaic a 10, 12, 14 or 16bit RAW image into RGB float" },
     { "demosaic", bitunpack_demosaic, METH_VARARGS, "Do a unit of demosaicing work (can be from any thread." },
-    { "postdemosaic", bitunpack_postdemosaic, METH_VARARGS, "Complete a demosaicing job. Returns the image." },
+    { "demosaictiles", bitunpack_demosaictiles, METH_VARARGS, "Demosaic a list of tiles on native threads, stealing work between them." },
+    { "demosaicfast", bitunpack_demosaicfast, METH_VARARGS, "Bilinear, nearest or superpixel demosaic on native threads. Returns the output size." },
+    { "postdemosaic", bitunpack_postdemosaic, METH_VARARGS, "Complete a demosaicing job. Returns the image as interleaved RGB float32, uint16 or float16." },
+    { "scanmlv", bitunpack_scanmlv, METH_VARARGS, "Walk MLV block headers in a buffer. Returns block records and next position." },
 
     { NULL, NULL, 0, NULL }
 };
@@ -683,6 +1169,7 @@ initbitunpack(void)
     m = Py_InitModule("bitunpack", methods);
     if (m == NULL)
         return;
-    PyModule_AddStringConstant(m,"__version__","3.0");
+    PyModule_AddStringConstant(m,"__version__","3.11");
+    unpackLevel = unpack_simd_detect();
 }
 
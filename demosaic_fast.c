@@ -0,0 +1,158 @@
+/*
+demosaic_fast.c, part of MlRawViewer
+(c) Andrew Baldwin 2014
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+*/
+
+#include <math.h>
+#include <stddef.h>
+
+#include "demosaic_fast.h"
+
+/* Colour at each 2x2 Bayer position: 0 red, 1 green, 2 blue */
+static const int CFA_COLOURS[2][4] = {
+    { 0, 1, 1, 2 }, /* RGGB, e.g. Canon */
+    { 1, 2, 0, 1 }, /* GBRG, e.g. BMPCC */
+};
+
+int
+demosaic_fast_size(int method, int width, int height, int* outwidth, int* outheight)
+{
+    if (method==DEMOSAIC_BILINEAR || method==DEMOSAIC_NEAREST) {
+        *outwidth = width;
+        *outheight = height;
+    } else if (method==DEMOSAIC_SUPERPIXEL) {
+        *outwidth = width/2;
+        *outheight = height/2;
+    } else {
+        return 0;
+    }
+    return 1;
+}
+
+/* Mirror around the edges, which keeps the Bayer colour */
+static inline int
+mirror(int i, int size)
+{
+    if (i<0) return -i;
+    if (i>=size) return 2*size-2-i;
+    return i;
+}
+
+static void
+demosaic_bilinear_row(float** raw, float* out[3], int width, int height, const int* colours, int y)
+{
+    const float* u = raw[mirror(y-1,height)];
+    const float* c = raw[y];
+    const float* d = raw[mirror(y+1,height)];
+    const int* rowcolours = colours+(y&1)*2;
+    size_t row = (size_t)y*width;
+    int x;
+    for (x=0;x<width;x++) {
+        int l = x>0?x-1:1;
+        int r = x<width-1?x+1:width-2;
+        int colour = rowcolours[x&1];
+        if (colour==1) {
+            /* Green: one colour is left and right, the other above and below */
+            int across = rowcolours[(x&1)^1];
+            out[1][row+x] = c[x]-DEMOSAIC_FAST_OFFSET;
+            out[across][row+x] = (c[l]+c[r])*0.5f-DEMOSAIC_FAST_OFFSET;
+            out[2-across][row+x] = (u[x]+d[x])*0.5f-DEMOSAIC_FAST_OFFSET;
+        } else {
+            /* Red or blue: green is all around, the other colour diagonal */
+            out[colour][row+x] = c[x]-DEMOSAIC_FAST_OFFSET;
+            out[1][row+x] = (u[x]+d[x]+c[l]+c[r])*0.25f-DEMOSAIC_FAST_OFFSET;
+            out[2-colour][row+x] = (u[l]+u[r]+d[l]+d[r])*0.25f-DEMOSAIC_FAST_OFFSET;
+        }
+    }
+}
+
+/* R, G and B of the 2x2 quad starting at row y, column x.
+ * Green is the geometric mean of the two greens, as in the GLSL version */
+static inline void
+demosaic_quad(float** raw, const int* colours, int x, int y, int geometric, float rgb[3])
+{
+    float g[2];
+    int n = 0;
+    int p;
+    for (p=0;p<4;p++) {
+        float v = raw[y+(p>>1)][x+(p&1)];
+        if (colours[p]==1)
+            g[n++] = v;
+        else
+            rgb[colours[p]] = v-DEMOSAIC_FAST_OFFSET;
+    }
+    if (geometric)
+        rgb[1] = sqrtf(g[0]*g[1])-DEMOSAIC_FAST_OFFSET;
+    else
+        rgb[1] = (g[0]+g[1])*0.5f-DEMOSAIC_FAST_OFFSET;
+}
+
+static void
+demosaic_nearest_row(float** raw, float* out[3], int width, int height, const int* colours, int y)
+{
+    /* Odd sizes repeat the last whole quad, which keeps the Bayer phase */
+    int lastx = (width/2-1)*2;
+    int qy = y&~1;
+    if (qy>(height/2-1)*2) qy = (height/2-1)*2;
+    size_t row = (size_t)y*width;
+    int x,c;
+    for (x=0;x<width;x+=2) {
+        int qx = x>lastx?lastx:x;
+        float rgb[3];
+        demosaic_quad(raw,colours,qx,qy,1,rgb);
+        for (c=0;c<3;c++) {
+            out[c][row+x] = rgb[c];
+            if (x+1<width)
+                out[c][row+x+1] = rgb[c];
+        }
+    }
+}
+
+static void
+demosaic_superpixel_row(float** raw, float* out[3], int width, const int* colours, int oy)
+{
+    int ow = width/2;
+    size_t row = (size_t)oy*ow;
+    int ox,c;
+    for (ox=0;ox<ow;ox++) {
+        float rgb[3];
+        demosaic_quad(raw,colours,ox*2,oy*2,0,rgb);
+        for (c=0;c<3;c++)
+            out[c][row+ox] = rgb[c];
+    }
+}
+
+void
+demosaic_fast_rows(int method, float** raw, float* red, float* green, float* blue,
+                   int width, int height, int cfa, int first, int count)
+{
+    float* out[3] = { red, green, blue };
+    const int* colours = CFA_COLOURS[cfa==1];
+    int y;
+    for (y=first;y<first+count;y++) {
+        if (method==DEMOSAIC_BILINEAR)
+            demosaic_bilinear_row(raw,out,width,height,colours,y);
+        else if (method==DEMOSAIC_NEAREST)
+            demosaic_nearest_row(raw,out,width,height,colours,y);
+        else if (method==DEMOSAIC_SUPERPIXEL)
+            demosaic_superpixel_row(raw,out,width,colours,y);
+    }
+}
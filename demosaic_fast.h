@@ -0,0 +1,54 @@
+/*
+demosaic_fast.h, part of MlRawViewer
+(c) Andrew Baldwin 2014
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+*/
+
+/*
+Fast CPU demosaics, for when AMaZE is too slow: batch jobs, proxies and
+machines without a capable GPU. Like AMaZE they read the float raw made
+by predemosaic (values above black, plus DEMOSAIC_FAST_OFFSET) and write
+R, G and B planes of values above black.
+
+Bilinear and nearest write full size planes, matching the GLSL versions.
+Superpixel makes one RGB pixel from each 2x2 Bayer quad, so its planes
+are half size and packed, with a row stride of the output width.
+*/
+
+#ifndef DEMOSAIC_FAST_H
+#define DEMOSAIC_FAST_H
+
+enum DEMOSAIC_FAST_METHODS {
+    DEMOSAIC_BILINEAR = 1,
+    DEMOSAIC_NEAREST = 2,
+    DEMOSAIC_SUPERPIXEL = 3,
+};
+
+/* Added by predemosaic to avoid artifacts at low levels */
+#define DEMOSAIC_FAST_OFFSET 15.0f
+
+/* Output size of a method, or 0 for unknown methods */
+int demosaic_fast_size(int method, int width, int height, int* outwidth, int* outheight);
+
+/* Demosaic output rows first..first+count-1. Rows can be done in any order or at once */
+void demosaic_fast_rows(int method, float** raw, float* red, float* green, float* blue,
+                        int width, int height, int cfa, int first, int count);
+
+#endif
@@ -0,0 +1,150 @@
+#!/usr/bin/python2.7
+"""
+Check the native bilinear, nearest and superpixel CPU demosaics against
+numpy versions of the same filters, for both CFAs and odd sizes.
+Also checks that thread counts and windows do not change the results,
+and that more threads never means fewer tiles.
+
+Usage: demosaicfasttest.py [<width> <height>]
+"""
+# standard python imports. Should not be missing
+import sys,os
+
+import numpy as np
+
+# So we can use modules from the main dir
+root = os.path.split(sys.path[0])[0]
+sys.path.append(root)
+
+# Now import our own modules
+import bitunpack
+import MlRaw
+
+CPUDemosaic = MlRaw.CPUDemosaic
+OFFSET = np.float32(15.0) # Added by predemosaic
+
+# Colour at each 2x2 Bayer position for each cfa: 0 red, 1 green, 2 blue
+COLOURS = ((0,1,1,2),(1,2,0,1))
+
+def check(name,ok):
+    print "%-60s %s"%(name,("ok" if ok else "FAILED"))
+    return ok
+
+def colourmap(width,height,cfa):
+    c = np.array(COLOURS[cfa]).reshape(2,2)
+    return np.tile(c,((height+1)/2,(width+1)/2))[:height,:width]
+
+def bilinear(raw,cfa):
+    height,width = raw.shape
+    p = np.pad(raw,1,mode='reflect')
+    c = p[1:-1,1:-1]
+    u,d = p[:-2,1:-1],p[2:,1:-1]
+    l,r = p[1:-1,:-2],p[1:-1,2:]
+    ul,ur,dl,dr = p[:-2,:-2],p[:-2,2:],p[2:,:-2],p[2:,2:]
+    across = (l+r)*np.float32(0.5)
+    updown = (u+d)*np.float32(0.5)
+    cross = (u+d+l+r)*np.float32(0.25)
+    diagonal = (ul+ur+dl+dr)*np.float32(0.25)
+    colours = colourmap(width,height,cfa)
+    # The colour left and right of each green
+    acrosscolour = np.roll(colours,1,axis=1)
+    acrosscolour[:,0] = colours[:,1]
+    rgb = np.zeros((height,width,3),dtype=np.float32)
+    for ch in range(3):
+        v = np.where(colours==ch,c,0)
+        green = colours==1
+        v = np.where(green & (ch!=1) & (acrosscolour==ch),across,v)
+        v = np.where(green & (ch!=1) & (acrosscolour!=ch),updown,v)
+        v = np.where(~green & (ch==1),cross,v)
+        v = np.where(~green & (ch!=1) & (colours!=ch),diagonal,v)
+        rgb[:,:,ch] = v-OFFSET
+    return rgb
+
+def quads(raw,cfa,geometric):
+    height,width = raw.shape
+    q = raw[:height/2*2,:width/2*2]
+    pos = [q[0::2,0::2],q[0::2,1::2],q[1::2,0::2],q[1::2,1::2]]
+    greens = [pos[i] for i in range(4) if COLOURS[cfa][i]==1]
+    rgb = np.zeros(greens[0].shape+(3,),dtype=np.float32)
+    for i in range(4):
+        if COLOURS[cfa][i]!=1:
+            rgb[:,:,COLOURS[cfa][i]] = pos[i]-OFFSET
+    if geometric:
+        rgb[:,:,1] = np.sqrt(greens[0]*greens[1])-OFFSET
+    else:
+        rgb[:,:,1] = (greens[0]+greens[1])*np.float32(0.5)-OFFSET
+    return rgb
+
+def nearest(raw,cfa):
+    height,width = raw.shape
+    q = quads(raw,cfa,True)
+    ys = np.minimum(np.arange(height)/2,q.shape[0]-1)
+    xs = np.minimum(np.arange(width)/2,q.shape[1]-1)
+    return q[ys][:,xs]
+
+def superpixel(raw,cfa):
+    return quads(raw,cfa,False)
+
+REFERENCES = {
+    CPUDemosaic.BILINEAR:bilinear,
+    CPUDemosaic.NEAREST:nearest,
+    CPUDemosaic.SUPERPIXEL:superpixel,
+}
+
+def demosaicfast(rawdata,width,height,black,cfa,quality,threads=None,window=None):
+    demosaicer = bitunpack.demosaicer(width,height)
+    bitunpack.predemosaicbits(demosaicer,rawdata,width,height,black,16,0)
+    MlRaw.DemosaicThread.doDemosaic(demosaicer,width,height,cfa,window,threads,quality)
+    ow,oh = MlRaw.DemosaicThread.outputSize(width,height,quality)
+    return np.frombuffer(bitunpack.postdemosaic(demosaicer),dtype=np.float32).reshape(oh,ow,3)
+
+def main():
+    sizes = [(1920,1080),(101,67),(2,2)]
+    if len(sys.argv)>2: sizes = [(int(sys.argv[1]),int(sys.argv[2]))]
+    black = 2048
+    failures = 0
+    np.random.seed(1)
+    for width,height in sizes:
+        # No zeros, which would be masked as dead pixels
+        raw = np.random.randint(black,65536,width*height).astype(np.uint16)
+        rawdata = raw.tostring()
+        rawfloat = (raw.astype(np.float32)-black+OFFSET).reshape(height,width)
+        for cfa in (0,1):
+            for quality in sorted(REFERENCES):
+                name = "%dx%d cfa %d %s"%(width,height,cfa,CPUDemosaic.Qualities[quality])
+                expect = REFERENCES[quality](rawfloat,cfa)
+                one = demosaicfast(rawdata,width,height,black,cfa,quality,threads=1)
+                ok = one.shape==expect.shape and np.allclose(one,expect,rtol=1e-6,atol=1e-3)
+                failures += not check(name+" matches numpy",ok)
+                many = demosaicfast(rawdata,width,height,black,cfa,quality)
+                failures += not check(name+" same on %d threads"%MlRaw.DemosaicThread.threads,np.array_equal(one,many))
+                if height>=8:
+                    window = (0,height/4+1,width,height/3)
+                    windowed = demosaicfast(rawdata,width,height,black,cfa,quality,window=window)
+                    scale = height/one.shape[0]
+                    first = window[1]/scale
+                    end = (window[1]+window[3]+scale-1)/scale
+                    failures += not check(name+" window rows",np.array_equal(one[first:end],windowed[first:end]))
+    ok = True
+    for width,height in ((640,360),(1920,1080),(2560,1080),(5184,2160)):
+        counts = [np.prod(MlRaw.DemosaicThread.grid(width,height,t)) for t in range(1,33)]
+        ok &= counts==sorted(counts)
+    failures += not check("tile count never falls as threads increase",ok)
+    demosaicer = bitunpack.demosaicer(16,16)
+    try:
+        bitunpack.demosaicfast(demosaicer,CPUDemosaic.AMAZE,0,1)
+        ok = False
+    except ValueError:
+        ok = True
+    failures += not check("AMaZE is not a fast method",ok)
+    try:
+        bitunpack.demosaicfast(demosaicer,CPUDemosaic.SUPERPIXEL,0,1,4,5)
+        ok = False
+    except ValueError:
+        ok = True
+    failures += not check("rows past the superpixel output are refused",ok)
+    print "%d failures"%failures
+    return failures!=0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+#!/usr/bin/python2.7
+"""
+Check the uint16 and float16 CPU demosaic outputs against float32.
+uint16 must be the float32 values rounded and clamped to 0..65535.
+float16 must be exactly what numpy makes from the float32 values,
+including scales which give subnormals and infinities.
+Also shows the size and postdemosaic time of each format.
+
+Usage: demosaicformattest.py [<width> <height>]
+"""
+# standard python imports. Should not be missing
+import sys,os,time
+
+import numpy as np
+
+# So we can use modules from the main dir
+root = os.path.split(sys.path[0])[0]
+sys.path.append(root)
+
+# Now import our own modules
+import bitunpack
+import MlRaw
+
+def check(name,ok):
+    print "%-50s %s"%(name,("ok" if ok else "FAILED"))
+    return ok
+
+def main():
+    width,height = 1920,1080
+    if len(sys.argv)>2: width,height = int(sys.argv[1]),int(sys.argv[2])
+    failures = 0
+    best = bitunpack.simd()
+    np.random.seed(1)
+    for cfa in (0,1):
+        # Full 16bit range, with highlights which AMaZE can push above 65535
+        raw = np.random.randint(0,65536,width*height).astype(np.uint16)
+        raw[::7] = 65535
+        rawdata = raw.tostring()
+        demosaicer = bitunpack.demosaicer(width,height)
+        bitunpack.predemosaicbits(demosaicer,rawdata,width,height,0,16,0)
+        MlRaw.DemosaicThread.doDemosaic(demosaicer,width,height,cfa)
+        f32 = np.frombuffer(bitunpack.postdemosaic(demosaicer),dtype=np.float32)
+        for variant in bitunpack.simdvariants():
+            bitunpack.setsimd(variant)
+            u16 = np.frombuffer(bitunpack.postdemosaic(demosaicer,'H'),dtype=np.uint16)
+            expect = np.clip(np.floor(f32.astype(np.float64)+0.5),0,65535).astype(np.uint16)
+            ok = np.array_equal(u16,expect)
+            ok &= np.abs(u16-np.clip(f32,0,65535)).max()<=0.5
+            failures += not check("cfa %d %s uint16 is rounded and clamped float32"%(cfa,variant),ok)
+            for scale in (1.0,1.0/65535.0,2.0**-30,4.0):
+                f16 = np.frombuffer(bitunpack.postdemosaic(demosaicer,'e',scale),dtype=np.float16)
+                expect = (f32*np.float32(scale)).astype(np.float16)
+                ok = np.array_equal(f16.view(np.uint16),expect.view(np.uint16))
+                failures += not check("cfa %d %s float16 scale %g matches numpy"%(cfa,variant,scale),ok)
+        bitunpack.setsimd(best)
+        f16 = np.frombuffer(bitunpack.postdemosaic(demosaicer,'e',1.0/65535.0),dtype=np.float16)
+        scaled = f32/np.float32(65535.0)
+        normal = scaled>=2.0**-14
+        relative = np.abs(f16[normal].astype(np.float32)-scaled[normal])/scaled[normal]
+        failures += not check("cfa %d float16 relative error %.2g <= 2^-11"%(cfa,relative.max()),relative.max()<=2.0**-11)
+        scaled = np.frombuffer(bitunpack.postdemosaic(demosaicer,'f',0.5),dtype=np.float32)
+        failures += not check("cfa %d float32 scale"%cfa,np.array_equal(scaled,f32*np.float32(0.5)))
+        # The module level call with a dtype gives the same. AMaZE does
+        # not write the frame edges, so those are left from earlier frames
+        for dtype in (np.uint16,np.float16):
+            result = MlRaw.demosaic16(rawdata,width,height,0,cfa=cfa,dtype=dtype)
+            expect = np.frombuffer(bitunpack.postdemosaic(demosaicer,np.dtype(dtype).char),dtype=dtype)
+            inside = lambda a:a.view(np.uint16).reshape(height,width,3)[16:-16,16:-16]
+            same = result.dtype==dtype and np.array_equal(inside(result),inside(expect))
+            failures += not check("cfa %d demosaic16 dtype %s"%(cfa,np.dtype(dtype).name),same)
+    try:
+        bitunpack.postdemosaic(demosaicer,'d')
+        failures += not check("unknown format rejected",False)
+    except ValueError:
+        check("unknown format rejected",True)
+    print "%8s %10s %10s"%("format","MB/frame","ms")
+    for fmt,name in (('f',"float32"),('H',"uint16"),('e',"float16")):
+        before = time.time()
+        result = bitunpack.postdemosaic(demosaicer,fmt)
+        took = time.time()-before
+        print "%8s %10.1f %10.1f"%(name,len(result)/1e6,1000.0*took)
+    print "%d failures"%failures
+    return failures!=0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,53 @@
+#!/usr/bin/python2.7
+"""
+Check that LJ92 tiles compressed on several unpack workers come back in
+tile order, the same as compressing them one after another, and that
+they decode to the frame that was compressed. Uses several workers
+whatever the number of cores, as one core hides ordering mistakes.
+
+Usage: packljtest.py [<workers>]
+"""
+# standard python imports. Should not be missing
+import sys,os,time
+
+import numpy as np
+
+# So we can use modules from the main dir
+root = os.path.split(sys.path[0])[0]
+sys.path.append(root)
+
+# Now import our own modules
+import bitunpack
+import MlRaw
+
+def check(name,ok):
+    print "%-60s %s"%(name,("ok" if ok else "FAILED"))
+    return ok
+
+def main():
+    workers = 4
+    if len(sys.argv)>1: workers = int(sys.argv[1])
+    pool = MlRaw.ParallelUnpack(workers)
+    failures = 0
+    # Later jobs finish first
+    def job(index,delay):
+        time.sleep(delay)
+        return index
+    jobs = [(i,0.05*(5-i)) for i in range(6)]
+    failures += not check("run returns results in job order",pool.run(job,jobs)==range(6))
+    np.random.seed(1)
+    for width,height,tw,tl in ((1024,512,128,64),(1810,1018,454,256),(1920,1080,960,1080)):
+        frame = np.random.randint(0,16384,width*height).astype(np.uint16)
+        serial = [str(bitunpack.pack16tolj(*j)) for j in pool.packLJJobs(frame,width,height,tw,tl)]
+        name = "%dx%d in %dx%d tiles"%(width,height,tw,tl)
+        ok = True
+        for repeat in range(10):
+            ok &= [str(t) for t in pool.packLJ(frame,width,height,tw,tl)]==serial
+        failures += not check(name+" in serial order on %d workers"%workers,ok)
+        output,status = pool.unpackLJ(serial,width,height,tw,tl)
+        failures += not check(name+" decode to the frame",not any(status) and np.array_equal(output,frame))
+    print "%d failures"%failures
+    return failures!=0
+
+if __name__ == '__main__':
+    sys.exit(main())
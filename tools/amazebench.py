@@ -0,0 +1,179 @@
+#!/usr/bin/python2.7
+"""
+Benchmark and regression check for the AMaZE CPU demosaic path:
+predemosaic (12, 14 and 16bit), AMaZE and postdemosaic (uint16).
+
+Synthetic Bayer frames are made at common ML resolutions for both CFA
+layouts: gradients, a zone plate, hard edged patches, noise and a few
+dead pixels. Each stage is timed at 1..N threads. Only AMaZE is
+threaded; the other stages are timed at each count anyway, as that is
+what a frame costs.
+
+Every result is checksummed and compared against tools/amazegolden.txt,
+so changes made for speed which alter the image are caught. AMaZE treats
+tile edges as frame edges, so results depend on the tile grid, which
+depends on the thread count. Goldens are kept per grid. A grid with no
+golden is checked against the same tiles done on one thread instead.
+Goldens are made by this build's compiler and flags, so a new compiler
+can need new goldens (-golden), but only after checking why the image
+changed.
+
+Usage: amazebench.py [-csv] [-golden] [<maxthreads> [<repeats> [<size>...]]]
+  -csv      Comma separated results, one row per size, cfa, bits and threads
+  -golden   Write new goldens instead of checking them
+  sizes     Any of %s. Default is all of them
+"""
+# standard python imports. Should not be missing
+import sys,os,time,hashlib
+
+import numpy as np
+
+# So we can use modules from the main dir
+root = os.path.split(sys.path[0])[0]
+sys.path.append(root)
+
+# Now import our own modules
+import bitunpack
+import MlRaw
+
+SIZES = (("1080p",1920,1080),("2.5K",2560,1080),("3.5K",3584,1730),("5.2K",5184,2160))
+BITS = (12,14,16)
+LEVELS = {12:(512,3750),14:(2048,15000),16:(8192,60000)} # black,white
+GOLDEN = os.path.join(sys.path[0],"amazegolden.txt")
+
+__doc__ = __doc__%(", ".join(s[0] for s in SIZES))
+
+def scene(width,height,cfa,seed):
+    """
+    0..1 linear Bayer samples of a test scene for the cfa
+    """
+    y,x = np.mgrid[0:height,0:width].astype(np.float64)
+    u,v = x/width,y/height
+    # Zone plate, which is hard on any demosaic
+    r2 = ((x-width*0.75)**2+(y-height*0.5)**2)/(height*height)
+    zone = 0.5+0.5*np.cos(200.0*r2)
+    red = 0.1+0.8*u
+    green = 0.1+0.8*v
+    blue = 0.4+0.4*zone
+    # Hard edged patches of saturated colours
+    for i,(pr,pg,pb) in enumerate(((1,0,0),(0,1,0),(0,0,1),(1,1,1),(0,0,0))):
+        patch = (np.abs(u-0.1-i*0.08)<0.03)&(np.abs(v-0.2)<0.1)
+        red[patch],green[patch],blue[patch] = pr,pg,pb
+    colours = np.array(((0,1),(1,2)) if cfa==0 else ((1,2),(0,1)))
+    which = colours[(y%2).astype(int),(x%2).astype(int)]
+    bayer = np.choose(which,(red,green,blue))
+    noise = np.random.RandomState(seed).normal(0.0,0.01,bayer.shape)
+    return np.clip(bayer+noise,0.0,1.0)
+
+def pack(values,bits):
+    """
+    Pack values as ML does: an MSB first bitstream of 16bit little endian words
+    """
+    stream = np.unpackbits(values.astype(">u2").view(np.uint8)).reshape(-1,16)[:,16-bits:].ravel()
+    stream = np.concatenate((stream,np.zeros((-len(stream))%16,dtype=np.uint8)))
+    return np.packbits(stream).reshape(-1,2)[:,::-1].tostring()
+
+def frame(width,height,cfa,bits):
+    black,white = LEVELS[bits]
+    values = (black+scene(width,height,cfa,width+cfa)*(white-black)).astype(np.uint16).ravel()
+    values[12345::100003] = 0 # Dead pixels
+    if bits==16:
+        return values.tostring()
+    data = pack(values,bits)
+    # Unpacking masks the dead pixels, so only compare the rest
+    unpacked = np.frombuffer(bitunpack.unpackto16(data,bits,0)[0],dtype=np.uint16)[:len(values)]
+    assert np.array_equal(unpacked[values!=0],values[values!=0])
+    return data
+
+def timeStages(demosaicer,rawdata,width,height,cfa,bits,threads,repeats,tilethreads=None):
+    """
+    Best ms of each stage, and the uint16 result. The tiles are those
+    for tilethreads, when given, instead of threads
+    """
+    cpu = MlRaw.DemosaicThread
+    black = LEVELS[bits][0]
+    tiles = cpu.tiles(width,height,threads=tilethreads or threads)
+    best = [None]*3
+    for r in range(repeats):
+        t0 = time.time()
+        bitunpack.predemosaicbits(demosaicer,rawdata,width,height,black,bits,0)
+        t1 = time.time()
+        bitunpack.demosaictiles(demosaicer,tiles,cfa,threads)
+        t2 = time.time()
+        result = bitunpack.postdemosaic(demosaicer,'H')
+        t3 = time.time()
+        took = (t1-t0,t2-t1,t3-t2)
+        best = [1000.0*t if b==None else min(b,1000.0*t) for b,t in zip(best,took)]
+    return best,result
+
+def readGoldens():
+    goldens = {}
+    if os.path.exists(GOLDEN):
+        for line in open(GOLDEN):
+            if line.strip() and not line.startswith("#"):
+                name,cfa,bits,grid,digest = line.split()
+                goldens[(name,int(cfa),int(bits),grid)] = digest
+    return goldens
+
+def writeGoldens(goldens):
+    f = open(GOLDEN,"w")
+    f.write("# md5 of the uint16 AMaZE output of tools/amazebench.py frames\n")
+    f.write("# size cfa bits grid md5\n")
+    for key in sorted(goldens,key=lambda k:([s[0] for s in SIZES].index(k[0]),k[1],k[2],k[3])):
+        f.write("%s %d %d %s %s\n"%(key+(goldens[key],)))
+    f.close()
+
+def main():
+    args = sys.argv[1:]
+    csv = "-csv" in args
+    golden = "-golden" in args
+    args = [a for a in args if not a.startswith("-")]
+    maxthreads = MlRaw.DemosaicThread.threads
+    repeats = 3
+    sizes = SIZES
+    if len(args)>0: maxthreads = int(args[0])
+    if len(args)>1: repeats = int(args[1])
+    if len(args)>2: sizes = [s for s in SIZES if s[0] in args[2:]]
+    goldens = readGoldens()
+    failures = 0
+    if csv:
+        print "size,width,height,cfa,bits,threads,grid,pre_ms,amaze_ms,post_ms,total_ms,fps,checksum,status"
+    else:
+        print "%d cpus, unpack variant %s, best of %d"%(MlRaw.DemosaicThread.threads,bitunpack.simd(),repeats)
+        print "%6s %3s %4s %7s %5s %8s %9s %8s %9s %7s  %s"%("size","cfa","bits","threads","grid","pre ms","amaze ms","post ms","total ms","fps","checksum")
+    for name,width,height in sizes:
+        demosaicer = bitunpack.demosaicer(width,height)
+        for cfa in (0,1):
+            for bits in BITS:
+                rawdata = frame(width,height,cfa,bits)
+                for threads in range(1,maxthreads+1):
+                    key = (name,cfa,bits,"%dx%d"%MlRaw.DemosaicThread.grid(width,height,threads))
+                    stages,result = timeStages(demosaicer,rawdata,width,height,cfa,bits,threads,repeats)
+                    digest = hashlib.md5(result).hexdigest()
+                    status = "ok"
+                    if key in goldens and not golden:
+                        if digest != goldens[key]:
+                            status = "MISMATCH with golden"
+                    elif threads>1:
+                        ignore,single = timeStages(demosaicer,rawdata,width,height,cfa,bits,1,1,threads)
+                        if hashlib.md5(single).hexdigest() != digest:
+                            status = "MISMATCH with 1 thread"
+                    if status == "ok" and golden:
+                        goldens[key] = digest
+                    elif status == "ok" and key not in goldens:
+                        status = "no golden"
+                    failures += status.startswith("MISMATCH")
+                    total = sum(stages)
+                    if csv:
+                        print "%s,%d,%d,%d,%d,%d,%s,%.2f,%.2f,%.2f,%.2f,%.2f,%s,%s"%((name,width,height,cfa,bits,threads,key[3])+tuple(stages)+(total,1000.0/total,digest,status))
+                    else:
+                        print "%6s %3d %4d %7d %5s %8.1f %9.1f %8.1f %9.1f %7.2f  %s"%((name,cfa,bits,threads,key[3])+tuple(stages)+(total,1000.0/total,status))
+                    sys.stdout.flush()
+    if golden:
+        writeGoldens(goldens)
+    if not csv:
+        print "%d failures"%failures
+    return failures!=0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+#!/usr/bin/python2.7
+"""
+Check clips for clipping and exposure without the GPU.
+Uses the levels measured while each frame is unpacked. Prints one line
+per frame (or only flagged frames with -q) and a summary per clip.
+
+Usage: clipqc.py [-q] [-c <clipped %>] <clip> [<clip>...]
+"""
+# standard python imports. Should not be missing
+import sys,os,getopt
+
+# So we can use modules from the main dir
+root = os.path.split(sys.path[0])[0]
+sys.path.append(root)
+
+# Now import our own modules
+import MlRaw
+
+def check(filename,clipLimit,quiet):
+    r = MlRaw.loadRAWorMLV(filename)
+    frames = r.frames()
+    flagged = 0
+    worst = 0.0
+    exposures = []
+    print "%s: %d frames %dx%d"%(filename,frames,r.width(),r.height())
+    if not quiet:
+        print "%8s %8s %8s %8s %8s %9s"%("frame","R","G1","G2","B","clipped%")
+    for i in range(frames):
+        f = r.frame(i)
+        f.convert()
+        stats = f.framestats
+        if stats == None:
+            continue
+        clipped = stats.clippedFraction()*100.0
+        exposure = [stats.exposure(c) for c in range(4)]
+        exposures.append(exposure[1])
+        worst = max(worst,clipped)
+        flag = clipped>clipLimit
+        if flag:
+            flagged += 1
+        if flag or not quiet:
+            print "%8d %8.3f %8.3f %8.3f %8.3f %8.3f%s"%(i,exposure[0],exposure[1],exposure[2],exposure[3],clipped," CLIPPED" if flag else "")
+    r.close()
+    if len(exposures)>0:
+        print "%s: %d of %d frames over %.2f%% clipped, worst %.3f%%, G1 exposure %.3f-%.3f"%(
+            filename,flagged,frames,clipLimit,worst,min(exposures),max(exposures))
+    return flagged
+
+def main():
+    quiet = False
+    clipLimit = 0.1
+    opts,args = getopt.getopt(sys.argv[1:],"qc:")
+    for opt,value in opts:
+        if opt=="-q": quiet = True
+        elif opt=="-c": clipLimit = float(value)
+    if len(args)==0:
+        print __doc__
+        return 1
+    flagged = 0
+    for filename in args:
+        flagged += check(filename,clipLimit,quiet)
+    return 1 if flagged>0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+#!/usr/bin/python2.7
+"""
+Benchmark CPU (AMaZE) demosaicing. First, how one frame scales from 1 to
+N threads with the tiles chosen for each thread count, against the old
+fixed 4x4 grid. Each result is checked against the same tiles done on
+one thread. Then a stream of frames with one frame at a time against
+several frames in flight, as the export does. Each concurrent result is
+checked against the serial one, and the number of demosaicers the pool
+made is reported. Last, the throughput of each CPU demosaic quality
+against AMaZE, including postdemosaic.
+
+Usage: demosaicbench.py [<width> <height> [<frames> [<inflight> [<maxthreads>]]]]
+"""
+# standard python imports. Should not be missing
+import sys,os,time,threading,Queue
+
+import numpy as np
+
+# So we can use modules from the main dir
+root = os.path.split(sys.path[0])[0]
+sys.path.append(root)
+
+# Now import our own modules
+import bitunpack
+import MlRaw
+
+def frame(width,height,seed):
+    np.random.seed(seed)
+    return np.random.randint(2048,16383,width*height).astype(np.uint16).tostring()
+
+def fixedGrid(width,height):
+    # What was used before tiles were chosen by thread count
+    bw = width/4
+    bw = bw + (4-bw%4)
+    bh = height/4
+    bh = bh + (bh%2)
+    return [(x*bw,y*bh,min(bw,width-x*bw),min(bh,height-y*bh)) for y in range(4) for x in range(4) if x*bw<width and y*bh<height]
+
+def timeTiles(demosaicer,rawdata,width,height,tiles,threads,repeats=3):
+    best = None
+    for r in range(repeats):
+        bitunpack.predemosaic16(demosaicer,rawdata,width,height,2048,0)
+        before = time.time()
+        bitunpack.demosaictiles(demosaicer,tiles,0,threads)
+        took = time.time()-before
+        if best == None or took<best:
+            best = took
+    return best,np.frombuffer(bitunpack.postdemosaic(demosaicer),dtype=np.float32)
+
+def scaling(rawdata,width,height,maxthreads):
+    demosaicer = bitunpack.demosaicer(width,height)
+    print "%8s %8s %10s %8s %6s %12s"%("threads","tiles","ms/frame","speedup","eff","4x4 ms")
+    single = None
+    for n in range(1,maxthreads+1):
+        tiles = MlRaw.DemosaicThread.tiles(width,height,threads=n)
+        took,result = timeTiles(demosaicer,rawdata,width,height,tiles,n)
+        fixed,ignore = timeTiles(demosaicer,rawdata,width,height,fixedGrid(width,height),n)
+        ignore,reference = timeTiles(demosaicer,rawdata,width,height,tiles,1,1)
+        if single == None:
+            single = took
+        print "%8d %8d %10.1f %7.2fx %5.0f%% %12.1f"%(n,len(tiles),1000.0*took,single/took,100.0*single/took/n,1000.0*fixed),
+        if not np.array_equal(result,reference):
+            print "MISMATCH"
+        else:
+            print
+
+def qualities(rawdata,width,height,repeats=3):
+    demosaicer = bitunpack.demosaicer(width,height)
+    cpu = MlRaw.DemosaicThread
+    print "%12s %10s %10s %8s %9s %8s"%("quality","output","ms/frame","fps","Mpix/s","speedup")
+    amaze = None
+    for quality,name in enumerate(cpu.Qualities):
+        best = None
+        for r in range(repeats):
+            bitunpack.predemosaic16(demosaicer,rawdata,width,height,2048,0)
+            before = time.time()
+            cpu.doDemosaic(demosaicer,width,height,0,quality=quality)
+            bitunpack.postdemosaic(demosaicer,'H')
+            took = time.time()-before
+            if best == None or took<best:
+                best = took
+        if amaze == None:
+            amaze = best
+        ow,oh = cpu.outputSize(width,height,quality)
+        print "%12s %10s %10.1f %8.1f %9.1f %7.1fx"%(name,"%dx%d"%(ow,oh),1000.0*best,1.0/best,width*height/best/1e6,amaze/best)
+
+def stream(frames,width,height,inflight):
+    """
+    Demosaic all frames with inflight at a time. Returns results in order
+    """
+    results = [None]*len(frames)
+    jobq = Queue.Queue()
+    def worker():
+        job = jobq.get()
+        while job != None:
+            i = job
+            results[i] = MlRaw.demosaic16(frames[i],width,height,2048)
+            job = jobq.get()
+    threads = [threading.Thread(target=worker) for i in range(inflight)]
+    for t in threads:
+        t.start()
+    for i in range(len(frames)):
+        jobq.put(i)
+    for t in threads:
+        jobq.put(None)
+    for t in threads:
+        t.join()
+    return results
+
+def main():
+    width,height = 1920,1080
+    count = 8
+    inflight = MlRaw.DemosaicThread.FramesInFlight
+    if len(sys.argv)>2: width,height = int(sys.argv[1]),int(sys.argv[2])
+    if len(sys.argv)>3: count = int(sys.argv[3])
+    maxthreads = MlRaw.DemosaicThread.threads
+    if len(sys.argv)>4: inflight = int(sys.argv[4])
+    if len(sys.argv)>5: maxthreads = int(sys.argv[5])
+    frames = [frame(width,height,i) for i in range(count)]
+    pool = MlRaw.DemosaicThread.demosaicers
+    print "%dx%d, %d cpus"%(width,height,MlRaw.DemosaicThread.threads)
+    scaling(frames[0],width,height,maxthreads)
+    print "%d frames"%count
+    print "%9s %10s %8s %8s %12s"%("inflight","ms/frame","fps","speedup","demosaicers")
+    serial = None
+    reference = None
+    for n in sorted(set((1,inflight))):
+        created = pool.created
+        before = time.time()
+        results = stream(frames,width,height,n)
+        took = time.time()-before
+        if reference == None:
+            reference = results
+            serial = took
+        bad = sum([not np.array_equal(a,b) for a,b in zip(reference,results)])
+        print "%9d %10.1f %8.2f %7.2fx %12d"%(n,1000.0*took/count,count/took,serial/took,pool.created-created),
+        if bad:
+            print "MISMATCH in %d frames"%bad
+        else:
+            print
+    print "Qualities on %d threads"%MlRaw.DemosaicThread.threads
+    qualities(frames[0],width,height)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+#!/usr/bin/python2.7
+"""
+Benchmark unpacking a run of frames the way a DNG export does, with a
+few frames in flight at once. Compares a new buffer per frame with
+unpacking into buffers from the MlRaw frame buffer pool, reporting
+time per frame, buffers allocated and peak RSS.
+Each mode runs in its own process so peak RSS is not shared.
+
+Usage: framebufbench.py [<frames> [<width> <height> [<inflight>]]]
+"""
+# standard python imports. Should not be missing
+import sys,os,time,subprocess,resource,collections
+
+import numpy as np
+
+# So we can use modules from the main dir
+root = os.path.split(sys.path[0])[0]
+sys.path.append(root)
+
+def run(mode,frames,width,height,inflight):
+    # Now import our own modules
+    import MlRaw,bitunpack
+    raw = np.random.randint(0,256,width*height*14/8).astype(np.uint8).tostring()
+    held = collections.deque()
+    allocated = 0
+    before = time.time()
+    for i in range(frames):
+        if mode=="new":
+            unpacked,stats = bitunpack.unpack14to16(raw,0)
+            image = np.frombuffer(unpacked,dtype=np.uint16)
+            allocated += 1
+        else:
+            image,stats = MlRaw.unpacks14np16(raw,width,height)
+        held.append(image) # Frames waiting to be written
+        if len(held)>inflight:
+            held.popleft()
+    elapsed = time.time()-before
+    if mode=="pool":
+        allocated = MlRaw.FrameBuffers.allocated
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform=="darwin":
+        peak /= 1024 # Bytes rather than KB
+    print "%6s %10.3f %10d %10.1f"%(mode,elapsed*1000.0/frames,allocated,peak/1024.0)
+
+def main():
+    frames = 200
+    width,height = 1920,1080
+    inflight = 8
+    if len(sys.argv)>1 and sys.argv[1]=="--run":
+        run(sys.argv[2],*[int(a) for a in sys.argv[3:]])
+        return
+    if len(sys.argv)>1: frames = int(sys.argv[1])
+    if len(sys.argv)>3: width,height = int(sys.argv[2]),int(sys.argv[3])
+    if len(sys.argv)>4: inflight = int(sys.argv[4])
+    print "%d frames of %dx%d, %d in flight"%(frames,width,height,inflight)
+    print "%6s %10s %10s %10s"%("mode","ms/frame","allocated","peak MB")
+    for mode in ("new","pool"):
+        sys.stdout.flush()
+        subprocess.call([sys.executable,sys.argv[0],"--run",mode,str(frames),str(width),str(height),str(inflight)])
+
+if __name__ == '__main__':
+    sys.exit(main())
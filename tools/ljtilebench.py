@@ -0,0 +1,177 @@
+#!/usr/bin/python2.7
+"""
+Benchmark decoding LJ92 compressed CinemaDNG frames, comparing tiles
+decoded one after another (1 thread) with the tiles spread over 2..N
+native threads.
+
+Synthetic sequences are made with several tile layouts, from one tile
+up to BMD style grids with padded edge tiles, by the DNG export's
+encoder. Encoding is timed too, one tile after another against all
+tiles on the unpack workers. Each decoded frame is checked against the
+frame that was encoded. With a CinemaDNG directory, its LJ92 frames
+are timed too, and checked against the 1 thread result.
+
+Usage: ljtilebench.py [<width> <height> [<frames> [<maxthreads>]]] [<cdng dir>]
+"""
+# standard python imports. Should not be missing
+import sys,os,time
+
+import numpy as np
+
+# So we can use modules from the main dir
+root = os.path.split(sys.path[0])[0]
+sys.path.append(root)
+
+# Now import our own modules
+import bitunpack
+import MlRaw
+import DNG
+
+def layouts(width,height):
+    """
+    (name,tilewidth,tilelength) for some tile grids
+    """
+    # Tiles are even sized so they start on a Bayer quad
+    def size(length,count):
+        return ((length+count-1)/count+1)&~1
+    grids = [(1,1),(2,1),(2,2),(4,2),(4,4)]
+    result = [("%dx%d"%g,size(width,g[0]),size(height,g[1])) for g in grids]
+    result.append(("256px",256,256))
+    return result
+
+def encodeSerial(frame,width,height,tw,tl):
+    """
+    The tiles packLJ makes, one after another on this thread
+    """
+    return [bitunpack.pack16tolj(*job) for job in MlRaw.UnpackThreads.packLJJobs(frame,width,height,tw,tl)]
+
+def timeEncode(frames,width,height,tw,tl,encode,repeats=3):
+    """
+    Best ms per frame encoding the frames, and the encoded sequence
+    """
+    best = None
+    for r in range(repeats):
+        before = time.time()
+        sequence = [[str(t) for t in encode(f,width,height,tw,tl)] for f in frames]
+        took = 1000.0*(time.time()-before)/len(frames)
+        if best == None or took<best:
+            best = took
+    return best,sequence
+
+def syntheticFrames(width,height,count):
+    frames = []
+    for i in range(count):
+        np.random.seed(i)
+        y,x = np.mgrid[0:height,0:width]
+        frame = 2048+((x*7+y*3+i*50)%8000)+np.random.randint(0,64,(height,width))
+        frames.append(frame.astype(np.uint16).ravel())
+    return frames
+
+def timeDecode(sequence,width,height,tw,tl,threads,output,repeats=3):
+    """
+    Best ms per frame decoding the sequence, and the status of each frame
+    """
+    best = None
+    for r in range(repeats):
+        statuses = []
+        before = time.time()
+        for tiles in sequence:
+            statuses.append(bitunpack.unpackljtiles(tiles,output,width,height,tw,tl,"",threads))
+        took = 1000.0*(time.time()-before)/len(sequence)
+        if best == None or took<best:
+            best = took
+    return best,statuses
+
+def header():
+    print "%8s %7s %6s %7s %10s %8s %8s"%("layout","tiles","tile","threads","ms/frame","fps","speedup")
+
+def report(name,tiles,tw,tl,threads,took,single,ok):
+    print "%8s %7d %6s %7d %10.2f %8.1f %7.2fx"%(name,tiles,"%dx%d"%(tw,tl),threads,took,1000.0/took,single/took),
+    print "" if ok else "MISMATCH"
+
+def synthetic(width,height,count,maxthreads):
+    frames = syntheticFrames(width,height,count)
+    output = np.zeros(width*height,dtype=np.uint16)
+    failures = 0
+    print "%dx%d, %d frame sequences"%(width,height,count)
+    print "Encoding on %d unpack workers"%MlRaw.UnpackThreads.threads
+    print "%8s %7s %6s %12s %12s %8s"%("layout","tiles","tile","serial ms","workers ms","speedup")
+    sequences = []
+    for name,tw,tl in layouts(width,height):
+        serial,reference = timeEncode(frames,width,height,tw,tl,encodeSerial)
+        took,sequence = timeEncode(frames,width,height,tw,tl,MlRaw.UnpackThreads.packLJ)
+        ok = sequence == reference
+        failures += not ok
+        print "%8s %7d %6s %12.2f %12.2f %7.2fx"%(name,len(sequence[0]),"%dx%d"%(tw,tl),serial,took,serial/took),
+        print "" if ok else "MISMATCH"
+        sequences.append(sequence)
+    print "Decoding"
+    header()
+    for (name,tw,tl),sequence in zip(layouts(width,height),sequences):
+        single = None
+        for threads in range(1,maxthreads+1):
+            took,statuses = timeDecode(sequence,width,height,tw,tl,threads,output)
+            if single == None:
+                single = took
+            ok = not any(any(s) for s in statuses)
+            # Decode each frame again to check it
+            for f,tiles in zip(frames,sequence):
+                output[:] = 0
+                ok &= not any(bitunpack.unpackljtiles(tiles,output,width,height,tw,tl,"",threads))
+                ok &= np.array_equal(output,f)
+            failures += not ok
+            report(name,len(sequence[0]),tw,tl,threads,took,single,ok)
+    return failures
+
+def cdng(path,count,maxthreads):
+    names = sorted([n for n in os.listdir(path) if n.lower().endswith(".dng") and n[0]!='.'])[:count]
+    sequence = []
+    for n in names:
+        d = DNG.DNG()
+        d.readFileIn(os.path.join(path,n))
+        ifd = d.FULL_IFD
+        if not ifd.hasTiles():
+            print n,"is not tiled"
+            return 1
+        width,height = ifd.width,ifd.length
+        tw,tl = ifd.TileWidth,ifd.TileLength
+        sequence.append([str(t) for t in ifd.tiles()])
+        d.close()
+    output = np.zeros(width*height,dtype=np.uint16)
+    reference = np.zeros(width*height,dtype=np.uint16)
+    failures = 0
+    print "%s: %dx%d, %d frames"%(path,width,height,len(sequence))
+    header()
+    single = None
+    for threads in range(1,maxthreads+1):
+        took,statuses = timeDecode(sequence,width,height,tw,tl,threads,output)
+        if single == None:
+            single = took
+        ok = not any(any(s) for s in statuses)
+        for tiles in sequence:
+            bitunpack.unpackljtiles(tiles,reference,width,height,tw,tl,"",1)
+            bitunpack.unpackljtiles(tiles,output,width,height,tw,tl,"",threads)
+            ok &= np.array_equal(output,reference)
+        failures += not ok
+        report("cdng",len(sequence[0]),tw,tl,threads,took,single,ok)
+    return failures
+
+def main():
+    args = sys.argv[1:]
+    path = None
+    if args and os.path.isdir(args[-1]):
+        path = args.pop()
+    width,height = 1920,1080
+    count = 8
+    maxthreads = MlRaw.UnpackThreads.threads
+    if len(args)>1: width,height = int(args[0]),int(args[1])
+    if len(args)>2: count = int(args[2])
+    if len(args)>3: maxthreads = int(args[3])
+    failures = synthetic(width,height,count,maxthreads)
+    if path:
+        failures += cdng(path,count,maxthreads)
+    print "%d failures"%failures
+    return failures!=0
+
+if __name__ == '__main__':
+    sys.exit(main())
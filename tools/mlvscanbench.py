@@ -0,0 +1,111 @@
+#!/usr/bin/python2.7
+"""
+Benchmark walking MLV blocks on a synthetic multi-GB clip.
+Compares the old per-block seek/read/unpack loop with the mapped
+block scanner, and times a full MLV open and index, and opening
+with an .IDX sidecar.
+
+Usage: mlvscanbench.py [<GB> [<spans> [<tmpdir>]]]
+"""
+# standard python imports. Should not be missing
+import sys,struct,os,time,tempfile,shutil
+
+# So we can use modules from the main dir
+root = os.path.split(sys.path[0])[0]
+sys.path.append(root)
+
+import mlvsynth
+
+# Now import our own modules
+import MlRaw,MlvIndex
+
+def seekReadScan(names):
+    blocks = 0
+    for name in names:
+        fh = file(name,'rb')
+        fh.seek(0,os.SEEK_END)
+        size = fh.tell()
+        pos = 0
+        while pos<size-8:
+            fh.seek(pos)
+            blockType,blockSize = struct.unpack("II",fh.read(8))
+            if blockType==MlRaw.MLV.BlockType.VideoFrame:
+                fh.seek(pos+8)
+                struct.unpack("<QI4H2I",fh.read(28))
+            pos += blockSize
+            blocks += 1
+        fh.close()
+    return blocks
+
+def mappedScan(names):
+    blocks = 0
+    for name in names:
+        fh = file(name,'rb')
+        span = MlvIndex.SpanMap(fh)
+        pos = 0
+        while pos<span.size:
+            recs,pos = span.blocks(pos,maxblocks=4096)
+            if len(recs)==0:
+                break
+            blocks += len(recs)
+        span.close()
+        fh.close()
+    return blocks
+
+def fullIndex(names):
+    r = MlRaw.MLV(names[0])
+    while r.indexingStatus()<1.0:
+        time.sleep(0.001)
+    frames = len(r.framepos)
+    r.close()
+    return frames
+
+def xrefIndex(names):
+    r = MlRaw.MLV(names[0])
+    frames = r.frames()
+    for i in range(frames):
+        r._getframedata(i)
+    r.close()
+    return frames
+
+def xrefOpen(names):
+    r = MlRaw.MLV(names[0])
+    r._getframedata(r.frames()/2)
+    r.close()
+    return 1
+
+def report(name,blocks,size,elapsed):
+    print "%-20s %8d blocks %8.3fs %12.0f blocks/s %8.2f GB/s"%(name,blocks,elapsed,blocks/elapsed,size/elapsed/1e9)
+
+def main():
+    gb = 4.0
+    spans = 1
+    tmpdir = None
+    if len(sys.argv)>1: gb = float(sys.argv[1])
+    if len(sys.argv)>2: spans = int(sys.argv[2])
+    if len(sys.argv)>3: tmpdir = sys.argv[3]
+    workdir = tempfile.mkdtemp(dir=tmpdir)
+    try:
+        width,height = 1920,1080
+        frames = int(gb*1e9/(width*height*14/8))
+        print "Writing %d frame synthetic clip (%.1f GB, %d spans)"%(frames,gb,spans)
+        names,positions = mlvsynth.writeMlv(os.path.join(workdir,"BENCH"),frames,width,height,spans=spans)
+        size = sum([os.path.getsize(n) for n in names])
+        for name,scan in (("seek+read",seekReadScan),("mapped scanner",mappedScan),("MLV open+index",fullIndex)):
+            before = time.time()
+            blocks = scan(names)
+            report(name,blocks,size,time.time()-before)
+        # Drop the index saved by the full scan so the IDX gets used
+        mrx = MlRaw.ImageSequence.userMetadataNameFromOriginal(names[0])
+        if os.path.exists(mrx):
+            os.remove(mrx)
+        mlvsynth.writeIdx(os.path.join(workdir,"BENCH"),positions)
+        for name,scan in (("IDX open+seek",xrefOpen),("IDX all frames",xrefIndex)):
+            before = time.time()
+            blocks = scan(names)
+            report(name,blocks,size,time.time()-before)
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    sys.exit(main())
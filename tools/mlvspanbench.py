@@ -0,0 +1,63 @@
+#!/usr/bin/python2.7
+"""
+Benchmark scanning spanned MLV clips with one thread against one
+thread per span, for increasing span counts.
+Point tmpdir at the storage to be measured. For cold cache numbers,
+drop the OS file cache between runs (e.g. Linux: echo 3 > /proc/sys/vm/drop_caches)
+
+Usage: mlvspanbench.py [<GB> [<tmpdir> [<width> <height>]]]
+"""
+# standard python imports. Should not be missing
+import sys,os,time,tempfile,shutil,Queue
+
+# So we can use modules from the main dir
+root = os.path.split(sys.path[0])[0]
+sys.path.append(root)
+
+import mlvsynth
+
+# Now import our own modules
+import MlvIndex
+
+def scan(names,threads):
+    fhs = [file(n,'rb') for n in names]
+    ranges = [(i,0,os.path.getsize(n)) for i,n in enumerate(names)]
+    scanner = MlvIndex.ParallelScanner(fhs,ranges,threads)
+    blocks = 0
+    for fhi in range(len(names)):
+        while 1:
+            chunk = scanner.next(fhi,1.0)
+            if chunk == None:
+                break
+            blocks += len(chunk[0])
+    scanner.stop()
+    for fh in fhs:
+        fh.close()
+    return blocks
+
+def main():
+    gb = 4.0
+    tmpdir = None
+    width,height = 640,360
+    if len(sys.argv)>1: gb = float(sys.argv[1])
+    if len(sys.argv)>2: tmpdir = sys.argv[2]
+    if len(sys.argv)>4: width,height = int(sys.argv[3]),int(sys.argv[4])
+    frames = int(gb*1e9/(width*height*14/8))
+    print "%d frames of %dx%d, %.1f GB, %d cpus"%(frames,width,height,gb,MlvIndex.SCAN_THREADS)
+    print "%6s %10s %10s %8s"%("spans","1 thread","N threads","speedup")
+    for spans in (1,2,4,8,16):
+        workdir = tempfile.mkdtemp(dir=tmpdir)
+        try:
+            names,positions = mlvsynth.writeMlv(os.path.join(workdir,"BENCH"),frames,width,height,spans=spans)
+            before = time.time()
+            scan(names,1)
+            serial = time.time()-before
+            before = time.time()
+            scan(names,spans)
+            parallel = time.time()-before
+            print "%6d %9.3fs %9.3fs %7.2fx"%(spans,serial,parallel,serial/parallel)
+        finally:
+            shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+#!/usr/bin/python2.7
+"""
+Write synthetic MLV clips for benchmarking and checking the MLV reader.
+Frame payloads are left as holes (sparse files) unless asked for, so
+multi-GB clips can be made quickly without using the disk space.
+"""
+# standard python imports. Should not be missing
+import sys,struct,os
+
+def block(blockType,payload):
+    return struct.pack("<4sI",blockType,8+len(payload))+payload
+
+def fileHeader(spanIndex,spanCount,videoFrames,audioFrames=0,fpsnum=25000,fpsden=1000):
+    return block("MLVI",struct.pack("<8sQHHIHHIIII","v2.0",0x1234,spanIndex,spanCount,0,1,0,videoFrames,audioFrames,fpsnum,fpsden))
+
+def rawInfo(width,height,bits=14,black=2048,white=15000):
+    ri = [0]*40
+    ri[2] = height
+    ri[3] = width
+    ri[4] = width*bits/8
+    ri[5] = width*height*bits/8
+    ri[6] = bits
+    ri[7] = black
+    ri[8] = white
+    ri[11] = width
+    ri[12] = height
+    ri[15] = height
+    ri[16] = width
+    # Identity colour matrix as rationals
+    for i in range(9):
+        ri[21+2*i] = 1 if i in (0,4,8) else 0
+        ri[22+2*i] = 1
+    return block("RAWI",struct.pack("<Q2H40i",0,width,height,*ri))
+
+def rtc(timestamp=0):
+    return block("RTCI",struct.pack("<Q10H8s",timestamp,0,0,12,1,1,114,0,0,0,0,""))
+
+def expo(timestamp=0,iso=100,shutter=20000):
+    return block("EXPO",struct.pack("<Q4IQ",timestamp,0,iso,iso,0,shutter))
+
+def lens(timestamp=0,focal=50):
+    return block("LENS",struct.pack("<Q3HBBII32s32s",timestamp,focal,0,280,0,0,0,0,"Synthetic 50mm","0"))
+
+def wbal(timestamp=0):
+    return block("WBAL",struct.pack("<Q7I",timestamp,0,5500,0,0,0,0,0))
+
+def xref(entries,frameType=1):
+    data = "".join([struct.pack("<HHQ",fn,0,offset) for fn,offset in entries])
+    return block("XREF",struct.pack("<QII",0,frameType,len(entries))+data)
+
+def videoFrameHeader(frameNumber,payloadSize,frameSpace=0,timestamp=0):
+    return struct.pack("<4sIQI4HI","VIDF",32+frameSpace+payloadSize,timestamp,frameNumber,0,0,0,0,frameSpace)
+
+def framePayload(frameNumber,size):
+    """
+    Recognisable payload for checking reads
+    """
+    stamp = struct.pack("<I",frameNumber)
+    return (stamp*(size/4+1))[:size]
+
+def spanNames(basename,spans):
+    names = [basename+".MLV"]
+    for i in range(1,spans):
+        names.append(basename+".M%02d"%(i-1))
+    return names
+
+def writeMlv(basename,frames,width=1920,height=1080,bits=14,spans=1,frameSpace=0,payload=False,metadataEvery=0,xrefBlock=False,idx=False):
+    """
+    Write an MLV clip of the given number of frames split across spans.
+    Returns the list of span file names and the (span,offset) of each frame.
+    """
+    frameSize = width*height*bits/8
+    names = spanNames(basename,spans)
+    perSpan = (frames+spans-1)/spans
+    positions = []
+    frame = 0
+    for spanIndex,name in enumerate(names):
+        spanFrames = min(perSpan,frames-frame)
+        f = file(name,'wb')
+        f.write(fileHeader(spanIndex,spans,spanFrames))
+        if spanIndex==0:
+            f.write(rawInfo(width,height,bits))
+        f.write(rtc())
+        f.write(expo())
+        f.write(lens())
+        f.write(wbal())
+        for i in range(spanFrames):
+            if metadataEvery>0 and frame>0 and frame%metadataEvery==0:
+                f.write(expo(iso=100*(1+(frame/metadataEvery)%32)))
+            positions.append((spanIndex,f.tell()))
+            f.write(videoFrameHeader(frame,frameSize,frameSpace))
+            if payload:
+                f.write("\0"*frameSpace)
+                f.write(framePayload(frame,frameSize))
+            else:
+                f.seek(frameSpace+frameSize,os.SEEK_CUR)
+            frame += 1
+        if xrefBlock and spanIndex==len(names)-1:
+            f.write(xref(positions))
+        f.truncate(f.tell())
+        f.close()
+    if idx:
+        writeIdx(basename,positions)
+    return names,positions
+
+def writeIdx(basename,positions):
+    """
+    Write an .IDX sidecar holding the XREF of a clip, like mlv_dump does
+    """
+    f = file(basename+".IDX",'wb')
+    f.write(fileHeader(0,1,0))
+    f.write(xref(positions))
+    f.close()
+
+if __name__ == '__main__':
+    if len(sys.argv)<3:
+        print "Usage: mlvsynth.py <basename> <frames> [<spans>]"
+        sys.exit(1)
+    spans = 1
+    if len(sys.argv)>3:
+        spans = int(sys.argv[3])
+    names,positions = writeMlv(sys.argv[1],int(sys.argv[2]),spans=spans)
+    print "Wrote",", ".join(names)
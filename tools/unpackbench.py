@@ -0,0 +1,108 @@
+#!/usr/bin/python2.7
+"""
+Benchmark the packed raw unpack variants (scalar, sse2, ssse3, avx2)
+for 10, 12 and 14bit data, reporting GB/s of packed input per variant.
+Each variant is first checked against the scalar output.
+Then compares one frame unpacked in a single call with the frame
+split across the unpack threads. Last, times each bit depth through
+the Frame conversion (unpack and levels) and the demosaic preparation,
+and the 1/2, 1/4 and 1/8 size decodes used for scrubbing and thumbnails.
+
+Usage: unpackbench.py [<width> <height> [<repeats>]]
+"""
+# standard python imports. Should not be missing
+import sys,os,time
+
+import numpy as np
+
+# So we can use modules from the main dir
+root = os.path.split(sys.path[0])[0]
+sys.path.append(root)
+
+# Now import our own modules
+import bitunpack
+import MlRaw
+
+def packed(width,height,bits):
+    data = np.random.randint(0,256,(width*height*bits+7)/8).astype(np.uint8)
+    # Some dead pixels too
+    data[::997] = 0
+    return data.tostring()
+
+def main():
+    width,height = 3584,1730
+    repeats = 20
+    if len(sys.argv)>2: width,height = int(sys.argv[1]),int(sys.argv[2])
+    if len(sys.argv)>3: repeats = int(sys.argv[3])
+    best = bitunpack.simd()
+    variants = bitunpack.simdvariants()
+    print "%dx%d frames, %d repeats, default variant %s"%(width,height,repeats,best)
+    print "%5s %5s %8s %10s %10s %8s"%("bits","swap","variant","ms/frame","GB/s","speedup")
+    try:
+        for bits in (10,12,14):
+            data = packed(width,height,bits)
+            for swap in (0,1):
+                bitunpack.setsimd("scalar")
+                reference = bitunpack.unpackto16(data,bits,swap)[0]
+                scalar = None
+                for variant in variants:
+                    bitunpack.setsimd(variant)
+                    if bitunpack.unpackto16(data,bits,swap)[0] != reference:
+                        print "%5d %5d %8s MISMATCH"%(bits,swap,variant)
+                        continue
+                    before = time.time()
+                    for i in range(repeats):
+                        bitunpack.unpackto16(data,bits,swap)
+                    elapsed = (time.time()-before)/repeats
+                    if scalar == None:
+                        scalar = elapsed
+                    print "%5d %5d %8s %10.3f %10.2f %7.2fx"%(bits,swap,variant,elapsed*1000.0,len(data)/elapsed/1e9,scalar/elapsed)
+    finally:
+        bitunpack.setsimd(best)
+    threads = MlRaw.UnpackThreads.threads
+    print
+    print "%5s %10s %10s %8s (%d threads)"%("bits","single","split","speedup",threads)
+    for bits in (10,12,14):
+        data = packed(width,height,bits)
+        reference = bitunpack.unpackto16(data,bits,0)[0]
+        if MlRaw.UnpackThreads.unpack(data,width*height,bits,0).tostring() != reference:
+            print "%5d MISMATCH"%bits
+            continue
+        before = time.time()
+        for i in range(repeats):
+            bitunpack.unpackto16(data,bits,0)
+        single = (time.time()-before)/repeats
+        before = time.time()
+        for i in range(repeats):
+            MlRaw.UnpackThreads.unpack(data,width*height,bits,0)
+        split = (time.time()-before)/repeats
+        print "%5d %8.3fms %8.3fms %7.2fx"%(bits,single*1000.0,split*1000.0,single/split)
+    print
+    print "%5s %10s %10s %12s %10s"%("bits","convert","GB/s","predemosaic","GB/s")
+    demosaicer = bitunpack.demosaicer(width,height)
+    for bits in (10,12,14,16):
+        data = packed(width,height,bits)
+        before = time.time()
+        for i in range(repeats):
+            frame = MlRaw.Frame(None,data,width,height,2048,15000,bitsPerSample=bits,convert=False)
+            frame._convert()
+        convert = (time.time()-before)/repeats
+        before = time.time()
+        for i in range(repeats):
+            bitunpack.predemosaicbits(demosaicer,data,width,height,2048,bits,0)
+        prepare = (time.time()-before)/repeats
+        print "%5d %8.3fms %10.2f %10.3fms %10.2f"%(bits,convert*1000.0,len(data)/convert/1e9,prepare*1000.0,len(data)/prepare/1e9)
+    print
+    print "%5s %10s %10s %10s"%("bits","1/2","1/4","1/8")
+    for bits in (10,12,14,16):
+        data = packed(width,height,bits)
+        times = []
+        for factor in (2,4,8):
+            before = time.time()
+            for i in range(repeats):
+                MlRaw.UnpackThreads.reduced(data,width,height,bits,0,factor,2048)
+            times.append((time.time()-before)/repeats)
+        print "%5d %8.3fms %8.3fms %8.3fms"%tuple([bits]+[t*1000.0 for t in times])
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,798 @@
+/*
+unpack_simd.c, part of MlRawViewer
+(c) Andrew Baldwin 2014
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+*/
+
+/*
+Unpacking of Canon packed raw data (10, 12 or 14 bit values packed MSB
+first into a stream of 16bit little endian words) to 16bit values.
+
+Every 8 pixels take exactly "bits" bytes, so the data is handled in
+groups of 8 pixels. Each pixel of a group is either inside one word
+or split across two neighbouring words, and can be made with:
+   p = ((X * Lmul) | ((Y * Rmul) >> 16)) & mask
+where X and Y are words of the group picked per lane. The SSSE3 and
+AVX2 versions pick the words with a byte shuffle so one table works for
+any bit depth. The SSE2 version only handles 14bit where the words needed
+line up with the pixel lanes.
+
+The variant is chosen at import time from what the CPU supports. The
+scalar loop is always there as a fallback and for the group tails.
+
+unpack_frame also linearizes, subtracts black and measures per channel
+levels as it goes, a chunk at a time while the unpacked values are
+still in cache.
+*/
+
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+
+#include "unpack_simd.h"
+
+#if defined(__x86_64__) || defined(__i386__) || defined(_M_X64) || defined(_M_IX86)
+#define UNPACK_X86 1
+#include <emmintrin.h>
+#include <tmmintrin.h>
+#include <immintrin.h>
+#if defined(_MSC_VER)
+#include <intrin.h>
+#define TARGET_SSSE3
+#define TARGET_AVX2
+#else
+#define TARGET_SSSE3 __attribute__((target("ssse3")))
+#define TARGET_AVX2 __attribute__((target("avx2")))
+#endif
+/* Every AVX2 CPU also has the F16C half float conversions */
+#if defined(_MSC_VER)
+#define TARGET_F16C
+#else
+#define TARGET_F16C __attribute__((target("avx2,f16c")))
+#endif
+#endif
+
+static const char* UNPACK_NAMES[] = { "scalar", "sse2", "ssse3", "avx2" };
+
+const char*
+unpack_simd_name(int level)
+{
+    if (level<UNPACK_SCALAR || level>UNPACK_AVX2)
+        return "unknown";
+    return UNPACK_NAMES[level];
+}
+
+int
+unpack_simd_level(const char* name)
+{
+    int level;
+    for (level=UNPACK_SCALAR;level<=UNPACK_AVX2;level++)
+        if (strcmp(name,UNPACK_NAMES[level])==0)
+            return level;
+    return -1;
+}
+
+int
+unpack_simd_detect(void)
+{
+#ifdef UNPACK_X86
+#if defined(_MSC_VER)
+    int info[4];
+    int level = UNPACK_SCALAR;
+    __cpuid(info,0);
+    int maxleaf = info[0];
+    __cpuid(info,1);
+    if (info[3]&(1<<26)) level = UNPACK_SSE2;
+    if (info[2]&(1<<9)) level = UNPACK_SSSE3;
+    /* AVX2 needs the OS to save the YMM registers as well */
+    if (maxleaf>=7 && (info[2]&(1<<27)) && (_xgetbv(0)&6)==6) {
+        __cpuidex(info,7,0);
+        if (info[1]&(1<<5)) level = UNPACK_AVX2;
+    }
+    return level;
+#else
+    __builtin_cpu_init();
+    if (__builtin_cpu_supports("avx2")) return UNPACK_AVX2;
+    if (__builtin_cpu_supports("ssse3")) return UNPACK_SSSE3;
+    if (__builtin_cpu_supports("sse2")) return UNPACK_SSE2;
+    return UNPACK_SCALAR;
+#endif
+#else
+    return UNPACK_SCALAR;
+#endif
+}
+
+/*
+Dead pixel masking: a 0 value is replaced by the last value of the same colour
+*/
+static inline void
+unpack_deadpixels(uint16_t* output, int first, int count)
+{
+    int i;
+    for (i=first;i<first+count;i++)
+        if (output[i]==0 && i>=2)
+            output[i] = output[i-2];
+}
+
+static inline uint32_t
+unpack_word(const uint8_t* input, int length, int pos, int swap)
+{
+    uint32_t b0 = pos<length?input[pos]:0;
+    uint32_t b1 = pos+1<length?input[pos+1]:0;
+    return swap?((b0<<8)|b1):((b1<<8)|b0);
+}
+
+static void
+unpack_scalar(const uint8_t* input, int length, uint16_t* output, int first, int elements, int bits, int swap)
+{
+    uint32_t acc = 0;
+    uint32_t mask = (1<<bits)-1;
+    int have = 0;
+    int pos = (first*bits)>>3;
+    int i;
+    for (i=first;i<elements;i++) {
+        uint32_t out;
+        if (have<bits) {
+            uint32_t w;
+            if (pos+1<length) {
+                uint16_t word;
+                memcpy(&word,input+pos,2);
+                w = word;
+                if (swap)
+                    w = ((w&0xFF)<<8)|(w>>8);
+            } else
+                w = unpack_word(input,length,pos,swap);
+            pos += 2;
+            acc = (acc<<16)|w;
+            have += 16;
+        }
+        have -= bits;
+        out = (acc>>have)&mask;
+        if (out==0 && i>=2) out = output[i-2]; // Dead pixel masking
+        output[i] = out;
+    }
+}
+
+#ifdef UNPACK_X86
+/*
+Per lane word choice and multipliers for the group formula above.
+Shuffle entries of 0x80 give a zero lane.
+*/
+typedef struct {
+    uint8_t xshuf[16];
+    uint8_t yshuf[16];
+    uint16_t lmul[8];
+    uint16_t rmul[8];
+} unpack_tables;
+
+static void
+unpack_maketables(unpack_tables* t, int bits, int swap)
+{
+    int k;
+    for (k=0;k<8;k++) {
+        int offset = k*bits;
+        int a = offset>>4;
+        int avail = 16-(offset&15);
+        int xword = -1;
+        int yword = -1;
+        if (avail>bits) {
+            /* Inside word a, shifted down by what follows it */
+            yword = a;
+            t->lmul[k] = 0;
+            t->rmul[k] = 1<<(16-(avail-bits));
+        } else if (avail==bits) {
+            xword = a;
+            t->lmul[k] = 1;
+            t->rmul[k] = 0;
+        } else {
+            int need = bits-avail;
+            xword = a;
+            yword = a+1;
+            t->lmul[k] = 1<<need;
+            t->rmul[k] = 1<<need;
+        }
+        t->xshuf[k*2] = xword<0?0x80:(xword*2+(swap?1:0));
+        t->xshuf[k*2+1] = xword<0?0x80:(xword*2+(swap?0:1));
+        t->yshuf[k*2] = yword<0?0x80:(yword*2+(swap?1:0));
+        t->yshuf[k*2+1] = yword<0?0x80:(yword*2+(swap?0:1));
+    }
+}
+
+static int
+unpack_sse2_14(const uint8_t* input, int length, uint16_t* output, int elements, int swap)
+{
+    const __m128i lmul = _mm_setr_epi16(0,1<<12,1<<10,1<<8,1<<6,1<<4,1<<2,1);
+    const __m128i rmul = _mm_setr_epi16(1<<14,1<<12,1<<10,1<<8,1<<6,1<<4,1<<2,0);
+    const __m128i mask = _mm_set1_epi16(0x3FFF);
+    const __m128i zero = _mm_setzero_si128();
+    int i = 0;
+    while (i+8<=elements && (i/8)*14+16<=length) {
+        __m128i w = _mm_loadu_si128((const __m128i*)(input+(i/8)*14));
+        if (swap)
+            w = _mm_or_si128(_mm_slli_epi16(w,8),_mm_srli_epi16(w,8));
+        __m128i x = _mm_slli_si128(w,2);
+        __m128i p = _mm_or_si128(_mm_mullo_epi16(x,lmul),_mm_mulhi_epu16(w,rmul));
+        p = _mm_and_si128(p,mask);
+        _mm_storeu_si128((__m128i*)(output+i),p);
+        if (_mm_movemask_epi8(_mm_cmpeq_epi16(p,zero)))
+            unpack_deadpixels(output,i,8);
+        i += 8;
+    }
+    return i;
+}
+
+TARGET_SSSE3 static int
+unpack_ssse3(const uint8_t* input, int length, uint16_t* output, int elements, int bits, int swap)
+{
+    unpack_tables t;
+    unpack_maketables(&t,bits,swap);
+    const __m128i xshuf = _mm_loadu_si128((const __m128i*)t.xshuf);
+    const __m128i yshuf = _mm_loadu_si128((const __m128i*)t.yshuf);
+    const __m128i lmul = _mm_loadu_si128((const __m128i*)t.lmul);
+    const __m128i rmul = _mm_loadu_si128((const __m128i*)t.rmul);
+    const __m128i mask = _mm_set1_epi16((1<<bits)-1);
+    const __m128i zero = _mm_setzero_si128();
+    int i = 0;
+    while (i+8<=elements && (i/8)*bits+16<=length) {
+        __m128i w = _mm_loadu_si128((const __m128i*)(input+(i/8)*bits));
+        __m128i x = _mm_shuffle_epi8(w,xshuf);
+        __m128i y = _mm_shuffle_epi8(w,yshuf);
+        __m128i p = _mm_or_si128(_mm_mullo_epi16(x,lmul),_mm_mulhi_epu16(y,rmul));
+        p = _mm_and_si128(p,mask);
+        _mm_storeu_si128((__m128i*)(output+i),p);
+        if (_mm_movemask_epi8(_mm_cmpeq_epi16(p,zero)))
+            unpack_deadpixels(output,i,8);
+        i += 8;
+    }
+    return i;
+}
+
+TARGET_AVX2 static int
+unpack_avx2(const uint8_t* input, int length, uint16_t* output, int elements, int bits, int swap)
+{
+    unpack_tables t;
+    unpack_maketables(&t,bits,swap);
+    const __m256i xshuf = _mm256_broadcastsi128_si256(_mm_loadu_si128((const __m128i*)t.xshuf));
+    const __m256i yshuf = _mm256_broadcastsi128_si256(_mm_loadu_si128((const __m128i*)t.yshuf));
+    const __m256i lmul = _mm256_broadcastsi128_si256(_mm_loadu_si128((const __m128i*)t.lmul));
+    const __m256i rmul = _mm256_broadcastsi128_si256(_mm_loadu_si128((const __m128i*)t.rmul));
+    const __m256i mask = _mm256_set1_epi16((1<<bits)-1);
+    const __m256i zero = _mm256_setzero_si256();
+    int i = 0;
+    /* Two groups per step, one in each 128bit lane */
+    while (i+16<=elements && (i/8+1)*bits+16<=length) {
+        const uint8_t* g = input+(i/8)*bits;
+        __m256i w = _mm256_inserti128_si256(_mm256_castsi128_si256(_mm_loadu_si128((const __m128i*)g)),
+                                            _mm_loadu_si128((const __m128i*)(g+bits)),1);
+        __m256i x = _mm256_shuffle_epi8(w,xshuf);
+        __m256i y = _mm256_shuffle_epi8(w,yshuf);
+        __m256i p = _mm256_or_si256(_mm256_mullo_epi16(x,lmul),_mm256_mulhi_epu16(y,rmul));
+        p = _mm256_and_si256(p,mask);
+        _mm256_storeu_si256((__m256i*)(output+i),p);
+        if (_mm256_movemask_epi8(_mm256_cmpeq_epi16(p,zero)))
+            unpack_deadpixels(output,i,16);
+        i += 16;
+    }
+    return i;
+}
+#endif
+
+static void
+unpack_kernels(const uint8_t* input, int length, uint16_t* output, int elements, int bits, int swap, int level)
+{
+    int done = 0;
+#ifdef UNPACK_X86
+    if (level>=UNPACK_AVX2)
+        done = unpack_avx2(input,length,output,elements,bits,swap);
+    else if (level>=UNPACK_SSSE3)
+        done = unpack_ssse3(input,length,output,elements,bits,swap);
+    else if (level>=UNPACK_SSE2 && bits==14)
+        done = unpack_sse2_14(input,length,output,elements,swap);
+#endif
+    unpack_scalar(input,length,output,done,elements,bits,swap);
+}
+
+/*
+Decode the single value at index, without dead pixel masking
+*/
+static uint32_t
+unpack_pixel(const uint8_t* input, int length, int index, int bits, int swap)
+{
+    long long bit = (long long)index*bits;
+    int pos = (int)(bit>>4)*2;
+    int shift = (int)(bit&15);
+    uint32_t acc = (unpack_word(input,length,pos,swap)<<16)|unpack_word(input,length,pos+2,swap);
+    return (acc>>(32-shift-bits))&((1<<bits)-1);
+}
+
+/*
+What dead pixel masking would have made of index. Only needed at the
+start of a range, where the values before it were not unpacked
+*/
+static uint32_t
+unpack_lookback(const uint8_t* input, int length, int index, int bits, int swap)
+{
+    while (index>=0) {
+        uint32_t v = unpack_pixel(input,length,index,bits,swap);
+        if (v)
+            return v;
+        index -= 2;
+    }
+    return 0;
+}
+
+/*
+Unpack values first to first+count of "bits" bits from input to the
+same place in output. first must be a multiple of 8.
+swap means the 16bit words are big endian (e.g. 12bit DNG data).
+The result is the same as unpacking everything in one go, so a frame
+can be split into ranges for several threads.
+Safe to call without the GIL.
+*/
+void
+unpack_bits(const uint8_t* input, int length, uint16_t* output, int first, int count, int bits, int swap, int level)
+{
+    int offset = (first/8)*bits;
+    int p;
+    if (count<=0)
+        return;
+    if (offset>length)
+        offset = length;
+    unpack_kernels(input+offset,length-offset,output+first,count,bits,swap,level);
+    if (first==0)
+        return;
+    for (p=0;p<2 && p<count;p++) {
+        int i;
+        uint32_t v;
+        if (output[first+p]!=0)
+            continue;
+        v = unpack_lookback(input,length,first+p-2,bits,swap);
+        for (i=first+p;i<first+count && output[i]==0;i+=2)
+            output[i] = v;
+    }
+}
+
+/*
+Apply linearization and black subtraction to a run of one row starting
+at column x, and measure it. Even values are channel ca and odd values channel cb.
+The levels are kept per lane of 16 values so the compiler can
+vectorise the loop. The histogram is made from 1 in UNPACK_HIST_STEP/2
+values of each channel, with bins spanning black to white.
+*/
+static inline void
+unpack_measure(uint16_t* px, int x, int n, const unpack_process* proc, unpack_stats* stats, int ca, int cb,
+               const int linearize, const int subtract)
+{
+    const uint16_t* lin = proc->lin;
+    uint32_t linmax = proc->linlen-1;
+    uint32_t black = proc->black;
+    uint32_t white = proc->white;
+    uint32_t range = white>black?white-black:0;
+    uint32_t hscale = range?(UNPACK_HIST_BINS<<16)/range:0;
+    uint16_t lo[16];
+    uint16_t hi[16];
+    uint32_t sum[16];
+    uint32_t clipped[16];
+    int j,k;
+    for (k=0;k<16;k++) {
+        lo[k] = 0xFFFF;
+        hi[k] = 0;
+        sum[k] = 0;
+        clipped[k] = 0;
+    }
+#define UNPACK_MEASURE(k) { \
+            uint32_t v = px[j+(k)]; \
+            if (linearize) \
+                v = lin[v<linmax?v:linmax]; \
+            clipped[k] += v>=white; \
+            if (subtract) \
+                v = v>black?v-black:0; \
+            if (linearize || subtract) \
+                px[j+(k)] = v; \
+            lo[k] = v<lo[k]?v:lo[k]; \
+            hi[k] = v>hi[k]?v:hi[k]; \
+            sum[k] += v; \
+        }
+    for (j=0;j+16<=n;j+=16)
+        for (k=0;k<16;k++)
+            UNPACK_MEASURE(k)
+    for (k=0;j+k<n;k++)
+        UNPACK_MEASURE(k)
+#undef UNPACK_MEASURE
+    for (k=0;k<16 && k<n;k++) {
+        int c = (k&1)?cb:ca;
+        if (lo[k]<stats->min[c]) stats->min[c] = lo[k];
+        if (hi[k]>stats->max[c]) stats->max[c] = hi[k];
+        stats->sum[c] += sum[k];
+        stats->clipped[c] += clipped[k];
+    }
+    stats->count[ca] += (n+1)/2;
+    stats->count[cb] += n/2;
+    /* Sample at the same columns however the frame was split up */
+    j = (UNPACK_HIST_STEP-x%UNPACK_HIST_STEP)%UNPACK_HIST_STEP;
+    if (j==UNPACK_HIST_STEP-1)
+        j = -1;
+    for (;j<n;j+=UNPACK_HIST_STEP) {
+        for (k=j<0?1:0;k<2 && j+k<n;k++) {
+            uint32_t v = px[j+k];
+            uint32_t above = subtract?v:(v>black?v-black:0);
+            uint32_t bin = ((above<range?above:range)*hscale)>>16;
+            stats->hist[((j+k)&1)?cb:ca][bin<UNPACK_HIST_BINS-1?bin:UNPACK_HIST_BINS-1]++;
+        }
+    }
+}
+
+static void
+unpack_process_row(uint16_t* px, int x, int n, const unpack_process* proc, unpack_stats* stats, int ca, int cb)
+{
+    if (proc->linlen>0) {
+        if (proc->subtract)
+            unpack_measure(px,x,n,proc,stats,ca,cb,1,1);
+        else
+            unpack_measure(px,x,n,proc,stats,ca,cb,1,0);
+    } else {
+        if (proc->subtract)
+            unpack_measure(px,x,n,proc,stats,ca,cb,0,1);
+        else
+            unpack_measure(px,x,n,proc,stats,ca,cb,0,0);
+    }
+}
+
+static void
+unpack_process_run(uint16_t* output, int start, int n, const unpack_process* proc, unpack_stats* stats)
+{
+    /* Channel (R,G1,G2,B) at each position of the 2x2 pattern */
+    static const int RGGB[4] = { 0, 1, 2, 3 };
+    static const int GBRG[4] = { 1, 3, 0, 2 };
+    const int* channels = proc->cfa==1?GBRG:RGGB;
+    int width = proc->width;
+    int x = start%width;
+    int y = start/width;
+    int i = 0;
+    while (i<n) {
+        int run = width-x;
+        if (run>n-i)
+            run = n-i;
+        unpack_process_row(output+start+i,x,run,proc,stats,
+            channels[((y&1)<<1)|(x&1)],channels[((y&1)<<1)|((x+1)&1)]);
+        i += run;
+        x = 0;
+        y++;
+    }
+}
+
+void
+unpack_stats_init(unpack_stats* stats)
+{
+    int c;
+    memset(stats,0,sizeof(unpack_stats));
+    for (c=0;c<4;c++)
+        stats->min[c] = 0xFFFF;
+}
+
+/*
+Unpack a range as unpack_bits does, and in the same pass (a chunk at a
+time while it is still in cache) linearize, subtract black and measure
+it into stats. bits can also be 16, where input is already unpacked
+(and may be the same as output).
+*/
+void
+unpack_frame(const uint8_t* input, int length, uint16_t* output, int first, int count, int bits, int swap, int level,
+             const unpack_process* proc, unpack_stats* stats)
+{
+    int done = 0;
+    while (done<count) {
+        int n = count-done;
+        if (n>UNPACK_CHUNK)
+            n = UNPACK_CHUNK;
+        if (bits==16) {
+            long long offset = (long long)(first+done)*2;
+            long long have = length-offset;
+            if (have>n*2) have = n*2;
+            if (have<0) have = 0;
+            if ((const uint8_t*)(output+first+done)!=input+offset)
+                memmove(output+first+done,input+offset,have);
+            memset((uint8_t*)(output+first+done)+have,0,n*2-have);
+        } else
+            unpack_bits(input,length,output,first+done,n,bits,swap,level);
+        unpack_process_run(output,first+done,n,proc,stats);
+        done += n;
+    }
+}
+
+/*
+Unpack a whole frame of 10, 12, 14 or 16 bit values to floats ready for
+demosaicing: black is subtracted and a small offset added so that the
+demosaic never sees values at or below zero.
+Works through the frame a chunk at a time, carrying the last two
+values over for dead pixel masking.
+*/
+void
+unpack_tofloat(const uint8_t* input, int length, float* output, int elements, int bits, int swap, int black, int level)
+{
+    uint16_t tmp[UNPACK_CHUNK+2];
+    int done = 0;
+    tmp[0] = tmp[1] = 0;
+    while (done<elements) {
+        uint16_t* chunk = tmp+2;
+        int n = elements-done;
+        int i,p;
+        if (n>UNPACK_CHUNK)
+            n = UNPACK_CHUNK;
+        if (bits==16) {
+            if ((done+n)*2<=length) {
+                memcpy(chunk,input+done*2,n*2);
+                if (swap)
+                    for (i=0;i<n;i++)
+                        chunk[i] = (uint16_t)((chunk[i]>>8)|(chunk[i]<<8));
+            } else {
+                for (i=0;i<n;i++)
+                    chunk[i] = unpack_word(input,length,(done+i)*2,swap);
+            }
+            for (i=0;i<n;i++)
+                if (chunk[i]==0 && done+i>=2)
+                    chunk[i] = chunk[i-2];
+        } else {
+            int offset = (done/8)*bits;
+            if (offset>length)
+                offset = length;
+            unpack_kernels(input+offset,length-offset,chunk,n,bits,swap,level);
+            for (p=0;p<2 && p<n;p++)
+                if (chunk[p]==0 && done+p>=2)
+                    for (i=p;i<n && chunk[i]==0;i+=2)
+                        chunk[i] = chunk[i-2];
+        }
+        for (i=0;i<n;i++) {
+            int ival = (int)chunk[i]-black;
+            // To avoid artifacts from demosaicing at low levels
+            if (ival<0) ival = 0;
+            output[done+i] = (float)(ival+15);
+        }
+        if (n>=2) {
+            tmp[0] = chunk[n-2];
+            tmp[1] = chunk[n-1];
+        }
+        done += n;
+    }
+}
+
+/*
+Decode a reduced resolution linear RGB image straight from the Bayer
+data, skipping the full unpack and demosaic. Each output pixel comes
+from the 2x2 Bayer quad at the top left of its factor x factor block,
+so only 2 of every factor rows are unpacked. Green is the mean of the
+two greens. Black is subtracted. Writes output rows first..first+rows-1
+of the (width/factor) x (height/factor) image.
+*/
+static void
+unpack_row(const uint8_t* input, int length, uint16_t* row, int first, int n, int bits, int swap, int level)
+{
+    int i,p;
+    if (bits==16) {
+        if (((long long)first+n)*2<=length) {
+            memcpy(row,input+(long long)first*2,n*2);
+            if (swap)
+                for (i=0;i<n;i++)
+                    row[i] = (uint16_t)((row[i]>>8)|(row[i]<<8));
+        } else {
+            for (i=0;i<n;i++)
+                row[i] = unpack_word(input,length,(first+i)*2,swap);
+        }
+        for (i=2;i<n;i++)
+            if (row[i]==0)
+                row[i] = row[i-2];
+    } else {
+        /* Packed groups are 8 values long so start at a group boundary */
+        int skip = first&7;
+        int offset = ((first-skip)/8)*bits;
+        if (offset>length)
+            offset = length;
+        unpack_kernels(input+offset,length-offset,row,n+skip,bits,swap,level);
+        memmove(row,row+skip,n*sizeof(uint16_t));
+    }
+    /* Dead pixels at the row start take their value from earlier rows */
+    for (p=0;p<2 && p<n;p++) {
+        if (row[p]==0 && first+p>=2) {
+            row[p] = unpack_lookback(input,length,first+p-2,bits,swap);
+            for (i=p+2;i<n && row[i]==0;i+=2)
+                row[i] = row[i-2];
+        }
+    }
+}
+
+int
+unpack_reduced(const uint8_t* input, int length, uint16_t* output, int width, int height,
+               int bits, int swap, int factor, int black, int cfa, int level, int first, int rows)
+{
+    static const int RGGB[4] = { 0, 1, 2, 3 };
+    static const int GBRG[4] = { 1, 3, 0, 2 };
+    const int* channels = cfa==1?GBRG:RGGB;
+    int ow = width/factor;
+    int oy;
+    uint16_t* top = (uint16_t*)malloc((width+8)*2*sizeof(uint16_t));
+    uint16_t* bottom = top+width+8;
+    if (top==NULL)
+        return -1;
+    for (oy=first;oy<first+rows;oy++) {
+        int sy = (oy*factor)&~1;
+        int ox;
+        uint16_t* out = output+oy*ow*3;
+        unpack_row(input,length,top,sy*width,width,bits,swap,level);
+        unpack_row(input,length,bottom,(sy+1)*width,width,bits,swap,level);
+        for (ox=0;ox<ow;ox++) {
+            int sx = (ox*factor)&~1;
+            int v[4];
+            int c;
+            v[channels[0]] = top[sx];
+            v[channels[1]] = top[sx+1];
+            v[channels[2]] = bottom[sx];
+            v[channels[3]] = bottom[sx+1];
+            v[1] = (v[1]+v[2]+1)>>1;
+            v[2] = v[3];
+            for (c=0;c<3;c++) {
+                int l = v[c]-black;
+                *out++ = (uint16_t)(l<0?0:l);
+            }
+        }
+    }
+    free(top);
+    return 0;
+}
+
+/*
+Interleave demosaiced R, G and B planes into RGB, multiplied by scale,
+as uint16 (rounded, clamped to 0..65535) or float16 (nearest even, as
+numpy does). Both take half the memory and upload bandwidth of float32.
+*/
+static inline uint16_t
+unpack_float_uint16(float f)
+{
+    f = f>0.0f?f:0.0f; /* Also NaN */
+    f = f<65535.0f?f:65535.0f;
+    return (uint16_t)(int)(f+0.5f);
+}
+
+#ifdef UNPACK_X86
+static inline __m128i
+unpack_uint16_sse2(const float* p, __m128 s)
+{
+    const __m128 zero = _mm_setzero_ps();
+    const __m128 top = _mm_set1_ps(65535.0f);
+    const __m128 half = _mm_set1_ps(0.5f);
+    const __m128i bias = _mm_set1_epi32(32768);
+    /* max returns 0 for NaN, like the scalar version */
+    __m128 lo = _mm_min_ps(_mm_max_ps(_mm_mul_ps(_mm_loadu_ps(p),s),zero),top);
+    __m128 hi = _mm_min_ps(_mm_max_ps(_mm_mul_ps(_mm_loadu_ps(p+4),s),zero),top);
+    __m128i ilo = _mm_sub_epi32(_mm_cvttps_epi32(_mm_add_ps(lo,half)),bias);
+    __m128i ihi = _mm_sub_epi32(_mm_cvttps_epi32(_mm_add_ps(hi,half)),bias);
+    /* Only a signed saturating pack in SSE2, so pack around 0 and flip back */
+    return _mm_xor_si128(_mm_packs_epi32(ilo,ihi),_mm_set1_epi16((short)0x8000));
+}
+
+static int
+unpack_rgb_uint16_sse2(const float* r, const float* g, const float* b, uint16_t* output, int elements, float scale)
+{
+    uint16_t tmp[3][8];
+    __m128 s = _mm_set1_ps(scale);
+    int i,j;
+    for (i=0;i+8<=elements;i+=8) {
+        _mm_storeu_si128((__m128i*)tmp[0],unpack_uint16_sse2(r+i,s));
+        _mm_storeu_si128((__m128i*)tmp[1],unpack_uint16_sse2(g+i,s));
+        _mm_storeu_si128((__m128i*)tmp[2],unpack_uint16_sse2(b+i,s));
+        for (j=0;j<8;j++) {
+            output[0] = tmp[0][j];
+            output[1] = tmp[1][j];
+            output[2] = tmp[2][j];
+            output += 3;
+        }
+    }
+    return i;
+}
+#endif
+
+void
+unpack_rgb_uint16(const float* r, const float* g, const float* b, uint16_t* output, int elements, float scale, int level)
+{
+    int i = 0;
+#ifdef UNPACK_X86
+    if (level>=UNPACK_SSE2)
+        i = unpack_rgb_uint16_sse2(r,g,b,output,elements,scale);
+#endif
+    output += i*3;
+    for (;i<elements;i++) {
+        output[0] = unpack_float_uint16(r[i]*scale);
+        output[1] = unpack_float_uint16(g[i]*scale);
+        output[2] = unpack_float_uint16(b[i]*scale);
+        output += 3;
+    }
+}
+
+static inline uint16_t
+unpack_float_half(float f)
+{
+    uint32_t x;
+    memcpy(&x,&f,4);
+    uint32_t sign = (x>>16)&0x8000;
+    uint32_t absx = x&0x7fffffff;
+    uint32_t h,rem,halfway;
+    if (absx>=0x7f800000) { /* Inf, or NaN keeping the top of its payload */
+        h = 0x7c00|((absx&0x7fffff)>>13);
+        if (absx>0x7f800000 && h==0x7c00)
+            h++;
+        return sign|h;
+    }
+    if (absx<0x38800000) { /* Subnormal or zero as a half */
+        int shift = 126-(int)(absx>>23);
+        if (shift>24)
+            return sign;
+        uint32_t m = (absx&0x7fffff)|0x800000;
+        h = m>>shift;
+        rem = m&((1u<<shift)-1);
+        halfway = 1u<<(shift-1);
+    } else {
+        h = (absx-0x38000000)>>13; /* Rebias the exponent, drop 13 mantissa bits */
+        rem = absx&0x1fff;
+        halfway = 0x1000;
+    }
+    if (rem>halfway || (rem==halfway && (h&1)))
+        h++; /* Can carry into the exponent, or up to infinity */
+    if (h>0x7c00)
+        h = 0x7c00;
+    return sign|h;
+}
+
+#ifdef UNPACK_X86
+TARGET_F16C static int
+unpack_rgb_half_f16c(const float* r, const float* g, const float* b, uint16_t* output, int elements, float scale)
+{
+    uint16_t tmp[3][8];
+    __m256 s = _mm256_set1_ps(scale);
+    int i,j;
+    for (i=0;i+8<=elements;i+=8) {
+        _mm_storeu_si128((__m128i*)tmp[0],_mm256_cvtps_ph(_mm256_mul_ps(_mm256_loadu_ps(r+i),s),_MM_FROUND_TO_NEAREST_INT));
+        _mm_storeu_si128((__m128i*)tmp[1],_mm256_cvtps_ph(_mm256_mul_ps(_mm256_loadu_ps(g+i),s),_MM_FROUND_TO_NEAREST_INT));
+        _mm_storeu_si128((__m128i*)tmp[2],_mm256_cvtps_ph(_mm256_mul_ps(_mm256_loadu_ps(b+i),s),_MM_FROUND_TO_NEAREST_INT));
+        for (j=0;j<8;j++) {
+            output[0] = tmp[0][j];
+            output[1] = tmp[1][j];
+            output[2] = tmp[2][j];
+            output += 3;
+        }
+    }
+    return i;
+}
+#endif
+
+void
+unpack_rgb_half(const float* r, const float* g, const float* b, uint16_t* output, int elements, float scale, int level)
+{
+    int i = 0;
+#ifdef UNPACK_X86
+    if (level>=UNPACK_AVX2)
+        i = unpack_rgb_half_f16c(r,g,b,output,elements,scale);
+#endif
+    output += i*3;
+    for (;i<elements;i++) {
+        output[0] = unpack_float_half(r[i]*scale);
+        output[1] = unpack_float_half(g[i]*scale);
+        output[2] = unpack_float_half(b[i]*scale);
+        output += 3;
+    }
+}
@@ -0,0 +1,89 @@
+/*
+unpack_simd.h, part of MlRawViewer
+(c) Andrew Baldwin 2014
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+*/
+
+#ifndef UNPACK_SIMD_H
+#define UNPACK_SIMD_H
+
+#include <stdint.h>
+
+enum UNPACK_LEVELS {
+    UNPACK_SCALAR = 0,
+    UNPACK_SSE2 = 1,
+    UNPACK_SSSE3 = 2,
+    UNPACK_AVX2 = 3,
+};
+
+/* Best variant this CPU can run */
+int unpack_simd_detect(void);
+const char* unpack_simd_name(int level);
+/* Returns -1 for unknown names */
+int unpack_simd_level(const char* name);
+
+void unpack_bits(const uint8_t* input, int length, uint16_t* output,
+                 int first, int count, int bits, int swap, int level);
+
+/* Values handled at a time when more than unpacking is done. A multiple of 8 */
+#define UNPACK_CHUNK 4096
+
+#define UNPACK_HIST_BINS 64
+/* Histograms are made from every UNPACK_HIST_STEP/2th value of each channel */
+#define UNPACK_HIST_STEP 32
+
+/* What to do to each value after unpacking */
+typedef struct {
+    int width;
+    int black;
+    int white;
+    int cfa; /* 0 RGGB, 1 GBRG */
+    int subtract; /* Subtract black from the stored values */
+    const uint16_t* lin; /* Linearization table, or NULL */
+    int linlen;
+} unpack_process;
+
+/* Per channel levels, in R, G1, G2, B order */
+typedef struct {
+    uint32_t min[4];
+    uint32_t max[4];
+    uint64_t sum[4];
+    uint32_t count[4];
+    uint32_t clipped[4];
+    uint32_t hist[4][UNPACK_HIST_BINS];
+} unpack_stats;
+
+void unpack_stats_init(unpack_stats* stats);
+void unpack_frame(const uint8_t* input, int length, uint16_t* output,
+                  int first, int count, int bits, int swap, int level,
+                  const unpack_process* proc, unpack_stats* stats);
+
+void unpack_tofloat(const uint8_t* input, int length, float* output,
+                    int elements, int bits, int swap, int black, int level);
+
+int unpack_reduced(const uint8_t* input, int length, uint16_t* output, int width, int height,
+                   int bits, int swap, int factor, int black, int cfa, int level, int first, int rows);
+
+void unpack_rgb_uint16(const float* r, const float* g, const float* b, uint16_t* output,
+                       int elements, float scale, int level);
+void unpack_rgb_half(const float* r, const float* g, const float* b, uint16_t* output,
+                     int elements, float scale, int level);
+
+#endif
@@ -0,0 +1,186 @@
+/*
+workpool.c, part of MlRawViewer
+(c) Andrew Baldwin 2014
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+*/
+
+/*
+Threads and locks come from Python's own portable thread layer, so this
+builds wherever the interpreter does. None of the workers touch Python
+objects, so they never need the GIL.
+*/
+
+#include <Python.h>
+#include <pythread.h>
+
+#include "workpool.h"
+
+typedef struct {
+    PyThread_type_lock lock;
+    int next; /* Items next..end-1 are still to do */
+    int end;
+} workshare;
+
+typedef struct {
+    workpool_fn fn;
+    void* ctx;
+    int threads;
+    workshare share[WORKPOOL_MAX_THREADS];
+    PyThread_type_lock countlock;
+    int running; /* Started threads still working */
+    PyThread_type_lock done; /* Held until the last started thread ends */
+} workpool;
+
+typedef struct {
+    workpool* pool;
+    int worker;
+} workerarg;
+
+static int
+workpool_take(workpool* pool, int worker)
+{
+    workshare* own = &pool->share[worker];
+    int item = -1;
+    PyThread_acquire_lock(own->lock,WAIT_LOCK);
+    if (own->next < own->end)
+        item = own->next++;
+    PyThread_release_lock(own->lock);
+    return item;
+}
+
+/* Move the back half of the largest other share to this worker.
+ * Returns 0 when there is nothing left anywhere */
+static int
+workpool_steal(workpool* pool, int worker)
+{
+    while (1) {
+        int victim = -1;
+        int most = 0;
+        int w;
+        for (w=0;w<pool->threads;w++) {
+            int left = pool->share[w].end - pool->share[w].next; /* Unlocked peek */
+            if (w!=worker && left>most) {
+                most = left;
+                victim = w;
+            }
+        }
+        if (victim<0)
+            return 0;
+        workshare* from = &pool->share[victim];
+        int first = -1;
+        int end = 0;
+        PyThread_acquire_lock(from->lock,WAIT_LOCK);
+        int left = from->end - from->next;
+        if (left>0) {
+            end = from->end;
+            first = end - (left+1)/2;
+            from->end = first;
+        }
+        PyThread_release_lock(from->lock);
+        if (first>=0) {
+            workshare* own = &pool->share[worker];
+            PyThread_acquire_lock(own->lock,WAIT_LOCK);
+            own->next = first;
+            own->end = end;
+            PyThread_release_lock(own->lock);
+            return 1;
+        }
+        /* Emptied meanwhile, look again */
+    }
+}
+
+static void
+workpool_work(workpool* pool, int worker)
+{
+    do {
+        int item;
+        while ((item = workpool_take(pool,worker))>=0)
+            pool->fn(pool->ctx,item,worker);
+    } while (workpool_steal(pool,worker));
+}
+
+static void
+workpool_thread(void* arg)
+{
+    workerarg* wa = (workerarg*)arg;
+    workpool* pool = wa->pool;
+    workpool_work(pool,wa->worker);
+    PyThread_acquire_lock(pool->countlock,WAIT_LOCK);
+    int last = (--pool->running)==0;
+    PyThread_release_lock(pool->countlock);
+    if (last)
+        PyThread_release_lock(pool->done);
+}
+
+int
+workpool_run(int threads, int items, workpool_fn fn, void* ctx)
+{
+    int i;
+    if (threads>items) threads = items;
+    if (threads>WORKPOOL_MAX_THREADS) threads = WORKPOOL_MAX_THREADS;
+    if (threads<=1) {
+        for (i=0;i<items;i++)
+            fn(ctx,i,0);
+        return 1;
+    }
+    workpool pool;
+    workerarg args[WORKPOOL_MAX_THREADS];
+    pool.fn = fn;
+    pool.ctx = ctx;
+    pool.threads = threads;
+    for (i=0;i<threads;i++) {
+        pool.share[i].lock = PyThread_allocate_lock();
+        pool.share[i].next = (int)(((long long)items*i)/threads);
+        pool.share[i].end = (int)(((long long)items*(i+1))/threads);
+    }
+    pool.countlock = PyThread_allocate_lock();
+    pool.done = PyThread_allocate_lock();
+    PyThread_acquire_lock(pool.done,WAIT_LOCK);
+    /* The caller holds one count until all threads are started, so the
+     * count can only reach 0 in a worker once nothing else will touch it */
+    pool.running = 1;
+    int started = 1;
+    for (i=1;i<threads;i++) {
+        args[i].pool = &pool;
+        args[i].worker = i;
+        PyThread_acquire_lock(pool.countlock,WAIT_LOCK);
+        pool.running++;
+        PyThread_release_lock(pool.countlock);
+        if (PyThread_start_new_thread(workpool_thread,&args[i]) == -1) {
+            /* Its share gets stolen by the others */
+            PyThread_acquire_lock(pool.countlock,WAIT_LOCK);
+            pool.running--;
+            PyThread_release_lock(pool.countlock);
+        } else {
+            started++;
+        }
+    }
+    workpool_work(&pool,0);
+    PyThread_acquire_lock(pool.countlock,WAIT_LOCK);
+    int wait = (--pool.running)>0;
+    PyThread_release_lock(pool.countlock);
+    if (wait) /* The last thread to end releases done, and touches nothing after */
+        PyThread_acquire_lock(pool.done,WAIT_LOCK);
+    for (i=0;i<threads;i++)
+        PyThread_free_lock(pool.share[i].lock);
+    PyThread_free_lock(pool.countlock);
+    PyThread_free_lock(pool.done);
+    return started;
+}
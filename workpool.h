@@ -0,0 +1,45 @@
+/*
+workpool.h, part of MlRawViewer
+(c) Andrew Baldwin 2014
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+*/
+
+/*
+Run numbered items of work on native threads, without the GIL.
+
+Each worker starts with an equal contiguous share of the items and takes
+them from the front. A worker with nothing left steals the back half of
+the largest remaining share, so uneven items do not leave cores idle at
+the end. The calling thread is worker 0, so one thread runs everything
+in the caller.
+*/
+
+#ifndef WORKPOOL_H
+#define WORKPOOL_H
+
+#define WORKPOOL_MAX_THREADS 64
+
+/* Called for each item. worker is 0..threads-1, for per worker scratch */
+typedef void (*workpool_fn)(void* ctx, int item, int worker);
+
+/* Returns the number of threads which took part */
+int workpool_run(int threads, int items, workpool_fn fn, void* ctx);
+
+#endif